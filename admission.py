@@ -0,0 +1,224 @@
+# admission.py
+"""
+对外 API 调用的全局准入控制。
+
+每个“端点:模型”一个令牌桶，桶状态和等待队列存放在本地 SQLite 库
+（ADMISSION_DATABASE），同一台机器上的所有 Streamlit 进程共享。所有端点共用同一个
+（按桶限长的）等待队列，按优先级（数值小的优先）和入队顺序排队：只要还有更高优先级的
+请求在等待，任何桶都不放行低优先级请求，因此交互聊天总是排在批量图片任务之前；同一
+优先级内各桶互不阻塞，轮到本桶队首且桶里有令牌时放行。
+等待期间通过 on_wait(位置, 预计等待秒数) 回调通知调用方。设置 API_ADMISSION=0 关闭。
+acquire_async() 是供事件循环使用的版本，排队等待时不占用线程。
+"""
+import asyncio
+import os
+import sqlite3
+import time
+
+import requests
+
+import database
+
+ENABLED = os.environ.get("API_ADMISSION", "1") != "0"
+ADMISSION_DATABASE = os.environ.get("ADMISSION_DATABASE", "admission.db")
+
+PRIORITY_INTERACTIVE = 0            # 聊天等交互请求
+PRIORITY_BULK = 10                  # 批量图片生成等可以等待的任务
+
+# 每个端点的默认限额：(每秒补充的令牌数, 桶容量)；RATE_LIMITS 可按 "端点:模型" 单独覆盖
+DEFAULT_LIMITS = {
+    "chat": (1.0, 10),
+    "images": (0.2, 3),
+}
+RATE_LIMITS = {}
+MAX_QUEUE_LENGTH = 50               # 每个桶最多排队的请求数，超出直接拒绝
+DEFAULT_TIMEOUT_S = 120
+POLL_INTERVAL_S = 0.25
+STALE_WAITER_S = 10                 # 超过该时间未刷新心跳的排队记录视为进程已退出
+
+
+class AdmissionRejected(requests.exceptions.RequestException):
+    """The request was not admitted: the queue was full or the wait timed out."""
+
+
+def _migration_1_admission_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            bucket TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admission_queue (
+            ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+            bucket TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            heartbeat_at REAL NOT NULL
+        );
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admission_queue_order ON admission_queue (bucket, priority, ticket);')
+
+
+def _migration_2_global_queue_order(cursor):
+    """Index for the provider-wide priority order (see _try_admit)."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admission_queue_priority ON admission_queue (priority, ticket);')
+
+
+ADMISSION_MIGRATIONS = [
+    (1, _migration_1_admission_tables),
+    (2, _migration_2_global_queue_order),
+]
+database.register_migrations(ADMISSION_DATABASE, ADMISSION_MIGRATIONS)
+
+
+def bucket_for(endpoint, model):
+    return f"{endpoint}:{model}" if model else endpoint
+
+
+def _limits(bucket):
+    if bucket in RATE_LIMITS:
+        return RATE_LIMITS[bucket]
+    return DEFAULT_LIMITS.get(bucket.split(":", 1)[0], DEFAULT_LIMITS["chat"])
+
+
+def _connect():
+    conn = database.create_connection(ADMISSION_DATABASE)
+    if conn is None:
+        raise AdmissionRejected("无法打开准入控制数据库")
+    return conn
+
+
+def _enqueue(bucket, priority):
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        cursor.execute('DELETE FROM admission_queue WHERE heartbeat_at < ?', (now - STALE_WAITER_S,))
+        queued = cursor.execute('SELECT COUNT(*) FROM admission_queue WHERE bucket = ?', (bucket,)).fetchone()[0]
+        if queued >= MAX_QUEUE_LENGTH:
+            conn.rollback()
+            raise AdmissionRejected(f"当前排队请求过多（{queued} 个），请稍后再试")
+        cursor.execute('INSERT INTO admission_queue (bucket, priority, heartbeat_at) VALUES (?, ?, ?)',
+                       (bucket, priority, now))
+        ticket = cursor.lastrowid
+        conn.commit()
+        return ticket
+    finally:
+        conn.close()
+
+
+def _try_admit(bucket, priority, ticket):
+    """Take a token if nothing is ahead of this ticket; returns (admitted, position, wait_s).
+
+    Ahead means any waiting ticket of a higher priority (whatever its bucket), or an
+    earlier ticket of the same priority in the same bucket.
+    """
+    rate, burst = _limits(bucket)
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        # 先刷新自己的心跳，再清理已退出进程留下的排队记录，免得死掉的队首一直挡住后面的请求
+        cursor.execute('UPDATE admission_queue SET heartbeat_at = ? WHERE ticket = ?', (now, ticket))
+        cursor.execute('DELETE FROM admission_queue WHERE heartbeat_at < ?', (now - STALE_WAITER_S,))
+        cursor.execute('INSERT OR IGNORE INTO rate_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?)',
+                       (bucket, burst, now))
+        tokens, updated_at = cursor.execute('SELECT tokens, updated_at FROM rate_buckets WHERE bucket = ?',
+                                            (bucket,)).fetchone()
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        position = cursor.execute('''
+            SELECT COUNT(*) FROM admission_queue
+            WHERE priority < ? OR (priority = ? AND bucket = ? AND ticket < ?)
+        ''', (priority, priority, bucket, ticket)).fetchone()[0]
+        admitted = position == 0 and tokens >= 1
+        if admitted:
+            tokens -= 1
+            cursor.execute('DELETE FROM admission_queue WHERE ticket = ?', (ticket,))
+        cursor.execute('UPDATE rate_buckets SET tokens = ?, updated_at = ? WHERE bucket = ?', (tokens, now, bucket))
+        conn.commit()
+        # 前面 position 个请求各要一个令牌，自己还要一个
+        wait_s = max(0.0, (position + 1 - tokens) / rate)
+        return admitted, position, wait_s
+    finally:
+        conn.close()
+
+
+def _leave(ticket):
+    conn = _connect()
+    try:
+        conn.execute('DELETE FROM admission_queue WHERE ticket = ?', (ticket,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def acquire(bucket, priority=PRIORITY_INTERACTIVE, on_wait=None, timeout=DEFAULT_TIMEOUT_S):
+    """Block until a request against bucket may be sent.
+
+    on_wait(position, wait_s) is called while queued, with the number of requests
+    ahead and the expected wait in seconds. Raises AdmissionRejected when the queue
+    is full or timeout expires.
+    """
+    if not ENABLED:
+        return
+    try:
+        ticket = _enqueue(bucket, priority)
+    except sqlite3.Error as e:
+        # 准入库本身不可用时不阻塞业务请求
+        print(f"Database error during admission enqueue: {e}")
+        return
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            admitted, position, wait_s = _try_admit(bucket, priority, ticket)
+            if admitted:
+                ticket = None
+                return
+            if time.monotonic() >= deadline:
+                raise AdmissionRejected(f"排队超时（{timeout} 秒），请稍后再试")
+            if on_wait is not None:
+                on_wait(position, wait_s)
+            time.sleep(min(POLL_INTERVAL_S, max(0.01, wait_s)))
+    except sqlite3.Error as e:
+        print(f"Database error during admission: {e}")
+    finally:
+        if ticket is not None:
+            try:
+                _leave(ticket)
+            except sqlite3.Error as e:
+                print(f"Database error during admission cleanup: {e}")
+
+
+async def acquire_async(bucket, priority=PRIORITY_INTERACTIVE, on_wait=None, timeout=DEFAULT_TIMEOUT_S):
+    """acquire() for coroutines: the SQLite steps run in worker threads and the wait between polls is an asyncio sleep."""
+    if not ENABLED:
+        return
+    try:
+        ticket = await asyncio.to_thread(_enqueue, bucket, priority)
+    except sqlite3.Error as e:
+        print(f"Database error during admission enqueue: {e}")
+        return
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            admitted, position, wait_s = await asyncio.to_thread(_try_admit, bucket, priority, ticket)
+            if admitted:
+                ticket = None
+                return
+            if time.monotonic() >= deadline:
+                raise AdmissionRejected(f"排队超时（{timeout} 秒），请稍后再试")
+            if on_wait is not None:
+                on_wait(position, wait_s)
+            await asyncio.sleep(min(POLL_INTERVAL_S, max(0.01, wait_s)))
+    except sqlite3.Error as e:
+        print(f"Database error during admission: {e}")
+    finally:
+        if ticket is not None:
+            # 协程被取消（如对冲请求落败）时也要退出队列
+            try:
+                await asyncio.to_thread(_leave, ticket)
+            except sqlite3.Error as e:
+                print(f"Database error during admission cleanup: {e}")
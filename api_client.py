@@ -0,0 +1,486 @@
+# api_client.py
+"""
+SiliconFlow API 的共享 HTTP 客户端。
+
+整个进程共用一个 requests.Session：urllib3 连接池保持到 api.siliconflow.cn 的
+keep-alive 连接，后续请求不再重复 TCP+TLS 握手；Authorization 等请求头在 Session
+上统一配置。用户登录时调用 prewarm() 在后台预先建立连接。
+stream_chat_completion() 以 SSE 流式接收回复，TextStream 把增量拼回完整文本，
+R1 模型的推理过程（reasoning_content 或 <think> 块）与正文分开，见 split_reasoning()。
+
+post_with_retry() 对 429/5xx 和连接错误做带抖动的指数退避重试，优先遵循 Retry-After；
+post_hedged() 在请求耗时超过近期 p95 时再发一个相同请求，取先成功的一个（API_HEDGE=1 开启）。
+每次实际发出请求前都经过 admission 的全局令牌桶和优先级队列。
+post_coalesced() 让同一进程内同时发出的相同请求共用一次上游调用（singleflight）。
+页面通过 async_client 调用：安装了 aiohttp 时走共享事件循环，否则回退到本模块的实现。
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import admission
+
+# 可指向本地替身服务器（mock_siliconflow.py）做离线测试和压测
+SILICONFLOW_BASE_URL = os.environ.get("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn").rstrip("/")
+CHAT_COMPLETIONS_URL = f"{SILICONFLOW_BASE_URL}/v1/chat/completions"
+IMAGE_GENERATIONS_URL = f"{SILICONFLOW_BASE_URL}/v1/images/generations"
+
+# 连接池大小：POOL_MAXSIZE 约等于同时在途的 API 请求数（Streamlit 每个会话一个脚本线程）
+POOL_CONNECTIONS = 4                # 按主机划分的连接池个数
+POOL_MAXSIZE = int(os.environ.get("API_POOL_MAXSIZE", "16"))
+PREWARM_CONNECTIONS = 2             # 登录时预先建立的连接数
+PREWARM_TIMEOUT_S = 10
+
+# 重试：只针对限流、服务端错误和连接层错误
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BASE_DELAY_S = 0.5
+RETRY_MAX_DELAY_S = 20              # Retry-After 超过该值时不再等待，直接把响应交给调用方
+
+# 对冲请求：默认关闭，每个对冲都是一次额外的计费请求
+HEDGE_ENABLED = os.environ.get("API_HEDGE", "") == "1"
+HEDGE_MIN_DELAY_S = 2.0
+HEDGE_MIN_SAMPLES = 20              # 样本太少时 p95 不可靠，不发对冲
+LATENCY_WINDOW = 200
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide Session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_block=False：池满时临时多开连接而不是排队等待
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    "Authorization": f"Bearer {os.environ['API_KEY']}",
+                    "Content-Type": "application/json",
+                })
+                _session = session
+    return _session
+
+
+def post(url, **kwargs):
+    """requests.post() over the shared keep-alive pool; auth headers are added by the Session."""
+    return get_session().post(url, **kwargs)
+
+
+def is_transient_error(e):
+    """True for errors worth falling back to another model on: timeouts, connection errors, 429 and 5xx."""
+    if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    response = getattr(e, "response", None)
+    return isinstance(e, requests.exceptions.HTTPError) and response is not None \
+        and response.status_code in RETRY_STATUSES
+
+
+def _retry_after_s(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _admission_bucket(url, payload):
+    endpoint = "images" if "/images/" in url else "chat"
+    return admission.bucket_for(endpoint, (payload or {}).get("model"))
+
+
+def post_with_retry(url, max_retries=MAX_RETRIES, priority=admission.PRIORITY_INTERACTIVE, on_wait=None, **kwargs):
+    """post() that retries 429/5xx responses and connection errors (including connect timeouts).
+
+    Read timeouts are not retried: the request already reached the server, where it may
+    still be running and is billed, and a retry would be charged again (and wait another
+    full timeout). Waits Retry-After when the server sends it, otherwise a full-jitter exponential
+    backoff. Every attempt first waits for admission (see admission.acquire; priority
+    and on_wait are passed through). Returns the last response (the caller still
+    calls raise_for_status()).
+    """
+    bucket = _admission_bucket(url, kwargs.get("json"))
+    for attempt in range(max_retries + 1):
+        admission.acquire(bucket, priority, on_wait)
+        try:
+            response = post(url, **kwargs)
+        except requests.exceptions.ConnectionError:  # ConnectTimeout 也是 ConnectionError，ReadTimeout 不是
+            if attempt >= max_retries:
+                raise
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY_S * (2 ** attempt)))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+            return response
+        delay = _retry_after_s(response)
+        if delay is None:
+            delay = random.uniform(0, RETRY_BASE_DELAY_S * (2 ** attempt))
+        elif delay > RETRY_MAX_DELAY_S:
+            return response
+        response.close()
+        time.sleep(delay)
+
+
+_latencies = {}                     # {hedge_key: deque(最近的成功请求耗时)}
+_latency_lock = threading.Lock()
+_hedge_executor = None
+
+
+def _record_latency(key, seconds):
+    with _latency_lock:
+        _latencies.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def _hedge_delay_s(key):
+    with _latency_lock:
+        samples = sorted(_latencies.get(key, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY_S, samples[int(len(samples) * 0.95) - 1])
+
+
+def _timed_post(key, url, kwargs):
+    start = time.monotonic()
+    response = post_with_retry(url, **kwargs)
+    if response.ok:
+        _record_latency(key, time.monotonic() - start)
+    return response
+
+
+def _close_when_done(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def post_hedged(url, hedge_key, **kwargs):
+    """post_with_retry() that, if the request outlives the recent p95 for hedge_key
+    (e.g. the model id), sends one duplicate and returns whichever succeeds first."""
+    global _hedge_executor
+    delay = _hedge_delay_s(hedge_key) if HEDGE_ENABLED else None
+    if delay is None:
+        return _timed_post(hedge_key, url, kwargs)
+    if _hedge_executor is None:
+        with _session_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=POOL_MAXSIZE, thread_name_prefix="api-hedge")
+    # 工作线程里不能调用页面的 on_wait；对冲请求以低优先级排队，不挤占交互请求
+    kwargs.pop("on_wait", None)
+    primary = _hedge_executor.submit(_timed_post, hedge_key, url, kwargs)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    hedge_kwargs = dict(kwargs, priority=admission.PRIORITY_BULK)
+    pending = {primary, _hedge_executor.submit(_timed_post, hedge_key, url, hedge_kwargs)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().ok:
+                for other in pending:
+                    other.add_done_callback(_close_when_done)  # 落后的请求完成后释放连接
+                return future.result()
+    # 两个请求都失败：以原请求的结果为准
+    return primary.result()
+
+
+def build_chat_payload(user_input, system_prompt_content, conversation_history, model_option, max_tokens_val, top_p_val):
+    """Chat completion request body for one turn (the same body asktoai sends)."""
+    api_messages = []
+    if system_prompt_content and system_prompt_content.strip():
+        api_messages.append({"role": "system", "content": system_prompt_content})
+    for msg in conversation_history:
+        api_messages.append({"role": msg["role"], "content": msg["content"]})
+    api_messages.append({"role": "user", "content": user_input})
+
+    payload = {
+        "model": model_option,
+        "messages": api_messages,
+        "stream": False,
+        "max_tokens": max_tokens_val,
+        "stop": ["null"],
+        "temperature": 0.7,
+        "top_p": top_p_val,
+        "top_k": 50,
+        "frequency_penalty": 0.5,
+        "n": 1,
+        "response_format": {"type": "text"},
+    }
+    return payload
+
+
+def request_chat_completion(payload, **options):
+    """Send a non-streaming chat completion; returns (text, usage, latency_s).
+
+    latency_s is the round trip of the final attempt, without admission queueing or
+    retry backoff. Does not touch Streamlit, so it can run on worker threads or from
+    scripts; options (priority, on_wait, max_retries) go to post_with_retry().
+    """
+    response = post_with_retry(CHAT_COMPLETIONS_URL, json=payload, timeout=120, **options)
+    return chat_completion_result(response)
+
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+# 这些模型有时省略开头的 <think>，正文中第一个 </think> 之前的内容都是推理
+REASONING_MODEL_MARKERS = ("deepseek-r1",)
+
+
+def is_reasoning_model(model):
+    return any(marker in (model or "").lower() for marker in REASONING_MODEL_MARKERS)
+
+
+def split_reasoning(message, model=None):
+    """(reasoning, answer) of a chat completion message; reasoning is None for non-reasoning models.
+
+    R1 models return their reasoning in reasoning_content; some deployments (and the
+    distilled models) put it in the content as a <think>...</think> block instead. Only
+    a block at the very start of the content is split off, or, for R1-family models that
+    sent no reasoning_content, everything before the first </think>. TextStream applies
+    the same rule to streamed replies.
+    """
+    reasoning = message.get("reasoning_content") or ""
+    answer = message.get("content") or ""
+    head = answer.lstrip()
+    if head.startswith(THINK_OPEN):
+        # 未闭合的 <think> 块（例如达到 max_tokens）整段算作推理
+        inline, _, answer = head[len(THINK_OPEN):].partition(THINK_CLOSE)
+        reasoning += inline
+    elif not reasoning and is_reasoning_model(model) and THINK_CLOSE in answer:
+        reasoning, answer = answer.split(THINK_CLOSE, 1)
+    return reasoning.strip() or None, answer.strip()
+
+
+def chat_completion_result(response):
+    """(text, usage, latency_s) of a non-streaming chat completion response; raises on HTTP errors.
+
+    text is the answer only; reasoning is dropped (see split_reasoning()).
+    """
+    response.raise_for_status()
+    latency = response.elapsed.total_seconds()
+    response_data = response.json()
+    choices = response_data.get("choices") or []
+    text = split_reasoning(choices[0].get("message") or {}, response_data.get("model"))[1] if choices else None
+    if not text:
+        raise ValueError("empty response from AI")
+    usage = response_data.get("usage") or {}
+    return text.strip(), usage, latency
+
+
+_in_flight = {}                     # {请求键: Future}，正在进行中的合并请求
+_in_flight_lock = threading.Lock()
+
+
+def _request_key(url, payload):
+    return url + "\0" + json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+
+def post_coalesced(url, on_coalesced=None, **kwargs):
+    """post_with_retry() where concurrent identical requests (same url and JSON body) share one upstream call.
+
+    The first caller sends the request; callers arriving while it is in flight wait
+    for it and get the same (fully read) response or exception. on_coalesced() is called
+    for those followers, so usage is only counted for the caller that made the request.
+    """
+    key = _request_key(url, kwargs.get("json"))
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _in_flight[key] = Future()
+    if not is_leader:
+        if on_coalesced:
+            on_coalesced()
+        return future.result()
+    try:
+        response = post_with_retry(url, **kwargs)
+        response.content  # 先读完响应体，所有等待者共享同一个 Response
+        future.set_result(response)
+        return response
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def _open_connection():
+    try:
+        # HEAD 根路径只为建立 TCP+TLS 连接，响应读完后连接回到池中
+        get_session().head(SILICONFLOW_BASE_URL, timeout=PREWARM_TIMEOUT_S).close()
+    except (requests.exceptions.RequestException, KeyError):
+        pass
+
+
+def prewarm(connections=PREWARM_CONNECTIONS):
+    """Open keep-alive connections in the background so the first API call skips the handshake."""
+    for _ in range(connections):
+        threading.Thread(target=_open_connection, name="api-prewarm", daemon=True).start()
+
+
+def stream_chat_completion(url, payload, timeout=120, **admission_options):
+    """POST a chat completion with "stream": true and yield each choice's delta dict as it arrives.
+
+    The SSE body is a sequence of "data: {json}" lines ending with "data: [DONE]"; an
+    event's usage block, if any, is passed on as the delta's "usage" key.
+    admission_options (priority, on_wait) go to post_with_retry().
+    HTTP errors raise before the first delta; a dropped connection raises
+    requests.exceptions.RequestException from the generator.
+    """
+    with post_with_retry(url, json=dict(payload, stream=True), stream=True, timeout=timeout,
+                         **admission_options) as response:
+        response.raise_for_status()
+        # 按字节读取再以 UTF-8 解码：text/event-stream 通常不带 charset，requests 会误判为 ISO-8859-1
+        for line in response.iter_lines():
+            delta = _parse_sse_line(line)
+            if delta is _SSE_DONE:
+                return
+            if delta is not None:
+                yield delta
+        raise requests.exceptions.ChunkedEncodingError("stream closed before [DONE]")
+
+
+_SSE_DONE = object()
+
+
+def _parse_sse_line(line):
+    """The delta dict carried by one SSE line (bytes), None for lines without one, or _SSE_DONE."""
+    if not line.startswith(b"data:"):
+        return None  # 空行分隔事件；": keep-alive" 之类的注释行忽略
+    data = line[len(b"data:"):].decode("utf-8").strip()
+    if data == "[DONE]":
+        return _SSE_DONE
+    try:
+        event = json.loads(data)
+    except ValueError:
+        # 连接在事件中途断开时最后一行是不完整的 JSON
+        raise requests.exceptions.ChunkedEncodingError(f"truncated SSE event: {data[:80]}")
+    choices = event.get("choices") or []
+    delta = choices[0].get("delta") if choices else None
+    if event.get("usage"):
+        # 累计 usage 随事件下发（通常在最后一个事件里），附在 delta 上传给调用方
+        return dict(delta or {}, usage=event["usage"])
+    return delta or None
+
+
+class TextStream:
+    """Iterate the answer pieces of streamed deltas, keeping the full text for history and persistence.
+
+    Reasoning (reasoning_content deltas, or inline <think> content as in split_reasoning()
+    for the given model) is not yielded; it is collected in self.reasoning and each piece
+    is passed to on_reasoning. A reasoning model's reply without <think> is yielded as it
+    arrives; if a </think> shows up later, the text yielded so far is moved to the reasoning
+    and an empty piece is yielded, so consumers should render self.text rather than
+    concatenating pieces. Errors before the first piece propagate to the caller; if
+    the connection drops mid-stream, iteration just stops and the error is kept in self.error.
+    """
+
+    def __init__(self, deltas, on_reasoning=None, model=None):
+        self._deltas = deltas
+        self._on_reasoning = on_reasoning
+        self._implicit_think = is_reasoning_model(model)
+        self.parts = []
+        self.reasoning_parts = []
+        self.error = None
+        self.usage = None           # 流中最后一次出现的 usage
+        # 正文开头是否是 <think> 块："start" 未确定，"think" 块内，"answer" 正文，
+        # "implicit" 为省略了 <think> 的 R1 回复：先当作正文输出，出现 </think> 时再把已输出的部分移到推理
+        self._think_state = "start"
+        self._held = ""             # 可能是被拆开的 <think>/</think> 标签的片段，暂不输出
+        self._moved = False         # 刚把已输出的正文移到了推理，需要通知调用方重绘
+
+    def __iter__(self):
+        try:
+            for delta in self._deltas:
+                if delta.get("usage"):
+                    self.usage = delta["usage"]
+                self._add_reasoning(delta.get("reasoning_content"))
+                content = delta.get("content")
+                if content:
+                    reasoning, content = self._split_think(content)
+                    self._add_reasoning(reasoning)
+                if content:
+                    self.parts.append(content)
+                if content or self._moved:
+                    self._moved = False
+                    yield content or ""
+        except requests.exceptions.RequestException as e:
+            if not self.parts:
+                raise
+            self.error = e
+        # 流结束：未闭合的 <think> 块算作推理；没有 </think> 的 R1 回复和未确定的开头算作正文
+        held, self._held = self._held, ""
+        if self._think_state == "think":
+            self._add_reasoning(held)
+            return
+        held = held if self.parts else held.lstrip()
+        if held:
+            self.parts.append(held)
+            yield held
+
+    def _add_reasoning(self, piece):
+        if piece:
+            self.reasoning_parts.append(piece)
+            if self._on_reasoning is not None:
+                self._on_reasoning(piece)
+
+    def _split_think(self, content):
+        """(reasoning, answer) parts of a content piece, following an inline <think> block at the start."""
+        if self._think_state == "start":
+            head = (self._held + content).lstrip()
+            if len(head) < len(THINK_OPEN) and THINK_OPEN.startswith(head):
+                self._held += content
+                return "", ""
+            self._held = ""
+            if head.startswith(THINK_OPEN):
+                self._think_state = "think"
+                content = head[len(THINK_OPEN):]
+            elif self._implicit_think and not self.reasoning_parts:
+                self._think_state = "implicit"
+                content = head
+            else:
+                self._think_state = "answer"
+                return "", head
+        if self._think_state == "answer":
+            return "", content if self.parts else content.lstrip()
+        text = self._held + content
+        end = text.find(THINK_CLOSE)
+        if end >= 0:
+            self._held = ""
+            if self._think_state == "implicit" and self.parts:
+                # 已经当作正文输出的内容其实是推理
+                moved, self.parts = "".join(self.parts), []
+                self._add_reasoning(moved)
+                self._moved = True
+            self._think_state = "answer"
+            return text[:end], text[end + len(THINK_CLOSE):].lstrip()
+        # 末尾可能是 </think> 的前半段，留到下一个片段再判断
+        keep = next((n for n in range(len(THINK_CLOSE) - 1, 0, -1) if text.endswith(THINK_CLOSE[:n])), 0)
+        self._held = text[len(text) - keep:]
+        piece = text[:len(text) - keep]
+        if self._think_state == "implicit":
+            return "", piece if self.parts else piece.lstrip()
+        return piece, ""
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def reasoning(self):
+        return "".join(self.reasoning_parts).strip() or None
@@ -0,0 +1,30 @@
+# archive_chats.py
+import sys
+
+import database as db
+
+
+def archive_chats(older_than_days=db.ARCHIVE_AFTER_DAYS, vacuum=False):
+    """Archive old chat sessions, apply per-user retention policies and optionally reclaim file space."""
+    print(f"Archiving chat sessions older than {older_than_days} days in {db.DATABASE_NAME} ...")
+    archived = db.archive_old_sessions(older_than_days)
+    print(f"Archived {archived} sessions ({'zstd' if db.zstandard else 'zlib'}).")
+
+    purged = db.purge_expired_chats()
+    print(f"Purged {purged} sessions past their retention policy.")
+
+    if vacuum:
+        # 删除行只会把页放回空闲列表，VACUUM 才会真正缩小数据库文件
+        print("Running VACUUM ...")
+        conn = db.create_connection()
+        try:
+            conn.execute("VACUUM;")
+        finally:
+            conn.close()
+        print("Done.")
+
+
+if __name__ == "__main__":
+    # 用法：python archive_chats.py [天数] [--vacuum]
+    args = [arg for arg in sys.argv[1:] if arg != "--vacuum"]
+    archive_chats(int(args[0]) if args else db.ARCHIVE_AFTER_DAYS, vacuum="--vacuum" in sys.argv[1:])
@@ -0,0 +1,377 @@
+# async_client.py
+"""
+基于 asyncio 的 API 客户端层，LLM、VLM、MCP 和图片页面共用。
+
+进程内只有一个后台事件循环线程和一个 aiohttp.ClientSession：在途请求是事件循环里的
+协程而不是各占一个线程，几百个挂起的请求（如 180 秒的图片生成）只需要一个线程和
+连接池里的 socket。*_async 协程可被其它协程直接 await（例如同时向多个模型提问）；
+同名的同步函数是给 Streamlit 脚本线程用的外观，把协程提交到事件循环后等待结果，
+on_wait 回调会被转回调用线程执行，脚本被中止时在途请求随之取消。
+
+重试、Retry-After、admission 准入、对冲和请求合并的行为与 api_client 相同；返回的
+Response 提供页面用到的 requests.Response 接口，错误映射为 requests 的异常类型，
+页面原有的异常处理不用改。aiohttp 为可选依赖：未安装或设置 API_ASYNC=0 时，
+同步函数直接使用 api_client 中基于线程的实现。
+"""
+import asyncio
+import atexit
+import datetime
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import admission
+import api_client
+
+try:  # aiohttp 为可选依赖
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+ENABLED = aiohttp is not None and os.environ.get("API_ASYNC", "1") != "0"
+MAX_CONNECTIONS = int(os.environ.get("API_ASYNC_MAX_CONNECTIONS", "256"))
+RELAY_POLL_INTERVAL_S = 0.1         # 同步外观转发 on_wait 回调的间隔
+
+_loop = None
+_loop_lock = threading.Lock()
+_session = None                     # aiohttp.ClientSession，只在事件循环线程内创建和使用
+_in_flight = {}                     # {请求键: Task}，正在进行中的合并请求（只在事件循环线程内访问）
+_fallback_executor = None
+
+
+class Response:
+    """The parts of requests.Response the pages use, filled from a fully read aiohttp response."""
+
+    def __init__(self, url, status_code, headers, content, elapsed_s):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.elapsed = datetime.timedelta(seconds=elapsed_s)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        try:
+            return json.loads(self.content)
+        except json.JSONDecodeError as e:
+            # 与 requests 一致：页面捕获的是 requests.exceptions.JSONDecodeError
+            raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos) from e
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        pass  # 响应体已读完，连接早已回到连接池
+
+
+def _get_loop():
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="api-event-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+            headers={
+                "Authorization": f"Bearer {os.environ['API_KEY']}",
+                "Content-Type": "application/json",
+            })
+    return _session
+
+
+@atexit.register
+def _close_session():
+    if _session is not None and _loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=5)
+        except Exception:
+            pass
+
+
+def _client_timeout(timeout):
+    # 与 requests 的 timeout 含义一致：连接和每次读取的超时，不限制总时长（流式回复可能很长）
+    return aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+
+def _translate_error(e):
+    # 区分连接超时和读取超时：只有前者会被重试（见 api_client.post_with_retry）
+    if isinstance(e, getattr(aiohttp, "ConnectionTimeoutError", ())):
+        return requests.exceptions.ConnectTimeout(str(e) or "connection timed out")
+    if isinstance(e, asyncio.TimeoutError):
+        return requests.exceptions.ReadTimeout(str(e) or "request timed out")
+    if isinstance(e, aiohttp.ClientPayloadError):
+        return requests.exceptions.ChunkedEncodingError(str(e))
+    if isinstance(e, aiohttp.ClientConnectionError):
+        return requests.exceptions.ConnectionError(str(e))
+    return requests.exceptions.RequestException(str(e))
+
+
+async def _attempt(url, payload, timeout, stream):
+    """One POST. Returns a Response, or the open aiohttp response for a successful stream."""
+    start = time.monotonic()
+    try:
+        response = await _get_session().post(url, json=payload, timeout=_client_timeout(timeout))
+        if stream and response.status < 400:
+            return response
+        try:
+            content = await response.read()
+        finally:
+            response.release()
+        return Response(url, response.status, response.headers, content, time.monotonic() - start)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise _translate_error(e) from e
+
+
+async def _post_with_retry(url, payload, timeout, max_retries, priority, on_wait, stream=False):
+    bucket = api_client._admission_bucket(url, payload)
+    for attempt in range(max_retries + 1):
+        await admission.acquire_async(bucket, priority, on_wait)
+        try:
+            response = await _attempt(url, payload, timeout, stream)
+        except requests.exceptions.ConnectionError:  # 与 api_client 相同，读取超时不重试
+            if attempt >= max_retries:
+                raise
+            await asyncio.sleep(random.uniform(0, api_client.RETRY_BASE_DELAY_S * (2 ** attempt)))
+            continue
+        if not isinstance(response, Response):
+            return response
+        if response.status_code not in api_client.RETRY_STATUSES or attempt >= max_retries:
+            return response
+        delay = api_client._retry_after_s(response)
+        if delay is None:
+            delay = random.uniform(0, api_client.RETRY_BASE_DELAY_S * (2 ** attempt))
+        elif delay > api_client.RETRY_MAX_DELAY_S:
+            return response
+        await asyncio.sleep(delay)
+
+
+async def post_with_retry_async(url, json=None, timeout=None, max_retries=api_client.MAX_RETRIES,
+                                priority=admission.PRIORITY_INTERACTIVE, on_wait=None):
+    """Coroutine version of api_client.post_with_retry(); returns a Response."""
+    return await _post_with_retry(url, json, timeout, max_retries, priority, on_wait)
+
+
+async def _timed_post(key, url, kwargs):
+    start = time.monotonic()
+    response = await post_with_retry_async(url, **kwargs)
+    if response.ok:
+        api_client._record_latency(key, time.monotonic() - start)
+    return response
+
+
+async def post_hedged_async(url, hedge_key, **kwargs):
+    """Coroutine version of api_client.post_hedged(); the losing request is cancelled."""
+    delay = api_client._hedge_delay_s(hedge_key) if api_client.HEDGE_ENABLED else None
+    primary = asyncio.ensure_future(_timed_post(hedge_key, url, kwargs))
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+    # 对冲请求以低优先级排队，不挤占交互请求，也不再通知页面排队状态
+    hedge_kwargs = dict(kwargs, priority=admission.PRIORITY_BULK, on_wait=None)
+    pending = {primary, asyncio.ensure_future(_timed_post(hedge_key, url, hedge_kwargs))}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None and task.result().ok:
+                for other in pending:
+                    other.cancel()
+                return task.result()
+    # 两个请求都失败：以原请求的结果为准
+    return primary.result()
+
+
+async def post_coalesced_async(url, on_coalesced=None, **kwargs):
+    """Coroutine version of api_client.post_coalesced(); callers share one Task per identical request."""
+    key = api_client._request_key(url, kwargs.get("json"))
+    task = _in_flight.get(key)
+    if task is None:
+        task = _in_flight[key] = asyncio.ensure_future(post_with_retry_async(url, **kwargs))
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    elif on_coalesced:
+        on_coalesced()
+    # shield：一个等待者被取消不影响其它等待者
+    return await asyncio.shield(task)
+
+
+async def request_chat_completion_async(payload, **options):
+    """Coroutine version of api_client.request_chat_completion(); returns (text, usage, latency_s)."""
+    response = await post_with_retry_async(api_client.CHAT_COMPLETIONS_URL, json=payload, timeout=120, **options)
+    return api_client.chat_completion_result(response)
+
+
+async def stream_chat_completion_async(url, payload, timeout=120, max_retries=api_client.MAX_RETRIES,
+                                       priority=admission.PRIORITY_INTERACTIVE, on_wait=None):
+    """Async generator version of api_client.stream_chat_completion(); yields delta dicts."""
+    response = await _post_with_retry(url, dict(payload, stream=True), timeout, max_retries, priority, on_wait,
+                                      stream=True)
+    if isinstance(response, Response):
+        response.raise_for_status()  # 流式请求成功时返回的是未读取的 aiohttp 响应
+    try:
+        async for line in response.content:
+            delta = api_client._parse_sse_line(line.rstrip(b"\r\n"))
+            if delta is api_client._SSE_DONE:
+                return
+            if delta is not None:
+                yield delta
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise _translate_error(e) from e
+    finally:
+        response.release()
+    raise requests.exceptions.ChunkedEncodingError("stream closed before [DONE]")
+
+
+async def _prewarm_async(connections):
+    session = _get_session()
+
+    async def open_connection():
+        try:
+            async with session.head(api_client.SILICONFLOW_BASE_URL,
+                                    timeout=aiohttp.ClientTimeout(total=api_client.PREWARM_TIMEOUT_S)):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
+
+
+# ---- 同步外观：在 Streamlit 脚本线程中调用 ----
+
+class _WaitRelay:
+    """Carries on_wait(position, wait_s) calls from the event loop back to the calling thread,
+    where Streamlit elements may be updated."""
+
+    def __init__(self, on_wait):
+        self.on_wait = on_wait
+        self.events = queue.SimpleQueue()
+
+    def __call__(self, position, wait_s):
+        self.events.put((position, wait_s))
+
+    def drain(self):
+        while not self.events.empty():
+            self.on_wait(*self.events.get())
+
+
+def _run(coro_fn, *args, on_wait=None, **kwargs):
+    """Run coro_fn(*args, **kwargs) on the shared loop and block until it finishes."""
+    relay = _WaitRelay(on_wait) if on_wait is not None else None
+    future = asyncio.run_coroutine_threadsafe(coro_fn(*args, on_wait=relay, **kwargs), _get_loop())
+    try:
+        if relay is not None:
+            while not wait([future], timeout=RELAY_POLL_INTERVAL_S).done:
+                relay.drain()
+            relay.drain()
+        return future.result()
+    except BaseException:
+        # 包括 Streamlit 中止脚本时抛出的异常：取消事件循环里的请求
+        future.cancel()
+        raise
+
+
+def post_with_retry(url, on_wait=None, **kwargs):
+    """Blocking facade over post_with_retry_async()."""
+    if not ENABLED:
+        return api_client.post_with_retry(url, on_wait=on_wait, **kwargs)
+    return _run(post_with_retry_async, url, on_wait=on_wait, **kwargs)
+
+
+def post_hedged(url, hedge_key, on_wait=None, **kwargs):
+    """Blocking facade over post_hedged_async()."""
+    if not ENABLED:
+        return api_client.post_hedged(url, hedge_key, on_wait=on_wait, **kwargs)
+    return _run(post_hedged_async, url, hedge_key, on_wait=on_wait, **kwargs)
+
+
+def post_coalesced(url, on_wait=None, **kwargs):
+    """Blocking facade over post_coalesced_async()."""
+    if not ENABLED:
+        return api_client.post_coalesced(url, on_wait=on_wait, **kwargs)
+    return _run(post_coalesced_async, url, on_wait=on_wait, **kwargs)
+
+
+def submit_chat_completion(payload, **options):
+    """Start request_chat_completion_async() and return a concurrent.futures.Future of (text, usage, latency_s)."""
+    global _fallback_executor
+    if ENABLED:
+        return asyncio.run_coroutine_threadsafe(request_chat_completion_async(payload, **options), _get_loop())
+    if _fallback_executor is None:
+        with _loop_lock:
+            if _fallback_executor is None:
+                _fallback_executor = ThreadPoolExecutor(max_workers=api_client.POOL_MAXSIZE,
+                                                        thread_name_prefix="api-request")
+    return _fallback_executor.submit(api_client.request_chat_completion, payload, **options)
+
+
+_DELTA, _WAIT, _ERROR, _END = range(4)
+
+
+def stream_chat_completion(url, payload, timeout=120, on_wait=None, **admission_options):
+    """Blocking generator facade over stream_chat_completion_async(); yields delta dicts."""
+    if not ENABLED:
+        yield from api_client.stream_chat_completion(url, payload, timeout, on_wait=on_wait, **admission_options)
+        return
+    items = queue.SimpleQueue()
+
+    def relay_wait(position, wait_s):
+        # on_wait 在事件循环线程里被调用，转交给调用方线程执行（st.* 只能在脚本线程里用）
+        items.put((_WAIT, (position, wait_s)))
+
+    async def pump():
+        try:
+            async for delta in stream_chat_completion_async(url, payload, timeout,
+                                                            on_wait=relay_wait if on_wait is not None else None,
+                                                            **admission_options):
+                items.put((_DELTA, delta))
+        except Exception as e:
+            items.put((_ERROR, e))
+        else:
+            items.put((_END, None))
+
+    future = asyncio.run_coroutine_threadsafe(pump(), _get_loop())
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == _DELTA:
+                yield value
+            elif kind == _WAIT:
+                on_wait(*value)
+            elif kind == _ERROR:
+                raise value
+            else:
+                return
+    finally:
+        # 调用方提前停止读取（页面中止、生成器被关闭）时取消上游请求
+        future.cancel()
+
+
+def prewarm(connections=api_client.PREWARM_CONNECTIONS):
+    """Open keep-alive connections in the background so the first API call skips the handshake."""
+    if not ENABLED:
+        api_client.prewarm(connections)
+        return
+    asyncio.run_coroutine_threadsafe(_prewarm_async(connections), _get_loop())
@@ -1,5 +1,6 @@
 import streamlit as st
 import database as db # Import the new database module
+import async_client
 """admin  456"""
 def show_layout_and_hide_sidebar():
     """Applies fullscreen layout and hides sidebar using CSS."""
@@ -48,12 +49,13 @@ def show_login_page():
             login_submitted = st.form_submit_button("Login")
 
             if login_submitted:
-                user = db.get_user_by_username(login_username)
+                user = db.get_user_by_username(login_username, use_cache=False)  # 校验密码时总是读最新数据
                 if user and user['password'] == login_password: # In a real app, use hashed passwords!
                     st.session_state.authenticated = True
                     st.session_state.current_page = "home" # Go to home after login
                     st.session_state.user_id = user['id'] # Store user ID in session
                     st.session_state.username = user['username'] # Store username in session
+                    async_client.prewarm() # 后台预先建立到 API 的连接
                     st.success("Login successful!")
                     st.rerun()
                 else:
@@ -98,6 +100,7 @@ def show_create_user_page():
                         if user:
                             st.session_state.user_id = user['id']
                             st.session_state.username = user['username']
+                        async_client.prewarm()
                         st.session_state.current_page = "home" # Go to home after creation
                         st.rerun()
                     elif result == "username_exists":
@@ -0,0 +1,16 @@
+# backfill_fts.py
+import database as db
+
+
+def backfill_fts():
+    """One-time backfill of the chat full-text index for databases created before it existed."""
+    print(f"Rebuilding full-text index '{db.CHAT_FTS_TABLE}' in {db.DATABASE_NAME} ...")
+    indexed = db.rebuild_chat_fts()
+    if indexed is None:
+        print("Failed to rebuild the full-text index.")
+    else:
+        print(f"Indexed {indexed} chat messages.")
+
+
+if __name__ == "__main__":
+    backfill_fts()
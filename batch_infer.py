@@ -0,0 +1,164 @@
+# batch_infer.py
+"""
+离线批量推理：读取 JSONL 提示文件，以有限并发调用聊天模型，结果逐行写入输出 JSONL。
+
+输入每行一个 JSON 对象：{"id": ..., "prompt": ..., 可选 "system", "history", "model", "max_tokens", "top_p"}，
+没有 id 时用行号。输出每行包含 id、model、response（或 error）、latency_s 和 usage。
+输出文件同时是检查点：重新运行时跳过已成功的 id，只处理剩余和失败的行（同一 id 以最后一行为准）。
+请求走 api_client（重试、admission 全局限流，优先级为批量任务），--rps 可再加一层本地限速。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import admission
+import api_client
+
+DEFAULT_MODEL = "deepseek-ai/DeepSeek-V3"
+DEFAULT_MAX_TOKENS = 1024
+DEFAULT_TOP_P = 0.7
+DEFAULT_CONCURRENCY = 8
+
+
+class RateLimiter:
+    """Space calls at least 1/rps seconds apart across threads."""
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps if rps else 0.0
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_at)
+            self._next_at = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def _read_prompts(path):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            row.setdefault("id", line_no)
+            yield row
+
+
+def _completed_ids(path):
+    """Ids whose last output line succeeded."""
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # 上次中断时写了一半的行
+                done[row["id"]] = "error" not in row
+    return {row_id for row_id, ok in done.items() if ok}
+
+
+def _run_one(row, args, limiter):
+    model = row.get("model", args.model)
+    payload = api_client.build_chat_payload(
+        row["prompt"], row.get("system", args.system), row.get("history", []), model,
+        row.get("max_tokens", args.max_tokens), row.get("top_p", args.top_p))
+    limiter.wait()
+    result = {"id": row["id"], "model": model}
+    try:
+        text, usage, latency = api_client.request_chat_completion(payload, priority=admission.PRIORITY_BULK)
+        result.update(response=text, latency_s=round(latency, 3), usage=usage)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run(args):
+    done_ids = _completed_ids(args.output)
+    limiter = RateLimiter(args.rps)
+    stats = {"ok": 0, "failed": 0, "skipped": 0, "completion_tokens": 0}
+    latencies = []
+    start = time.monotonic()
+    prompts = _read_prompts(args.input)
+    pending = set()
+    interrupted = False
+
+    with open(args.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        def write_finished(futures):
+            for future in futures:
+                result = future.result()
+                # 每行写完立即 flush，中断后重跑可从这里继续
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                if "error" in result:
+                    stats["failed"] += 1
+                else:
+                    stats["ok"] += 1
+                    latencies.append(result["latency_s"])
+                    stats["completion_tokens"] += result["usage"].get("completion_tokens", 0)
+
+        try:
+            for row in prompts:
+                if row["id"] in done_ids:
+                    stats["skipped"] += 1
+                    continue
+                # 在途任务不超过并发数的两倍，避免把整个输入文件读进内存
+                while len(pending) >= args.concurrency * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write_finished(finished)
+                pending.add(executor.submit(_run_one, row, args, limiter))
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_finished(finished)
+        except KeyboardInterrupt:
+            interrupted = True
+            for future in pending:
+                future.cancel()
+            print("\nInterrupted; waiting for requests already sent ...", file=sys.stderr)
+            write_finished([future for future in pending if not future.cancelled()])
+
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    processed = stats["ok"] + stats["failed"]
+    print(f"{'Interrupted' if interrupted else 'Done'}: {stats['ok']} ok, {stats['failed']} failed, "
+          f"{stats['skipped']} skipped (already done) in {elapsed:.1f}s")
+    if processed:
+        print(f"Throughput: {processed / elapsed:.2f} rows/s, "
+              f"{stats['completion_tokens'] / elapsed:.1f} completion tokens/s")
+    if latencies:
+        print(f"Latency: p50 {_percentile(latencies, 0.50):.2f}s, p95 {_percentile(latencies, 0.95):.2f}s, "
+              f"max {latencies[-1]:.2f}s")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through a chat model.")
+    parser.add_argument("input", help="input JSONL, one {\"prompt\": ...} object per line")
+    parser.add_argument("output", help="output JSONL; also the checkpoint for resuming")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"model id (default {DEFAULT_MODEL})")
+    parser.add_argument("--system", default="", help="system prompt for rows without their own")
+    parser.add_argument("--max-tokens", type=int, default=DEFAULT_MAX_TOKENS)
+    parser.add_argument("--top-p", type=float, default=DEFAULT_TOP_P)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rps", type=float, default=0, help="local request-rate cap (0 = admission limits only)")
+    run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# bench_database.py
+"""
+Micro-benchmark for the database layer.
+
+Runs against a throw-away copy of the database (never the live ai_app.db) and
+prints per-call latency for a fresh sqlite3.connect() per call versus the pooled
+connections returned by database.create_connection(), first on one thread and then
+with every call on a new thread (as Streamlit reruns and fan_out workers do).
+
+用法：python bench_database.py [调用次数]
+"""
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import database as db
+
+
+def _time_calls(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def _time_calls_on_new_threads(fn, iterations):
+    samples = []
+
+    def timed():
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    for _ in range(iterations):
+        thread = threading.Thread(target=timed)
+        thread.start()
+        thread.join()
+    return samples
+
+
+def _report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<28} mean {statistics.mean(samples):8.1f} us   "
+          f"p50 {statistics.median(samples):8.1f} us   p95 {p95:8.1f} us")
+
+
+def run(iterations=2000):
+    workdir = tempfile.mkdtemp(prefix="bench_db_")
+    bench_db = os.path.join(workdir, "bench.db")
+    if os.path.exists(db.DATABASE_NAME):
+        shutil.copy(db.DATABASE_NAME, bench_db)
+    db.DATABASE_NAME = bench_db
+    db.create_tables()
+    db.add_user("bench_user", "bench@example.com", "bench")
+
+    def unpooled_lookup():
+        # 旧实现：每次调用都新建连接
+        conn = sqlite3.connect(bench_db)
+        try:
+            conn.execute('SELECT id, username, email, password FROM users WHERE username = ?',
+                         ("bench_user",)).fetchone()
+        finally:
+            conn.close()
+
+    def pooled_lookup():
+        db.get_user_by_username("bench_user", use_cache=False)
+
+    print(f"{iterations} calls of get_user_by_username against {bench_db}")
+    _report("before (connect per call)", _time_calls(unpooled_lookup, iterations))
+    _report("after (pooled, WAL)", _time_calls(pooled_lookup, iterations))
+    print("each call on a new thread:")
+    _report("before (connect per call)", _time_calls_on_new_threads(unpooled_lookup, iterations))
+    _report("after (pooled, WAL)", _time_calls_on_new_threads(pooled_lookup, iterations))
+
+    db.close_all_connections()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -10,7 +10,7 @@ if "authenticated" not in st.session_state or not st.session_state.authenticated
     st.stop()
 
 current_username = st.session_state.get('username')
-current_user = database.get_user_by_username(current_username)
+current_user = database.get_user_by_id(st.session_state.get('user_id'))  # 走用户缓存，通常不访问数据库
 current_user_id = current_user['id'] if current_user else None
 
 if not current_user_id:
@@ -19,6 +19,9 @@ if not current_user_id:
 
 is_admin = (current_username == "admin")
 
+# 管理员用户列表每页显示的用户数
+ADMIN_USER_PAGE_SIZE = 50
+
 st.info(f"当前用户: **{current_username}** {'(管理员)' if is_admin else '(普通用户)'}")
 
 # --- Common Password Change Logic ---
@@ -48,12 +51,25 @@ def password_change_form(target_user_id, target_username, form_title="修改密
 if is_admin:
     st.header("管理员操作")
 
-    # Display all users for selection
-    all_users = database.get_all_users()
+    # Display one keyset page of users for selection（游标栈，栈顶为当前页起始游标）
+    if "admin_user_page_cursors" not in st.session_state:
+        st.session_state.admin_user_page_cursors = [None]
+    page_cursors = st.session_state.admin_user_page_cursors
+    page_users, next_cursor = database.get_users_page(page_cursors[-1], ADMIN_USER_PAGE_SIZE)
     # Exclude admin from modification/deletion in the admin UI itself
     # If 'admin' user is chosen, it means admin wants to modify their own account,
     # which is handled in the 'My Account Management' section below.
-    user_options = {f"{user['username']} (ID: {user['id']})": user['id'] for user in all_users if user['username'] != "admin"}
+    user_options = {f"{user['username']} (ID: {user['id']})": user['id'] for user in page_users if user['username'] != "admin"}
+
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if st.button("上一页用户", disabled=len(page_cursors) <= 1, use_container_width=True, key="admin_users_prev_page"):
+            page_cursors.pop()
+            st.rerun()
+    with next_col:
+        if st.button("下一页用户", disabled=next_cursor is None, use_container_width=True, key="admin_users_next_page"):
+            page_cursors.append(next_cursor)
+            st.rerun()
 
     if not user_options:
         st.info("没有其他用户可供管理。")
@@ -0,0 +1,64 @@
+# context_window.py
+"""
+对话上下文窗口管理：估算每条消息的 token 数，并把历史裁剪到模型的预算之内。
+
+估算是启发式的（中日韩字符约 1 token/字，其余约 4 字符/token，另加每条消息的
+格式开销），结果缓存在消息 dict 的 "tokens" 字段里，每条消息只计算一次。
+预算 = min(模型上下文长度 - max_tokens - 本轮固定内容 - 余量, 模型上下文长度 × HISTORY_CONTEXT_FRACTION)，
+上限按模型的上下文长度折算（32K 的模型 8K、64K 的模型 16K），保证长对话每轮请求的大小
+基本恒定。超出预算时从最早的消息开始丢弃，
+被丢弃的部分可由调用方用滚动摘要代替。
+"""
+import math
+import re
+
+DEFAULT_CONTEXT_TOKENS = 32 * 1024
+HISTORY_CONTEXT_FRACTION = 0.25     # 每轮随请求发送的历史最多占模型上下文长度的比例
+SAFETY_MARGIN_TOKENS = 256          # 估算误差的余量
+MESSAGE_OVERHEAD_TOKENS = 4         # 每条消息的角色、分隔符等格式开销
+
+_CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """Rough token count of a string."""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(message):
+    """Token estimate of a {"role", "content"} message, cached on the message itself."""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = message["tokens"] = estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+def history_budget(context_tokens, max_tokens, *fixed_texts, reserved_tokens=0):
+    """Tokens left for conversation history after the reply, the fixed texts (system prompt,
+    current input) and reserved_tokens (e.g. a summary) are accounted for, capped at
+    HISTORY_CONTEXT_FRACTION of the model's context."""
+    fixed = sum(estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS for text in fixed_texts if text)
+    available = context_tokens - max_tokens - fixed - reserved_tokens - SAFETY_MARGIN_TOKENS
+    cap = int(context_tokens * HISTORY_CONTEXT_FRACTION)
+    return max(0, min(available, cap - reserved_tokens))
+
+
+def fit_history(messages, budget_tokens):
+    """Return (dropped_count, kept_messages): the newest messages that fit in budget_tokens.
+
+    The kept part never starts with an assistant message, so the model always
+    sees whole user/assistant turns.
+    """
+    total = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        total += message_tokens(messages[i])
+        if total > budget_tokens:
+            break
+        start = i
+    while start < len(messages) and messages[start]["role"] != "user":
+        start += 1
+    return start, list(messages[start:])
@@ -10,7 +10,7 @@ def create_default_user():
 
     print(f"Attempting to create user: {username}")
 
-    # Ensure tables are created (this is already called when database.py is imported, but safe to call again)
+    # Ensure the schema is up to date (migrations also run on the first connection, so this is safe to call again)
     db.create_tables()
 
     # Check if the user already exists
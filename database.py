@@ -1,5 +1,19 @@
 import sqlite3
 import os
+import copy
+import datetime
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import write_behind
+import query_trace
+
+try:  # zstd 为可选依赖：安装了 zstandard 时归档使用 zstd，否则使用标准库 zlib
+    import zstandard
+except ImportError:
+    zstandard = None
 """
 users (1) —— (∞) chat_sessions —— (∞) chat_messages
    |
@@ -8,79 +22,705 @@ users (1) —— (∞) chat_sessions —— (∞) chat_messages
 users:id,username,email,password
       索引idx_username,idx_email：提升查询速度
 chat_sessions:session_id,user_id,model_name,started_at
-chat_messages:message_id,session_id,role,content,created_at
+chat_messages:message_id,session_id,role,content,reasoning,created_at
+      reasoning：R1 等推理模型的思考过程，与回复正文分开存放，不随历史重新发送
+      chat_messages_fts：content 的 FTS5 全文索引，由触发器同步
 game_high_scores:score_id,user_id,game_name,score,played_at
+game_leaderboard:game_name,user_id,best_score,played_at（每人每游戏最好成绩，由触发器维护）
+chat_archive:session_id,codec,message_count,payload,archived_at（旧会话消息的压缩归档）
+      chat_archive_fts：归档正文的无内容（contentless）FTS5 索引，rowid 为 session_id，归档时写入
+chat_retention_policies:user_id,retain_days
+api_call_metrics:metric_id,user_id,session_id,page,model_name,status,prompt_tokens,completion_tokens,latency_ms,first_token_ms,params,day
+      每次模型调用的用量与延迟，session_id 关联 chat_sessions；api_usage_daily 为按 (用户, 日期, 模型) 的汇总（由触发器维护）
+user_quotas:user_id,daily_tokens,daily_requests（每用户每日配额）
+
+设置 DB_TRACE=1（或调用 enable_query_tracing()）可记录每条语句的耗时并写慢查询日志，见 query_trace.py。
+表结构由下方 MIGRATIONS 按版本号维护（PRAGMA user_version），首次连接时自动升级。
+启用聊天分片（CHAT_SHARD_MODE）时，chat_sessions/chat_messages/chat_archive 存放在
+CHAT_SHARD_DIR 下的分片库中（结构见 SHARD_MIGRATIONS），其余表仍在中心库。
 
 """
 DATABASE_NAME = 'ai_app.db'
 
-def create_connection():
-    """创建并返回一个到 SQLite 数据库的连接对象。"""
-    conn = None
+# 连接参数：WAL 允许读写并发，busy_timeout 避免瞬时锁冲突直接报错
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16 * 1024          # PRAGMA cache_size 取负值表示 KiB
+MMAP_SIZE_BYTES = 64 * 1024 * 1024
+MAX_IDLE_CONNECTIONS = 16           # 每个数据库文件最多保留的空闲连接数（全进程共享）
+
+# 聊天内容全文索引（FTS5）
+CHAT_FTS_TABLE = 'chat_messages_fts'
+CHAT_ARCHIVE_FTS_TABLE = 'chat_archive_fts'
+FTS_MIN_KEYWORD_LENGTH = 3          # trigram 分词至少需要 3 个字符
+
+DEFAULT_PAGE_SIZE = 20              # 分页接口每页默认条数
+
+# 用户信息的进程内读缓存：TTL 内重复读取不访问数据库，add_user/update_user_password/delete_user 时整体失效
+USER_CACHE_TTL_S = 60
+USER_CACHE_MAX_ENTRIES = 1024       # 超过后按写入先后淘汰最旧的条目
+
+# 后台写队列：攒够 WRITE_BATCH_MAX_SIZE 个请求或等待 WRITE_BATCH_MAX_DELAY_S 秒后合并提交
+WRITE_BATCH_MAX_SIZE = 100
+WRITE_BATCH_MAX_DELAY_S = 0.05
+WRITE_MAX_RETRIES = 5
+WRITE_RETRY_BASE_DELAY_S = 0.05
+
+# 冷数据归档：早于 ARCHIVE_AFTER_DAYS 天的会话，其消息压缩成一个 blob 存入 chat_archive
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 200
+# 关键词太短无法走归档索引时，最多解压最近的这么多个归档会话
+ARCHIVE_SEARCH_SCAN_LIMIT = 200
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# 聊天记录分片（可选）：'user' 每个用户一个文件，'hash' 按 user_id 取模分到 CHAT_SHARD_BUCKETS 个文件；
+# 为空时聊天记录和其它表同在 DATABASE_NAME 中。users、排行榜和保留策略始终在中心库。
+CHAT_SHARD_MODE = os.environ.get('CHAT_SHARD_MODE', '')
+CHAT_SHARD_DIR = os.environ.get('CHAT_SHARD_DIR', 'chat_shards')
+CHAT_SHARD_BUCKETS = 16
+# 分片模式下 session_id = (分片内序号 << SHARD_KEY_BITS) | 分片键，因此可由 session_id 找到所在分片
+SHARD_KEY_BITS = 32
+FANOUT_MAX_WORKERS = 8              # 跨分片并行查询的线程数上限
+
+# LLM 回复缓存的持久层：单独的库文件，避免缓存写入与业务表争用写锁（结构见 CACHE_MIGRATIONS）
+LLM_CACHE_DATABASE = os.environ.get('LLM_CACHE_DATABASE', 'llm_cache.db')
+LLM_CACHE_EVICT_BATCH = 50
+
+# 进程内共享的连接池：{数据库路径: [空闲连接, ...]}。连接以 check_same_thread=False 打开，
+# 借出期间只由借用的线程使用、close() 时归还；Streamlit 每次 rerun 换一个脚本线程、
+# fan_out 每次新建工作线程，仍然能复用已经打开并设置好 PRAGMA 的连接
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def _reset_pool_after_fork():
+    # 子进程不能使用父进程打开的连接（见 PooledConnection.close 的 pid 检查）
+    global _pool, _pool_lock
+    _pool, _pool_lock = {}, threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+class PooledConnection(sqlite3.Connection):
+    """A sqlite3 connection whose close() hands it back to the process-wide pool."""
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        with _pool_lock:
+            pool = _pool.setdefault(self._pool_key, [])
+            if self._pool_pid == os.getpid() and len(pool) < MAX_IDLE_CONNECTIONS and self not in pool:
+                pool.append(self)
+                return
+        super().close()
+
+    def really_close(self):
+        """Close the underlying sqlite3 handle instead of pooling it."""
+        super().close()
+
+
+class TracedConnection(query_trace.TracingConnectionMixin, PooledConnection):
+    """PooledConnection whose cursors record latency, rows and calling page (see query_trace)."""
+
+
+def enable_query_tracing(enabled=True):
+    """Turn query tracing on or off; connections opened from now on use the matching class."""
+    query_trace.TRACE_ENABLED = enabled
+    close_all_connections()
+
+
+def _configure_connection(conn):
+    """Apply the per-connection PRAGMAs once, when the connection is first opened."""
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")  # WAL 模式下 NORMAL 已足够安全
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB};")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES};")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+
+
+def _open_connection(database):
+    """Return a pooled connection to database without checking the schema version."""
+    factory = TracedConnection if query_trace.TRACE_ENABLED else PooledConnection
+    conn, stale = None, []
+    with _pool_lock:
+        pool = _pool.setdefault(database, [])
+        while pool and conn is None:
+            candidate = pool.pop()
+            if type(candidate) is factory:
+                conn = candidate
+            else:
+                stale.append(candidate)  # 追踪开关切换前打开的连接
+    for candidate in stale:
+        candidate.really_close()
+    if conn is not None:
+        return conn
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        # 连接会被不同线程先后借用（同一时刻只有一个），因此关闭 sqlite3 的同线程检查
+        conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT_MS / 1000, factory=factory, check_same_thread=False)
+        conn._pool_key = database
+        conn._pool_pid = os.getpid()
+        _configure_connection(conn)
+        if factory is TracedConnection:
+            conn.install_trace_callback()
         return conn
     except sqlite3.Error as e:
         print(e)
     return conn
 
+
+def create_connection(database=None):
+    """返回一个 SQLite 连接：优先复用进程内连接池中的空闲连接，调用 close() 即归还。"""
+    database = database or DATABASE_NAME
+    if _is_chat_shard(database):
+        os.makedirs(CHAT_SHARD_DIR, exist_ok=True)
+    ensure_schema(database)
+    return _open_connection(database)
+
+
+def close_all_connections():
+    """Really close every idle connection in the process-wide pool."""
+    with _pool_lock:
+        idle = [conn for pool in _pool.values() for conn in pool]
+        _pool.clear()
+    for conn in idle:
+        conn.really_close()
+
+
+# --- Chat shard routing ---
+
+def _shard_key(user_id):
+    return user_id if CHAT_SHARD_MODE == 'user' else user_id % CHAT_SHARD_BUCKETS
+
+
+def _shard_path(shard_key):
+    name = f'user_{shard_key}.db' if CHAT_SHARD_MODE == 'user' else f'bucket_{shard_key:03d}.db'
+    return os.path.join(CHAT_SHARD_DIR, name)
+
+
+def _is_chat_shard(database):
+    return bool(CHAT_SHARD_MODE) and os.path.dirname(os.path.abspath(database)) == os.path.abspath(CHAT_SHARD_DIR)
+
+
+def chat_database_for_user(user_id):
+    """Return the database file holding user_id's chat history."""
+    if not CHAT_SHARD_MODE:
+        return DATABASE_NAME
+    return _shard_path(_shard_key(user_id))
+
+
+def chat_database_for_session(session_id):
+    """Return the database file holding a chat session."""
+    if not CHAT_SHARD_MODE:
+        return DATABASE_NAME
+    return _shard_path(session_id & ((1 << SHARD_KEY_BITS) - 1))
+
+
+def chat_databases(user_ids=None):
+    """Return the chat database files to query for user_ids, or every existing one when user_ids is None."""
+    if not CHAT_SHARD_MODE:
+        return [DATABASE_NAME]
+    if user_ids is not None:
+        return sorted({chat_database_for_user(user_id) for user_id in user_ids})
+    if not os.path.isdir(CHAT_SHARD_DIR):
+        return []
+    prefix = 'user_' if CHAT_SHARD_MODE == 'user' else 'bucket_'
+    return sorted(os.path.join(CHAT_SHARD_DIR, name) for name in os.listdir(CHAT_SHARD_DIR)
+                  if name.startswith(prefix) and name.endswith('.db'))
+
+
+def fan_out(fn, databases):
+    """Call fn(database) for every database, in parallel when there is more than one; returns the results in order."""
+    if len(databases) <= 1:
+        return [fn(database) for database in databases]
+    # 工作线程从进程内连接池借用连接，用完归还，下次 fan_out 的新线程继续复用
+    with ThreadPoolExecutor(max_workers=min(len(databases), FANOUT_MAX_WORKERS)) as executor:
+        return list(executor.map(fn, databases))
+
+
+# --- Schema migrations ---
+# 每个迁移只执行一次：数据库当前版本记录在 PRAGMA user_version 中，
+# 进程内首次连接某个数据库文件时按编号依次补齐未执行的迁移。
+
+def _migration_1_base_schema(cursor):
+    """Base schema: users, chat_sessions, chat_messages, game_high_scores."""
+    # 用户表：保存账号、邮箱、密码
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        );
+    ''')
+    # 为 username 和 email 创建唯一索引，加快查询速度
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_username ON users (username);')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_email ON users (email);')
+    # 聊天会话表：记录用户一次完整会话
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            model_name TEXT NOT NULL,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+    # 聊天消息表：保存每条聊天消息
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,          -- 'user' 或 'assistant'
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id) ON DELETE CASCADE
+        );
+    ''')
+    # 游戏成绩表：保存用户在游戏中的高分
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_high_scores (
+            score_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            game_name TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+
+
+def _migration_2_chat_fts(cursor):
+    """FTS5 index over chat_messages.content, kept in sync by triggers, backfilled once."""
+    try:
+        # 外部内容表：索引只存倒排信息，正文仍在 chat_messages 中
+        # trigram 分词支持中文子串匹配，与原 LIKE '%kw%' 语义一致
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {CHAT_FTS_TABLE} USING fts5(
+                content,
+                content='chat_messages',
+                content_rowid='message_id',
+                tokenize='trigram'
+            );
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 未编译 FTS5 时关键词搜索会退回 LIKE 扫描
+        print(f"Skipping chat full-text index: {e}")
+        return
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+            INSERT INTO {CHAT_FTS_TABLE} (rowid, content) VALUES (new.message_id, new.content);
+        END;
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+            INSERT INTO {CHAT_FTS_TABLE} ({CHAT_FTS_TABLE}, rowid, content)
+            VALUES ('delete', old.message_id, old.content);
+        END;
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF content ON chat_messages BEGIN
+            INSERT INTO {CHAT_FTS_TABLE} ({CHAT_FTS_TABLE}, rowid, content)
+            VALUES ('delete', old.message_id, old.content);
+            INSERT INTO {CHAT_FTS_TABLE} (rowid, content) VALUES (new.message_id, new.content);
+        END;
+    ''')
+    # 旧数据库里已有的消息一次性写入索引
+    cursor.execute(f"INSERT INTO {CHAT_FTS_TABLE} ({CHAT_FTS_TABLE}) VALUES ('rebuild');")
+
+
+def _migration_3_query_indexes(cursor):
+    """Indexes for the history search and leaderboard queries."""
+    _create_chat_indexes(cursor)
+    # 排行榜：某个游戏按分数倒序
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_scores_game_score ON game_high_scores (game_name, score DESC, played_at);')
+
+
+def _create_chat_indexes(cursor):
+    # 按用户查看会话（按时间倒序）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_started ON chat_sessions (user_id, started_at);')
+    # 管理员按日期查找：started_at 范围查询
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_started ON chat_sessions (started_at);')
+    # 取某个会话的全部消息（按时间顺序）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_session_created ON chat_messages (session_id, created_at);')
+
+
+def _migration_4_game_leaderboard(cursor):
+    """Materialized leaderboard: one best score per user per game, maintained by triggers."""
+    # game_high_scores 保留全部历史；game_leaderboard 只存每个用户在每个游戏的最好成绩
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_leaderboard (
+            game_name TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            best_score INTEGER NOT NULL,
+            played_at DATETIME NOT NULL,
+            PRIMARY KEY (game_name, user_id)
+        ) WITHOUT ROWID;
+    ''')
+    # 排行榜读取与名次计算都只扫描这条索引的前缀
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_leaderboard_rank ON game_leaderboard (game_name, best_score DESC, played_at);')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS game_high_scores_leaderboard_ai AFTER INSERT ON game_high_scores BEGIN
+            INSERT INTO game_leaderboard (game_name, user_id, best_score, played_at)
+            VALUES (new.game_name, new.user_id, new.score, COALESCE(new.played_at, CURRENT_TIMESTAMP))
+            ON CONFLICT (game_name, user_id) DO UPDATE SET
+                best_score = excluded.best_score,
+                played_at = excluded.played_at
+            WHERE excluded.best_score > game_leaderboard.best_score;
+        END;
+    ''')
+    # 删除历史成绩时，从剩余历史中重新计算该用户的最好成绩
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS game_high_scores_leaderboard_ad AFTER DELETE ON game_high_scores BEGIN
+            DELETE FROM game_leaderboard WHERE game_name = old.game_name AND user_id = old.user_id;
+            INSERT INTO game_leaderboard (game_name, user_id, best_score, played_at)
+            SELECT game_name, user_id, MAX(score), played_at
+            FROM game_high_scores
+            WHERE game_name = old.game_name AND user_id = old.user_id
+            GROUP BY game_name, user_id;
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_leaderboard_ad AFTER DELETE ON users BEGIN
+            DELETE FROM game_leaderboard WHERE user_id = old.id;
+        END;
+    ''')
+    # 用已有历史成绩回填（SQLite 中 MAX() 聚合时 played_at 取自最高分那一行）
+    cursor.execute('''
+        INSERT OR REPLACE INTO game_leaderboard (game_name, user_id, best_score, played_at)
+        SELECT game_name, user_id, MAX(score), played_at
+        FROM game_high_scores
+        GROUP BY game_name, user_id;
+    ''')
+
+
+def _migration_5_chat_archive(cursor):
+    """Cold-storage tier for old chat messages and per-user retention policies."""
+    _create_chat_archive_table(cursor)
+    # 用户级保留策略：超过 retain_days 天的会话（含归档）会被清除
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_retention_policies (
+            user_id INTEGER PRIMARY KEY,
+            retain_days INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+
+
+def _create_chat_archive_table(cursor):
+    # 会话元数据仍留在 chat_sessions（按模型/日期/用户查找照常可用），只把消息正文压缩归档
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            session_id INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,            -- 'zlib' 或 'zstd'
+            message_count INTEGER NOT NULL,
+            payload BLOB NOT NULL,          -- 压缩后的 JSON 消息列表
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id) ON DELETE CASCADE
+        );
+    ''')
+
+
+def _migration_6_api_usage(cursor):
+    """Per-call token and latency metrics, a per-user daily rollup kept by a trigger, and per-user quotas."""
+    # 每次实际发出的模型调用一行。session_id 对应 chat_sessions.session_id，不属于聊天会话的调用
+    # （VLM、图片等）为 NULL；分片模式下会话不在中心库，因此不加外键
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_call_metrics (
+            metric_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id INTEGER,
+            page TEXT NOT NULL,             -- 'llm'、'vlm'、'mcp'、'image'
+            model_name TEXT NOT NULL,
+            status TEXT NOT NULL,           -- 'ok'、'error' 或 'coalesced'（见迁移 9）
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            tokens_estimated INTEGER NOT NULL DEFAULT 0,  -- 1 表示接口没有返回 usage，为本地估算值
+            image_count INTEGER NOT NULL DEFAULT 0,
+            latency_ms INTEGER NOT NULL,
+            first_token_ms INTEGER,         -- 只有流式调用才有
+            params TEXT,                    -- 请求参数（max_tokens、top_p 等）的 JSON
+            day TEXT NOT NULL,              -- 本地日期 YYYY-MM-DD，配额按它统计
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    # 查看某个会话的调用明细
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_call_metrics_session ON api_call_metrics (session_id) WHERE session_id IS NOT NULL;')
+    # 某个用户某天的调用明细
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_call_metrics_user_day ON api_call_metrics (user_id, day);')
+    # 按 (用户, 日期, 模型) 预先汇总：配额检查和管理员报表只读这张小表，不扫描明细
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_usage_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            image_count INTEGER NOT NULL,
+            latency_ms_total INTEGER NOT NULL,
+            first_token_ms_total INTEGER NOT NULL,
+            first_token_calls INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day, model_name)
+        ) WITHOUT ROWID;
+    ''')
+    # 管理员按日期范围汇总全部用户
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_usage_daily_day ON api_usage_daily (day, model_name);')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS api_call_metrics_daily_ai AFTER INSERT ON api_call_metrics BEGIN
+            INSERT INTO api_usage_daily (user_id, day, model_name, calls, errors, prompt_tokens, completion_tokens,
+                                         image_count, latency_ms_total, first_token_ms_total, first_token_calls)
+            VALUES (new.user_id, new.day, new.model_name, 1, new.status != 'ok', new.prompt_tokens,
+                    new.completion_tokens, new.image_count, new.latency_ms, IFNULL(new.first_token_ms, 0),
+                    new.first_token_ms IS NOT NULL)
+            ON CONFLICT (user_id, day, model_name) DO UPDATE SET
+                calls = calls + 1,
+                errors = errors + excluded.errors,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                image_count = image_count + excluded.image_count,
+                latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+                first_token_ms_total = first_token_ms_total + excluded.first_token_ms_total,
+                first_token_calls = first_token_calls + excluded.first_token_calls;
+        END;
+    ''')
+    # 每用户每日配额；列为 NULL 时使用 usage_metrics 中的默认值
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_quotas (
+            user_id INTEGER PRIMARY KEY,
+            daily_tokens INTEGER,
+            daily_requests INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+    # 未开启外键约束，删除用户时由触发器清理
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_api_usage_ad AFTER DELETE ON users BEGIN
+            DELETE FROM api_call_metrics WHERE user_id = old.id;
+            DELETE FROM api_usage_daily WHERE user_id = old.id;
+            DELETE FROM user_quotas WHERE user_id = old.id;
+        END;
+    ''')
+
+
+def _migration_7_message_reasoning(cursor):
+    """Keep reasoning models' thinking in its own column instead of the message content."""
+    # ALTER TABLE ADD COLUMN 没有 IF NOT EXISTS，先检查列是否已存在
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(chat_messages)')]
+    if 'reasoning' not in columns:
+        cursor.execute('ALTER TABLE chat_messages ADD COLUMN reasoning TEXT;')
+
+
+def _migration_8_chat_archive_fts(cursor):
+    """Contentless FTS5 index over archived sessions, so keyword search only decompresses matching archives."""
+    try:
+        # content='' 只存倒排信息，不保存正文，归档仍然只占压缩后的空间
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {CHAT_ARCHIVE_FTS_TABLE} USING fts5(
+                content,
+                content='',
+                tokenize='trigram'
+            );
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 未编译 FTS5 时归档搜索只扫描最近的归档会话
+        print(f"Skipping chat archive full-text index: {e}")
+        return
+    # 已有的归档逐个解压写入索引
+    for session_id, codec, payload in cursor.connection.execute('SELECT session_id, codec, payload FROM chat_archive'):
+        _index_archived_session(cursor, session_id, decompress_messages(codec, payload))
+
+
+def _migration_9_coalesced_api_calls(cursor):
+    """Keep coalesced follower calls (status 'coalesced') out of the daily rollup and therefore out of quotas."""
+    # 搭便车的调用没有发出请求，用量已记在发起请求的那一行上
+    cursor.execute('DROP TRIGGER IF EXISTS api_call_metrics_daily_ai;')
+    cursor.execute('''
+        CREATE TRIGGER api_call_metrics_daily_ai AFTER INSERT ON api_call_metrics
+        WHEN new.status != 'coalesced' BEGIN
+            INSERT INTO api_usage_daily (user_id, day, model_name, calls, errors, prompt_tokens, completion_tokens,
+                                         image_count, latency_ms_total, first_token_ms_total, first_token_calls)
+            VALUES (new.user_id, new.day, new.model_name, 1, new.status != 'ok', new.prompt_tokens,
+                    new.completion_tokens, new.image_count, new.latency_ms, IFNULL(new.first_token_ms, 0),
+                    new.first_token_ms IS NOT NULL)
+            ON CONFLICT (user_id, day, model_name) DO UPDATE SET
+                calls = calls + 1,
+                errors = errors + excluded.errors,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                image_count = image_count + excluded.image_count,
+                latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+                first_token_ms_total = first_token_ms_total + excluded.first_token_ms_total,
+                first_token_calls = first_token_calls + excluded.first_token_calls;
+        END;
+    ''')
+
+
+# (版本号, 迁移函数)，版本号必须连续递增；新迁移只能追加到末尾
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_chat_fts),
+    (3, _migration_3_query_indexes),
+    (4, _migration_4_game_leaderboard),
+    (5, _migration_5_chat_archive),
+    (6, _migration_6_api_usage),
+    (7, _migration_7_message_reasoning),
+    (8, _migration_8_chat_archive_fts),
+    (9, _migration_9_coalesced_api_calls),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _shard_migration_1_chat_schema(cursor):
+    """Chat tables of a shard; users live in the central database, so there is no foreign key to them."""
+    # session_id 由写入方按 (序号 << SHARD_KEY_BITS) | 分片键 生成，不使用 AUTOINCREMENT
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            model_name TEXT NOT NULL,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,          -- 'user' 或 'assistant'
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id) ON DELETE CASCADE
+        );
+    ''')
+
+
+# 分片库只包含聊天相关的表，单独维护版本号
+SHARD_MIGRATIONS = [
+    (1, _shard_migration_1_chat_schema),
+    (2, _migration_2_chat_fts),
+    (3, _create_chat_indexes),
+    (4, _create_chat_archive_table),
+    (5, _migration_7_message_reasoning),
+    (6, _migration_8_chat_archive_fts),
+]
+
+def _cache_migration_1_llm_responses(cursor):
+    """Persistent tier of the LLM response cache, keyed by the payload hash."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model_name TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    ''')
+    # 按最近使用时间淘汰
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_response_cache_last_used ON llm_response_cache (last_used_at);')
+
+
+# LLM 回复缓存库的迁移，独立维护版本号
+CACHE_MIGRATIONS = [
+    (1, _cache_migration_1_llm_responses),
+]
+
+# 其它独立库文件各自的迁移列表：{数据库路径: migrations}
+_registered_migrations = {LLM_CACHE_DATABASE: CACHE_MIGRATIONS}
+
+
+def register_migrations(database, migrations):
+    """Declare the migrations for a separate database file (e.g. a module's local store)."""
+    _registered_migrations[database] = migrations
+
+_migrated_databases = set()
+_migration_lock = threading.Lock()
+
+
+def migrate(database=None, migrations=None):
+    """Bring the database up to its latest schema version; returns the version it ends at."""
+    database = database or DATABASE_NAME
+    if migrations is None:
+        if database in _registered_migrations:
+            migrations = _registered_migrations[database]
+        else:
+            migrations = SHARD_MIGRATIONS if _is_chat_shard(database) else MIGRATIONS
+    conn = _open_connection(database)
+    if not conn:
+        return None
+    try:
+        version = conn.execute('PRAGMA user_version;').fetchone()[0]
+        for target, migration in migrations:
+            if target <= version:
+                continue
+            # BEGIN IMMEDIATE 抢占写锁，避免多个进程同时执行同一迁移
+            conn.execute('BEGIN IMMEDIATE;')
+            try:
+                version = conn.execute('PRAGMA user_version;').fetchone()[0]
+                if target <= version:
+                    conn.rollback()
+                    continue
+                migration(conn.cursor())
+                conn.execute(f'PRAGMA user_version = {target};')
+                conn.commit()
+                version = target
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+        return version
+    except sqlite3.Error as e:
+        print(f"Error migrating database schema: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def ensure_schema(database=None):
+    """Run migrate() once per process for each database file."""
+    database = database or DATABASE_NAME
+    if database in _migrated_databases:
+        return
+    with _migration_lock:
+        if database not in _migrated_databases:
+            if migrate(database) is not None:
+                _migrated_databases.add(database)
+
+
 def create_tables():
-    """Create the users and chat_history tables if they don't exist."""
-    conn = create_connection()
-    if conn:
+    """Create or upgrade the schema (kept for scripts such as create_default_user.py)."""
+    ensure_schema()
+
+
+def rebuild_chat_fts():
+    """Backfill the full-text index from every existing row in chat_messages (in every chat shard)."""
+    total = 0
+    for database in chat_databases():
+        conn = create_connection(database)
+        if not conn:
+            return None
         try:
             cursor = conn.cursor()
-            # 用户表：保存账号、邮箱、密码
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT NOT NULL UNIQUE,
-                    email TEXT NOT NULL UNIQUE,
-                    password TEXT NOT NULL
-                );
-            ''')
-            # 为 username 和 email 创建唯一索引，加快查询速度
-            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_username ON users (username);')
-            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_email ON users (email);')
-            # 聊天会话表：记录用户一次完整会话
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_sessions (
-                    session_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    model_name TEXT NOT NULL,
-                    started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                );
-            ''')
-            # 聊天消息表：保存每条聊天消息
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,          -- 'user' 或 'assistant'
-                    content TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id) ON DELETE CASCADE
-                );
-            ''')
-
-            # 游戏成绩表：保存用户在游戏中的高分
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS game_high_scores (
-                    score_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    game_name TEXT NOT NULL,
-                    score INTEGER NOT NULL,
-                    played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                );
-            ''')
-            #提交到数据库
+            cursor.execute(f"INSERT INTO {CHAT_FTS_TABLE} ({CHAT_FTS_TABLE}) VALUES ('rebuild');")
             conn.commit()
+            cursor.execute('SELECT COUNT(*) FROM chat_messages')
+            total += cursor.fetchone()[0]
         except sqlite3.Error as e:
-            print(f"Error creating tables: {e}")
+            print(f"Database error during rebuild_chat_fts: {e}")
+            return None
         finally:
             conn.close()
+    return total
+
+
+def fts_match_query(keyword):
+    """Quote a user keyword as a single FTS5 phrase, or return None if trigram search can't serve it."""
+    keyword = keyword.strip()
+    if len(keyword) < FTS_MIN_KEYWORD_LENGTH:
+        return None
+    return '"' + keyword.replace('"', '""') + '"'
 
 def add_user(username, email, password): # password will now be stored as plain text
     """Add a new user to the users table."""
@@ -91,6 +731,7 @@ def add_user(username, email, password): # password will now be stored as plain
             cursor.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
                            (username, email, password))
             conn.commit()
+            invalidate_user_cache()
             return True
         except sqlite3.IntegrityError as e:
             #用户名或邮箱重复
@@ -107,41 +748,316 @@ def add_user(username, email, password): # password will now be stored as plain
             conn.close()
     return False
 
-def get_user_by_username(username):
-    """Retrieve a user's details by username."""
+def get_user_by_username(username, use_cache=True):
+    """Retrieve a user's details by username.
+
+    Served from the user cache when possible; pass use_cache=False to force a
+    database read (e.g. when checking a password at login).
+    """
+    try:
+        return _read_through(("user_by_username", username), lambda: _load_user('username', username), use_cache)
+    except sqlite3.Error as e:
+        print(f"Database error during get_user_by_username: {e}")
+        return None
+
+def get_user_by_id(user_id, use_cache=True):
+    """Retrieve a user's details by id, served from the user cache when possible."""
+    try:
+        return _read_through(("user_by_id", user_id), lambda: _load_user('id', user_id), use_cache)
+    except sqlite3.Error as e:
+        print(f"Database error during get_user_by_id: {e}")
+        return None
+
+def get_all_users():
+    """Retrieve all users' details (excluding password for security when listing)."""
+    try:
+        return _read_through(("all_users",), _load_all_users)
+    except sqlite3.Error as e:
+        print(f"Database error during get_all_users: {e}")
+        return []
+
+def get_users_page(after_username=None, limit=DEFAULT_PAGE_SIZE, username_like=None, email_like=None):
+    """Return (users, next_cursor) for one page of users ordered by username.
+
+    Keyset pagination: pass the returned next_cursor as after_username to get the
+    following page; next_cursor is None on the last page.
+    """
+    try:
+        if username_like or email_like:
+            # 每个搜索词都会是一个新键，命中率低，不进缓存
+            return _load_users_page(after_username, limit, username_like, email_like)
+        return _read_through(("users_page", after_username, limit),
+                             lambda: _load_users_page(after_username, limit, None, None))
+    except sqlite3.Error as e:
+        print(f"Database error during get_users_page: {e}")
+        return [], None
+
+# --- User cache ---
+
+_user_cache = {}                # {key: (过期时间, 值)}，按写入顺序排列
+_user_cache_lock = threading.Lock()
+_user_cache_generation = 0      # 每次失效加一，防止失效前开始的读取把旧值写回缓存
+
+
+def _read_through(key, load, use_cache=True):
+    """Return a copy of the cached value for key, calling load() on a miss; None results are not cached."""
+    if use_cache:
+        entry = _user_cache.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                return copy.deepcopy(entry[1])
+            with _user_cache_lock:
+                if _user_cache.get(key) is entry:
+                    del _user_cache[key]
+    generation = _user_cache_generation
+    value = load()
+    if value is not None:
+        with _user_cache_lock:
+            if generation == _user_cache_generation:
+                _store_user_cache_entry(key, value)
+        value = copy.deepcopy(value)
+    return value
+
+
+def _store_user_cache_entry(key, value):
+    """Insert under _user_cache_lock, first dropping expired entries and then the oldest beyond USER_CACHE_MAX_ENTRIES."""
+    now = time.monotonic()
+    for stale in [k for k, (expires_at, _) in _user_cache.items() if expires_at <= now]:
+        del _user_cache[stale]
+    _user_cache.pop(key, None)  # 重新插入到末尾
+    while len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+        del _user_cache[next(iter(_user_cache))]
+    _user_cache[key] = (now + USER_CACHE_TTL_S, value)
+
+
+def invalidate_user_cache():
+    """Drop every cached user row and listing."""
+    global _user_cache_generation
+    with _user_cache_lock:
+        _user_cache_generation += 1
+        _user_cache.clear()
+
+
+def _connect_or_raise():
     conn = create_connection()
-    if conn:
+    if conn is None:
+        raise sqlite3.OperationalError("unable to open database connection")
+    return conn
+
+
+def _load_user(column, value):
+    conn = _connect_or_raise()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT id, username, email, password FROM users WHERE {column} = ?', (value,))
+        user = cursor.fetchone()
+        if user:
+            return {"id": user[0], "username": user[1], "email": user[2], "password": user[3]}
+        return None
+    finally:
+        conn.close()
+
+
+def _load_all_users():
+    conn = _connect_or_raise()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, username, email FROM users ORDER BY username ASC')
+        return [{"id": row[0], "username": row[1], "email": row[2]} for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def _load_users_page(after_username, limit, username_like, email_like):
+    conn = _connect_or_raise()
+    try:
+        cursor = conn.cursor()
+        query = 'SELECT id, username, email FROM users WHERE 1=1'
+        params = []
+        if username_like:
+            query += ' AND username LIKE ?'
+            params.append(f'%{username_like}%')
+        if email_like:
+            query += ' AND email LIKE ?'
+            params.append(f'%{email_like}%')
+        if after_username is not None:
+            query += ' AND username > ?'
+            params.append(after_username)
+        # 多取一行用于判断是否还有下一页
+        query += ' ORDER BY username ASC LIMIT ?'
+        params.append(limit + 1)
+        cursor.execute(query, tuple(params))
+        users = [{"id": row[0], "username": row[1], "email": row[2]} for row in cursor.fetchall()]
+        if len(users) > limit:
+            users = users[:limit]
+            return users, users[-1]["username"]
+        return users, None
+    finally:
+        conn.close()
+
+def iter_all_users(batch_size=DEFAULT_PAGE_SIZE, **filters):
+    """Yield every user, one keyset page at a time, without holding a connection between batches."""
+    after_username = None
+    while True:
+        users, after_username = get_users_page(after_username, batch_size, **filters)
+        yield from users
+        if after_username is None:
+            return
+
+def get_usernames(user_ids):
+    """Return {user_id: username} for the given ids; ids of deleted users are left out."""
+    conn = create_connection()
+    usernames = {}
+    user_ids = list(user_ids)
+    if conn and user_ids:
         try:
             cursor = conn.cursor()
-            cursor.execute('SELECT id, username, email, password FROM users WHERE username = ?', (username,))
-            user = cursor.fetchone()
-            if user:
-                return {"id": user[0], "username": user[1], "email": user[2], "password": user[3]}
-            return None
+            placeholders = ', '.join('?' for _ in user_ids)
+            cursor.execute(f'SELECT id, username FROM users WHERE id IN ({placeholders})', tuple(user_ids))
+            usernames = dict(cursor.fetchall())
         except sqlite3.Error as e:
-            print(f"Database error during get_user_by_username: {e}")
-            return None
+            print(f"Database error during get_usernames: {e}")
         finally:
             conn.close()
-    return None
+    elif conn:
+        conn.close()
+    return usernames
 
-def get_all_users():
-    """Retrieve all users' details (excluding password for security when listing)."""
-    conn = create_connection()
-    users = []
+def find_usernames_like(username_like):
+    """Return {user_id: username} for every user whose name contains username_like."""
+    return {user["id"]: user["username"] for user in iter_all_users(username_like=username_like)}
+
+def _get_chat_sessions_page_in(database, user_ids, page_cursor, limit, model_name=None, started_on=None):
+    conn = create_connection(database)
+    sessions = []
     if conn:
         try:
             cursor = conn.cursor()
-            cursor.execute('SELECT id, username, email FROM users ORDER BY username ASC')
+            query = 'SELECT session_id, user_id, model_name, started_at FROM chat_sessions WHERE 1=1'
+            params = []
+            if user_ids is not None:
+                query += f' AND user_id IN ({", ".join("?" for _ in user_ids)})'
+                params.extend(user_ids)
+            if model_name is not None:
+                query += ' AND model_name = ?'
+                params.append(model_name)
+            if started_on is not None:
+                # 用 [当天, 次日) 的范围比较代替 DATE(started_at) = ?，才能命中 started_at 索引
+                query += ' AND started_at >= ? AND started_at < ?'
+                params.extend([started_on.isoformat(), (started_on + datetime.timedelta(days=1)).isoformat()])
+            if page_cursor is not None:
+                # (started_at, session_id) 行值比较，沿 idx_chat_sessions_* 索引继续向后翻页
+                query += ' AND (started_at, session_id) < (?, ?)'
+                params.extend(page_cursor)
+            query += ' ORDER BY started_at DESC, session_id DESC LIMIT ?'
+            params.append(limit)
+            cursor.execute(query, tuple(params))
             for row in cursor.fetchall():
-                users.append({"id": row[0], "username": row[1], "email": row[2]})
-            return users
+                sessions.append({"session_id": row[0], "user_id": row[1], "model_name": row[2],
+                                 "started_at": row[3], "messages": []})
+        finally:
+            conn.close()
+    return sessions
+
+def get_chat_sessions_page(user_id=None, page_cursor=None, limit=DEFAULT_PAGE_SIZE, with_messages=True,
+                           user_ids=None, model_name=None, started_on=None):
+    """Return (sessions, next_cursor) for one page of chat sessions, newest first.
+
+    user_id=None lists every user's sessions (admin), fanning out over all chat
+    shards when sharding is enabled; user_ids instead limits the listing to several
+    users. model_name and started_on (a datetime.date) further filter the sessions.
+    page_cursor is the opaque continuation token returned by the previous call;
+    None starts from the newest.
+    """
+    if user_id is not None:
+        user_ids = [user_id]
+    databases = chat_databases(user_ids)
+    sessions, after = [], page_cursor
+    while True:
+        try:
+            # 每个分片各取 limit+1 条，合并后再截取，多出的一条用于判断是否还有下一页
+            parts = fan_out(lambda database: _get_chat_sessions_page_in(database, user_ids, after, limit + 1,
+                                                                        model_name, started_on),
+                            databases)
         except sqlite3.Error as e:
-            print(f"Database error during get_all_users: {e}")
-            return []
+            print(f"Database error during get_chat_sessions_page: {e}")
+            return [], None
+        batch = sorted((session for part in parts for session in part),
+                       key=lambda session: (session["started_at"], session["session_id"]), reverse=True)
+        has_more = len(batch) > limit
+        batch = batch[:limit]
+        usernames = get_usernames({session["user_id"] for session in batch})
+        # 与原先 JOIN users 的语义一致：已删除用户的会话不再列出
+        for session in batch:
+            if session["user_id"] in usernames:
+                session["username"] = usernames[session["user_id"]]
+                sessions.append(session)
+        if len(sessions) >= limit or not has_more:
+            break
+        # 这一批里有已删除用户的会话、页还没满：从这批最后一行（过滤前）之后继续取
+        after = (batch[-1]["started_at"], batch[-1]["session_id"])
+    next_cursor = None
+    if has_more or len(sessions) > limit:
+        sessions = sessions[:limit]
+        next_cursor = (sessions[-1]["started_at"], sessions[-1]["session_id"])
+    if with_messages and sessions:
+        messages = get_chat_messages([session["session_id"] for session in sessions])
+        for session in sessions:
+            session["messages"] = messages.get(session["session_id"], [])
+    return sessions, next_cursor
+
+def iter_chat_sessions(user_id=None, batch_size=DEFAULT_PAGE_SIZE, with_messages=True):
+    """Yield chat sessions newest first, fetching batch_size sessions per query."""
+    page_cursor = None
+    while True:
+        sessions, page_cursor = get_chat_sessions_page(user_id, page_cursor, batch_size, with_messages)
+        yield from sessions
+        if page_cursor is None:
+            return
+
+def _get_chat_messages_in(database, session_ids):
+    conn = create_connection(database)
+    messages = {}
+    if conn:
+        try:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' for _ in session_ids)
+            # 归档的消息早于热表中的消息（会话归档后继续对话时，新消息写入热表），先取归档
+            cursor.execute(f'SELECT session_id, codec, payload FROM chat_archive WHERE session_id IN ({placeholders})',
+                           tuple(session_ids))
+            for session_id, codec, payload in cursor.fetchall():
+                messages.setdefault(session_id, []).extend(decompress_messages(codec, payload))
+            cursor.execute(f'''
+                SELECT session_id, role, content, created_at, reasoning
+                FROM chat_messages
+                WHERE session_id IN ({placeholders})
+                ORDER BY session_id, created_at ASC, message_id ASC
+            ''', tuple(session_ids))
+            for row in cursor.fetchall():
+                message = {"role": row[1], "content": row[2], "created_at": row[3]}
+                if row[4] is not None:
+                    message["reasoning"] = row[4]
+                messages.setdefault(row[0], []).append(message)
         finally:
             conn.close()
-    return []
+    return messages
+
+def get_chat_messages(session_ids):
+    """Return {session_id: [message, ...]} for the given sessions, each in chronological order.
+
+    Archived sessions are decompressed transparently.
+    """
+    by_database = {}
+    for session_id in session_ids:
+        by_database.setdefault(chat_database_for_session(session_id), []).append(session_id)
+    messages = {}
+    try:
+        for part in fan_out(lambda database: _get_chat_messages_in(database, by_database[database]), list(by_database)):
+            messages.update(part)
+    except sqlite3.Error as e:
+        print(f"Database error during get_chat_messages: {e}")
+        return {}
+    return messages
 
 def update_user_password(user_id, new_password): # new_password will now be stored as plain text
     """Update a user's password."""
@@ -151,6 +1067,7 @@ def update_user_password(user_id, new_password): # new_password will now be stor
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET password = ? WHERE id = ?', (new_password, user_id))
             conn.commit()
+            invalidate_user_cache()
             return cursor.rowcount > 0 # Returns True if a row was updated
         except sqlite3.Error as e:
             print(f"Database error during update_user_password: {e}")
@@ -168,6 +1085,7 @@ def delete_user(user_id):
             cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
             #由cascade，同时也删除了会话及游戏记录
             conn.commit()
+            invalidate_user_cache()
             return cursor.rowcount > 0 # Returns True if a row was deleted
         except sqlite3.Error as e:
             print(f"Database error during delete_user: {e}")
@@ -176,21 +1094,59 @@ def delete_user(user_id):
             conn.close()
     return False
 
+def _message_rows(session_id, messages):
+    """Turn chat messages into (session_id, role, content, reasoning) rows.
+
+    Messages are {"role": ..., "content": ..., "reasoning": ...} dicts (reasoning is
+    optional); plain strings are still accepted for old callers and alternate user/assistant.
+    """
+    rows = []
+    for i, msg in enumerate(messages):
+        if isinstance(msg, dict):
+            rows.append((session_id, msg["role"], msg["content"], msg.get("reasoning")))
+        else:
+            rows.append((session_id, "user" if i % 2 == 0 else "assistant", msg, None))
+    return rows
+
+def _insert_chat_session(cursor, user_id, model_name, messages=()):
+    """Insert a session row plus its messages on an open cursor; returns the session_id."""
+    if CHAT_SHARD_MODE:
+        # 分片模式：session_id 的低 SHARD_KEY_BITS 位是分片键，高位是分片内递增序号（单条语句内原子分配）
+        cursor.execute(f'''
+            INSERT INTO chat_sessions (session_id, user_id, model_name)
+            VALUES (((((SELECT IFNULL(MAX(session_id), 0) FROM chat_sessions) >> {SHARD_KEY_BITS}) + 1)
+                     << {SHARD_KEY_BITS}) | ?, ?, ?)
+        ''', (_shard_key(user_id), user_id, model_name))
+    else:
+        cursor.execute('INSERT INTO chat_sessions (user_id, model_name) VALUES (?, ?)', (user_id, model_name))
+    session_id = cursor.lastrowid
+    if messages:
+        cursor.executemany('INSERT INTO chat_messages (session_id, role, content, reasoning) VALUES (?, ?, ?, ?)',
+                           _message_rows(session_id, messages))
+    return session_id
+
+def _insert_chat_messages(cursor, session_id, messages, model_name=None):
+    """Append messages to a session on an open cursor, optionally updating its model."""
+    cursor.executemany('INSERT INTO chat_messages (session_id, role, content, reasoning) VALUES (?, ?, ?, ?)',
+                       _message_rows(session_id, messages))
+    if model_name:
+        cursor.execute('UPDATE chat_sessions SET model_name = ? WHERE session_id = ? AND model_name != ?',
+                       (model_name, session_id, model_name))
+    return True
+
+def _insert_game_score(cursor, user_id, game_name, score):
+    cursor.execute('INSERT INTO game_high_scores (user_id, game_name, score) VALUES (?, ?, ?)',
+                   (user_id, game_name, score))
+    return True
+
 def save_chat_session(user_id, model_name, messages):
     """Save an entire chat session with its messages to the database."""
-    conn = create_connection()
+    conn = create_connection(chat_database_for_user(user_id))
     if conn:
         try:
             cursor = conn.cursor()
-            # Start a new session
-            cursor.execute('INSERT INTO chat_sessions (user_id, model_name) VALUES (?, ?)', (user_id, model_name))
-            session_id = cursor.lastrowid
-
-            # Save each message in the session
-            for i, msg_content in enumerate(messages):
-                role = "user" if i % 2 == 0 else "assistant"
-                cursor.execute('INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)',
-                               (session_id, role, msg_content))
+            # Start a new session and save all of its messages with one executemany
+            _insert_chat_session(cursor, user_id, model_name, messages)
             conn.commit()
             return True
         except sqlite3.Error as e:
@@ -200,14 +1156,47 @@ def save_chat_session(user_id, model_name, messages):
             conn.close()
     return False
 
+def start_chat_session(user_id, model_name):
+    """Open a new, empty chat session and return its session_id (None on error)."""
+    conn = create_connection(chat_database_for_user(user_id))
+    if conn:
+        try:
+            cursor = conn.cursor()
+            session_id = _insert_chat_session(cursor, user_id, model_name)
+            conn.commit()
+            return session_id
+        except sqlite3.Error as e:
+            print(f"Database error during start_chat_session: {e}")
+            return None
+        finally:
+            conn.close()
+    return None
+
+def append_chat_messages(session_id, messages, model_name=None):
+    """Append one turn (e.g. a user/assistant pair) to a session in a single transaction.
+
+    If model_name is given, the session's model is updated to it as part of the same
+    transaction, so a session records the model that was last used.
+    """
+    conn = create_connection(chat_database_for_session(session_id))
+    if conn:
+        try:
+            _insert_chat_messages(conn.cursor(), session_id, messages, model_name)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error during append_chat_messages: {e}")
+            return False
+        finally:
+            conn.close()
+    return False
+
 def save_game_score(user_id, game_name, score):
     """Save a user's game score to the database."""
     conn = create_connection()
     if conn:
         try:
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO game_high_scores (user_id, game_name, score) VALUES (?, ?, ?)',
-                           (user_id, game_name, score))
+            _insert_game_score(conn.cursor(), user_id, game_name, score)
             conn.commit()
             return True
         except sqlite3.Error as e:
@@ -217,19 +1206,516 @@ def save_game_score(user_id, game_name, score):
             conn.close()
     return False
 
+# --- Cold storage and retention ---
+
+def compress_messages(messages):
+    """Serialize a session's messages to JSON and compress them; returns (codec, blob)."""
+    raw = json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+
+def decompress_messages(codec, payload):
+    """Inverse of compress_messages()."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("chat archive uses zstd but the 'zstandard' package is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == 'zlib':
+        raw = zlib.decompress(payload)
+    else:
+        raise ValueError(f"unknown chat archive codec: {codec}")
+    return json.loads(raw.decode('utf-8'))
+
+def archive_old_sessions(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move messages of sessions older than older_than_days into chat_archive; returns sessions archived.
+
+    Messages added after an archived session was resumed are merged into its existing archive.
+    """
+    return sum(_archive_old_sessions_in(database, older_than_days, batch_size) for database in chat_databases())
+
+def _archive_old_sessions_in(database, older_than_days, batch_size):
+    archived = 0
+    while True:
+        conn = create_connection(database)
+        if not conn:
+            return archived
+        try:
+            cursor = conn.cursor()
+            # 每批一个事务，避免长时间持有写锁
+            cursor.execute('''
+                SELECT cs.session_id
+                FROM chat_sessions cs
+                WHERE cs.started_at < datetime('now', ?)
+                  AND EXISTS (SELECT 1 FROM chat_messages cm WHERE cm.session_id = cs.session_id)
+                ORDER BY cs.started_at
+                LIMIT ?
+            ''', (f'-{int(older_than_days)} days', batch_size))
+            session_ids = [row[0] for row in cursor.fetchall()]
+            if not session_ids:
+                return archived
+            rows = []
+            for session_id in session_ids:
+                # 已归档后又继续聊过的会话：新消息并入原有归档（归档的消息更早）
+                existing = cursor.execute('SELECT codec, payload FROM chat_archive WHERE session_id = ?',
+                                          (session_id,)).fetchone()
+                session_messages = decompress_messages(*existing) if existing else []
+                if existing:
+                    _unindex_archived_session(cursor, session_id, session_messages)
+                cursor.execute('''
+                    SELECT role, content, created_at, reasoning FROM chat_messages
+                    WHERE session_id = ? ORDER BY created_at ASC, message_id ASC
+                ''', (session_id,))
+                for r in cursor.fetchall():
+                    message = {"role": r[0], "content": r[1], "created_at": r[2]}
+                    if r[3] is not None:
+                        message["reasoning"] = r[3]
+                    session_messages.append(message)
+                codec, payload = compress_messages(session_messages)
+                rows.append((session_id, codec, len(session_messages), payload))
+                _index_archived_session(cursor, session_id, session_messages)
+            cursor.executemany('''
+                INSERT OR REPLACE INTO chat_archive (session_id, codec, message_count, payload) VALUES (?, ?, ?, ?)
+            ''', rows)
+            # 删除热表中的消息（FTS 触发器会同步移除索引）
+            cursor.executemany('DELETE FROM chat_messages WHERE session_id = ?', [(sid,) for sid in session_ids])
+            conn.commit()
+            archived += len(session_ids)
+        except sqlite3.Error as e:
+            print(f"Database error during archive_old_sessions: {e}")
+            return archived
+        finally:
+            conn.close()
+
+def set_retention_policy(user_id, retain_days):
+    """Keep only the last retain_days days of a user's chats; retain_days=None removes the policy."""
+    conn = create_connection()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            if retain_days is None:
+                cursor.execute('DELETE FROM chat_retention_policies WHERE user_id = ?', (user_id,))
+            else:
+                cursor.execute('''
+                    INSERT INTO chat_retention_policies (user_id, retain_days) VALUES (?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET retain_days = excluded.retain_days
+                ''', (user_id, int(retain_days)))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error during set_retention_policy: {e}")
+            return False
+        finally:
+            conn.close()
+    return False
+
+def purge_expired_chats():
+    """Delete sessions (hot and archived) that fall outside their owner's retention policy; returns sessions purged."""
+    conn = create_connection()
+    policies = []
+    if conn:
+        try:
+            policies = conn.execute('SELECT user_id, retain_days FROM chat_retention_policies').fetchall()
+        except sqlite3.Error as e:
+            print(f"Database error during purge_expired_chats: {e}")
+            return 0
+        finally:
+            conn.close()
+    purged = 0
+    for user_id, retain_days in policies:
+        conn = create_connection(chat_database_for_user(user_id))
+        if not conn:
+            continue
+        try:
+            cursor = conn.cursor()
+            # 走 idx_chat_sessions_user_started 索引
+            cursor.execute('''
+                SELECT session_id FROM chat_sessions
+                WHERE user_id = ? AND started_at < datetime('now', ?)
+            ''', (user_id, f'-{int(retain_days)} days'))
+            session_ids = [(row[0],) for row in cursor.fetchall()]
+            for (session_id,) in session_ids:
+                _unindex_archived_session(cursor, session_id)
+            # 未开启外键约束，按依赖顺序显式删除
+            cursor.executemany('DELETE FROM chat_messages WHERE session_id = ?', session_ids)
+            cursor.executemany('DELETE FROM chat_archive WHERE session_id = ?', session_ids)
+            cursor.executemany('DELETE FROM chat_sessions WHERE session_id = ?', session_ids)
+            conn.commit()
+            purged += len(session_ids)
+        except sqlite3.Error as e:
+            print(f"Database error during purge_expired_chats: {e}")
+        finally:
+            conn.close()
+    return purged
+
+def _has_archive_index(cursor):
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (CHAT_ARCHIVE_FTS_TABLE,)).fetchone() is not None
+
+def _archived_text(messages):
+    return "\n".join(message["content"] for message in messages)
+
+def _index_archived_session(cursor, session_id, messages):
+    """Add an archived session's text to the archive FTS index (no-op without FTS5)."""
+    if _has_archive_index(cursor):
+        cursor.execute(f'INSERT INTO {CHAT_ARCHIVE_FTS_TABLE} (rowid, content) VALUES (?, ?)',
+                       (session_id, _archived_text(messages)))
+
+def _unindex_archived_session(cursor, session_id, messages=None):
+    """Remove an archived session from the archive FTS index before its archive row is deleted or replaced.
+
+    messages are the archived messages if the caller has already decompressed them.
+    """
+    if not _has_archive_index(cursor):
+        return
+    if messages is None:
+        row = cursor.execute('SELECT codec, payload FROM chat_archive WHERE session_id = ?', (session_id,)).fetchone()
+        if not row:
+            return
+        messages = decompress_messages(*row)
+    # 无内容表删除时必须提供原先写入的正文
+    cursor.execute(f"INSERT INTO {CHAT_ARCHIVE_FTS_TABLE} ({CHAT_ARCHIVE_FTS_TABLE}, rowid, content) "
+                   f"VALUES ('delete', ?, ?)", (session_id, _archived_text(messages)))
+
+def _recent_live_archives(cursor, user_filter, params):
+    """Yield the newest ARCHIVE_SEARCH_SCAN_LIMIT archived sessions whose users still exist, with their payloads.
+
+    Used when the keyword is too short for the archive index (or FTS5 is missing);
+    sessions of deleted users do not count toward the limit.
+    """
+    remaining, after = ARCHIVE_SEARCH_SCAN_LIMIT, ''
+    after_params = []
+    while remaining > 0:
+        rows = cursor.execute(f'''
+            SELECT cs.session_id, cs.user_id, cs.model_name, cs.started_at
+            FROM chat_archive a
+            JOIN chat_sessions cs ON cs.session_id = a.session_id
+            WHERE 1=1{user_filter}{after}
+            ORDER BY cs.started_at DESC, cs.session_id DESC
+            LIMIT ?
+        ''', params + after_params + [ARCHIVE_SEARCH_SCAN_LIMIT]).fetchall()
+        if not rows:
+            return
+        after, after_params = ' AND (cs.started_at, cs.session_id) < (?, ?)', [rows[-1][3], rows[-1][0]]
+        usernames = get_usernames({row[1] for row in rows})
+        for row in [row for row in rows if row[1] in usernames][:remaining]:
+            remaining -= 1
+            codec, payload = cursor.connection.execute(
+                'SELECT codec, payload FROM chat_archive WHERE session_id = ?', (row[0],)).fetchone()
+            yield row + (codec, payload)
+        if len(rows) < ARCHIVE_SEARCH_SCAN_LIMIT:
+            return
+
+def _search_archived_messages_in(database, needle, match_query, user_ids):
+    conn = create_connection(database)
+    results = []
+    if conn:
+        try:
+            cursor = conn.cursor()
+            user_filter, params = '', []
+            if user_ids is not None:
+                user_filter = f' AND cs.user_id IN ({", ".join("?" for _ in user_ids)})'
+                params = list(user_ids)
+            if match_query and _has_archive_index(cursor):
+                # 先用索引找出候选会话，只解压这些归档
+                cursor.execute(f'''
+                    SELECT cs.session_id, cs.user_id, cs.model_name, cs.started_at, a.codec, a.payload
+                    FROM {CHAT_ARCHIVE_FTS_TABLE} f
+                    JOIN chat_archive a ON a.session_id = f.rowid
+                    JOIN chat_sessions cs ON cs.session_id = a.session_id
+                    WHERE {CHAT_ARCHIVE_FTS_TABLE} MATCH ?{user_filter}
+                ''', [match_query] + params)
+                rows = cursor
+            else:
+                rows = _recent_live_archives(cursor, user_filter, params)
+            # 逐行解压，避免一次性把所有候选载入内存；索引是 trigram 匹配，仍按子串逐条确认
+            for session_id, user_id, model_name, started_at, codec, payload in rows:
+                matches = [m for m in decompress_messages(codec, payload) if needle in m["content"].casefold()]
+                if matches:
+                    results.append({"session_id": session_id, "user_id": user_id, "model_name": model_name,
+                                    "started_at": started_at, "messages": matches})
+        finally:
+            conn.close()
+    return results
+
+def search_archived_messages(keyword, user_ids=None):
+    """Substring-search archived sessions; returns sessions (newest first) holding only the matching messages.
+
+    Candidates come from the archive FTS index, so only matching archives are decompressed;
+    keywords too short for trigram search only scan the newest ARCHIVE_SEARCH_SCAN_LIMIT
+    archived sessions. user_ids=None searches every user's archive.
+    """
+    needle = keyword.strip().casefold()
+    match_query = fts_match_query(keyword)
+    try:
+        parts = fan_out(lambda database: _search_archived_messages_in(database, needle, match_query, user_ids),
+                        chat_databases(user_ids))
+    except sqlite3.Error as e:
+        print(f"Database error during search_archived_messages: {e}")
+        return []
+    results = sorted((session for part in parts for session in part),
+                     key=lambda session: session["started_at"], reverse=True)
+    usernames = get_usernames({session["user_id"] for session in results})
+    results = [session for session in results if session["user_id"] in usernames]
+    for session in results:
+        session["username"] = usernames[session["user_id"]]
+    return results
+
+
+# --- Write-behind variants ---
+# 以下函数把写操作交给后台单写线程批量提交，立即返回 concurrent.futures.Future；
+# 需要确认写入结果时调用 future.result()。
+
+def _write_queue(database=None):
+    # 每个数据库文件一个写线程：分片之间的写入互不阻塞
+    database = database or DATABASE_NAME
+    return write_behind.get_write_queue(
+        database,
+        lambda: create_connection(database),
+        max_batch_size=WRITE_BATCH_MAX_SIZE,
+        max_batch_delay=WRITE_BATCH_MAX_DELAY_S,
+        max_retries=WRITE_MAX_RETRIES,
+        retry_base_delay=WRITE_RETRY_BASE_DELAY_S,
+    )
+
+def save_chat_session_async(user_id, model_name, messages):
+    """Queue save_chat_session(); the Future resolves to the new session_id."""
+    return _write_queue(chat_database_for_user(user_id)).submit(_insert_chat_session, user_id, model_name, messages)
+
+def append_chat_messages_async(session_id, messages, model_name=None):
+    """Queue append_chat_messages(); the Future resolves to True."""
+    return _write_queue(chat_database_for_session(session_id)).submit(
+        _insert_chat_messages, session_id, messages, model_name)
+
+def save_game_score_async(user_id, game_name, score):
+    """Queue save_game_score(); the Future resolves to True."""
+    return _write_queue().submit(_insert_game_score, user_id, game_name, score)
+
+def flush_writes(timeout=None):
+    """Wait until every queued write-behind request has been committed."""
+    write_behind.flush_all(timeout)
+
+# --- LLM response cache store ---
+# response_cache.py 的持久层；内存 LRU 未命中时才会读到这里。
+
+def get_cached_llm_response(cache_key, max_age_s):
+    """Return (response, created_at) for cache_key if it is younger than max_age_s seconds, else None."""
+    conn = create_connection(LLM_CACHE_DATABASE)
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT response, created_at FROM llm_response_cache WHERE cache_key = ? AND created_at >= ?',
+                           (cache_key, time.time() - max_age_s))
+            row = cursor.fetchone()
+            return tuple(row) if row else None
+        except sqlite3.Error as e:
+            print(f"Database error during get_cached_llm_response: {e}")
+            return None
+        finally:
+            conn.close()
+    return None
+
+def _touch_cached_llm_response(cursor, cache_key):
+    cursor.execute('UPDATE llm_response_cache SET last_used_at = ? WHERE cache_key = ?', (time.time(), cache_key))
+
+def _store_cached_llm_response(cursor, cache_key, model_name, response, max_age_s, max_bytes):
+    now = time.time()
+    cursor.execute('''
+        INSERT OR REPLACE INTO llm_response_cache
+            (cache_key, model_name, response, size_bytes, created_at, last_used_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (cache_key, model_name, response, len(response.encode('utf-8')), now, now))
+    cursor.execute('DELETE FROM llm_response_cache WHERE created_at < ?', (now - max_age_s,))
+    evicted = cursor.rowcount
+    # 超出容量时按最近使用时间从旧到新分批淘汰
+    while cursor.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM llm_response_cache').fetchone()[0] > max_bytes:
+        cursor.execute('''
+            DELETE FROM llm_response_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_response_cache ORDER BY last_used_at ASC LIMIT ?
+            )
+        ''', (LLM_CACHE_EVICT_BATCH,))
+        if cursor.rowcount == 0:
+            break
+        evicted += cursor.rowcount
+    return evicted
+
+def touch_cached_llm_response_async(cache_key):
+    """Queue a last-used update for a persistent cache hit."""
+    return _write_queue(LLM_CACHE_DATABASE).submit(_touch_cached_llm_response, cache_key)
+
+def store_cached_llm_response_async(cache_key, model_name, response, max_age_s, max_bytes):
+    """Queue storing a response, expiring old entries and evicting down to max_bytes.
+
+    The Future resolves to the number of entries removed.
+    """
+    return _write_queue(LLM_CACHE_DATABASE).submit(
+        _store_cached_llm_response, cache_key, model_name, response, max_age_s, max_bytes)
+
+def clear_llm_response_cache():
+    """Delete every persisted LLM response."""
+    conn = create_connection(LLM_CACHE_DATABASE)
+    if conn:
+        try:
+            conn.execute('DELETE FROM llm_response_cache')
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error during clear_llm_response_cache: {e}")
+            return False
+        finally:
+            conn.close()
+    return False
+
+# --- API usage metrics and quotas ---
+# usage_metrics.py 的存储层：明细经后台写线程写入，按天汇总由触发器维护在 api_usage_daily。
+
+# get_usage_report() 可用的分组方式
+_USAGE_GROUP_COLUMNS = {"model": "model_name", "user": "user_id", "day": "day"}
+
+def _insert_api_call(cursor, row):
+    cursor.execute('''
+        INSERT INTO api_call_metrics (user_id, session_id, page, model_name, status, prompt_tokens, completion_tokens,
+                                      tokens_estimated, image_count, latency_ms, first_token_ms, params, day)
+        VALUES (:user_id, :session_id, :page, :model_name, :status, :prompt_tokens, :completion_tokens,
+                :tokens_estimated, :image_count, :latency_ms, :first_token_ms, :params, :day)
+    ''', row)
+    return cursor.lastrowid
+
+def record_api_call_async(row):
+    """Queue one api_call_metrics row (a dict keyed by column name); the Future resolves to its metric_id."""
+    return _write_queue().submit(_insert_api_call, row)
+
+def get_daily_usage(user_id, day):
+    """Return {"calls", "tokens", "images"} used by user_id on day (YYYY-MM-DD), summed over models."""
+    usage = {"calls": 0, "tokens": 0, "images": 0}
+    conn = create_connection()
+    if conn:
+        try:
+            # 主键前缀 (user_id, day)：只读这一天每个模型一行的汇总
+            row = conn.execute('''
+                SELECT IFNULL(SUM(calls), 0), IFNULL(SUM(prompt_tokens + completion_tokens), 0), IFNULL(SUM(image_count), 0)
+                FROM api_usage_daily WHERE user_id = ? AND day = ?
+            ''', (user_id, day)).fetchone()
+            usage.update(calls=row[0], tokens=row[1], images=row[2])
+        except sqlite3.Error as e:
+            print(f"Database error during get_daily_usage: {e}")
+        finally:
+            conn.close()
+    return usage
+
+def get_usage_report(start_day, end_day, group_by="model", user_id=None):
+    """Aggregate usage between two days (inclusive) grouped by "model", "user" or "day".
+
+    Returns dicts with key, calls, errors, prompt_tokens, completion_tokens, images,
+    avg_latency_ms and avg_first_token_ms (None without streamed calls), most tokens first.
+    """
+    column = _USAGE_GROUP_COLUMNS[group_by]
+    # 指定用户时走主键区间，否则走 idx_api_usage_daily_day 的日期区间
+    where, params = 'day BETWEEN ? AND ?', [start_day, end_day]
+    if user_id is not None:
+        where, params = 'user_id = ? AND ' + where, [user_id] + params
+    conn = create_connection()
+    report = []
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {column}, SUM(calls), SUM(errors), SUM(prompt_tokens), SUM(completion_tokens), SUM(image_count),
+                       SUM(latency_ms_total), SUM(first_token_ms_total), SUM(first_token_calls)
+                FROM api_usage_daily
+                WHERE {where}
+                GROUP BY {column}
+                ORDER BY SUM(prompt_tokens + completion_tokens) DESC
+            ''', params)
+            for key, calls, errors, prompt, completion, images, latency, first_token, first_token_calls in cursor.fetchall():
+                report.append({
+                    "key": key, "calls": calls, "errors": errors, "prompt_tokens": prompt,
+                    "completion_tokens": completion, "images": images,
+                    "avg_latency_ms": latency / calls,
+                    "avg_first_token_ms": first_token / first_token_calls if first_token_calls else None,
+                })
+            return report
+        except sqlite3.Error as e:
+            print(f"Database error during get_usage_report: {e}")
+            return []
+        finally:
+            conn.close()
+    return []
+
+def get_session_api_calls(session_id):
+    """Per-call metrics of one chat session, oldest first."""
+    conn = create_connection()
+    calls = []
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT model_name, status, prompt_tokens, completion_tokens, latency_ms, first_token_ms, created_at
+                FROM api_call_metrics WHERE session_id = ? ORDER BY metric_id
+            ''', (session_id,))
+            for row in cursor.fetchall():
+                calls.append(dict(zip(("model_name", "status", "prompt_tokens", "completion_tokens", "latency_ms",
+                                       "first_token_ms", "created_at"), row)))
+            return calls
+        except sqlite3.Error as e:
+            print(f"Database error during get_session_api_calls: {e}")
+            return []
+        finally:
+            conn.close()
+    return []
+
+def get_user_quota(user_id):
+    """Return (daily_tokens, daily_requests) set for user_id (either may be None), or None without a row."""
+    conn = create_connection()
+    if conn:
+        try:
+            row = conn.execute('SELECT daily_tokens, daily_requests FROM user_quotas WHERE user_id = ?',
+                               (user_id,)).fetchone()
+            return tuple(row) if row else None
+        except sqlite3.Error as e:
+            print(f"Database error during get_user_quota: {e}")
+            return None
+        finally:
+            conn.close()
+    return None
+
+def set_user_quota(user_id, daily_tokens=None, daily_requests=None):
+    """Set a user's daily quotas (0 = unlimited, None = default); both None removes the override."""
+    conn = create_connection()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            if daily_tokens is None and daily_requests is None:
+                cursor.execute('DELETE FROM user_quotas WHERE user_id = ?', (user_id,))
+            else:
+                cursor.execute('''
+                    INSERT INTO user_quotas (user_id, daily_tokens, daily_requests) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        daily_tokens = excluded.daily_tokens,
+                        daily_requests = excluded.daily_requests
+                ''', (user_id, daily_tokens, daily_requests))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error during set_user_quota: {e}")
+            return False
+        finally:
+            conn.close()
+    return False
+
 def get_leaderboard(game_name, limit=10):
-    """Retrieve the top scores for a specific game."""
+    """Retrieve the top scores (each user's best) for a specific game."""
     conn = create_connection()
     leaderboard = []
     if conn:
         try:
             cursor = conn.cursor()
+            # 读取物化排行榜，按索引顺序取前 limit 条，不再对全部历史排序
             cursor.execute('''
-                SELECT u.username, g.score, g.played_at
-                FROM game_high_scores g
+                SELECT u.username, g.best_score, g.played_at
+                FROM game_leaderboard g
                 JOIN users u ON g.user_id = u.id
                 WHERE g.game_name = ?
-                ORDER BY g.score DESC, g.played_at ASC
+                ORDER BY g.best_score DESC, g.played_at ASC
                 LIMIT ?
             ''', (game_name, limit))
             for row in cursor.fetchall():
@@ -242,5 +1728,28 @@ def get_leaderboard(game_name, limit=10):
             conn.close()
     return []
 
-# Ensure tables are created when this module is imported
-create_tables()
\ No newline at end of file
+def get_user_rank(user_id, game_name):
+    """Return {"rank", "score", "played_at"} for a user's best score in a game, or None."""
+    conn = create_connection()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT best_score, played_at FROM game_leaderboard WHERE game_name = ? AND user_id = ?',
+                           (game_name, user_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            best_score, played_at = row
+            # 名次 = 排在前面的人数 + 1。索引是 best_score DESC、played_at ASC，方向不同无法用行值比较
+            # 表示成一个区间；拆成两个覆盖索引区间分别计数再相加，避免 OR 触发 MULTI-INDEX OR 的 rowid 去重
+            cursor.execute('''
+                SELECT (SELECT COUNT(*) FROM game_leaderboard WHERE game_name = ? AND best_score > ?)
+                     + (SELECT COUNT(*) FROM game_leaderboard WHERE game_name = ? AND best_score = ? AND played_at < ?)
+            ''', (game_name, best_score, game_name, best_score, played_at))
+            return {"rank": cursor.fetchone()[0] + 1, "score": best_score, "played_at": played_at}
+        except sqlite3.Error as e:
+            print(f"Database error during get_user_rank: {e}")
+            return None
+        finally:
+            conn.close()
+    return None
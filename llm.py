@@ -1,13 +1,19 @@
 import streamlit as st
 import requests
+import api_client  # 共享的 keep-alive 连接池
+import async_client  # 共享的事件循环，页面通过它发起 API 请求
+import itertools
 import json
-import os
+import time
+from concurrent.futures import as_completed
 import authenticator as auth
 import database # Import the database module
+import response_cache
+import context_window
+import usage_metrics
 
 # --- Configuration ---
-DEEPSEEK_API_URL = "https://api.siliconflow.cn/v1/chat/completions"
-DEEPSEEK_API_KEY = os.environ["API_KEY"]
+DEEPSEEK_API_URL = api_client.CHAT_COMPLETIONS_URL
 # CHAT_HISTORY_FILE = 'chat_history.json' # No longer needed for file-based saving
 
 # Mapping from user-friendly display names to actual model identifiers for the API
@@ -19,6 +25,28 @@ MODEL_OPTIONS_MAP = {
     "DeepSeek-R1-14B": f"{MODEL_PREFIX}DeepSeek-R1-Distill-Qwen-14B",
 }
 
+# 各模型的上下文长度（tokens），与 max_tokens 一起决定每轮能带多少历史
+MODEL_CONTEXT_TOKENS = {
+    MODEL_OPTIONS_MAP["DeepSeek-R1"]: 64 * 1024,
+    MODEL_OPTIONS_MAP["DeepSeek-V3"]: 64 * 1024,
+    MODEL_OPTIONS_MAP["DeepSeek-R1-70B"]: 32 * 1024,
+    MODEL_OPTIONS_MAP["DeepSeek-R1-14B"]: 32 * 1024,
+}
+# 模型不可用时依次尝试的备选模型
+MODEL_FALLBACKS = {
+    MODEL_OPTIONS_MAP["DeepSeek-R1"]: [MODEL_OPTIONS_MAP["DeepSeek-V3"]],
+    MODEL_OPTIONS_MAP["DeepSeek-R1-70B"]: [MODEL_OPTIONS_MAP["DeepSeek-R1-14B"]],
+}
+# 较早对话的滚动摘要用较快的模型生成，长度上限也计入历史预算
+SUMMARY_MODEL = MODEL_OPTIONS_MAP["DeepSeek-V3"]
+SUMMARY_MAX_TOKENS = 512
+# 侧边栏“历史会话”每页条数；列表只查会话元数据，打开某个会话时才加载它的消息
+SESSION_PAGE_SIZE = 10
+MODEL_DISPLAY_NAMES = {model: display_name for display_name, model in MODEL_OPTIONS_MAP.items()}
+# R1 系列的思考过程折叠显示；流式输出时最多每 REASONING_REFRESH_S 秒刷新一次
+REASONING_LABEL = "💭 思考过程"
+REASONING_REFRESH_S = 0.5
+
 
 # --- Helper Functions (removed file-based load/save, now use database) ---
 # def load_chat_history():
@@ -40,62 +68,253 @@ MODEL_OPTIONS_MAP = {
 #         st.error(f"Error saving chat history: {e}")
 
 
-def asktoai(user_input, system_prompt_content, conversation_history, model_option, max_tokens_val, top_p_val):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    api_messages = []
-    if system_prompt_content and system_prompt_content.strip():
-        api_messages.append({"role": "system", "content": system_prompt_content})
-    for i, msg_content in enumerate(conversation_history):
-        role = "user" if i % 2 == 0 else "assistant"
-        api_messages.append({"role": role, "content": msg_content})
-    api_messages.append({"role": "user", "content": user_input})
+def queue_notice(placeholder):
+    """on_wait callback for api_client calls: show the admission queue position in placeholder."""
+    return lambda position, wait_s: placeholder.info(
+        f"请求排队中：前面还有 {position} 个请求，预计等待约 {wait_s:.0f} 秒。")
+
+
+def show_reasoning(reasoning, placeholder=None):
+    """Render a reasoning model's thinking in a collapsed expander (into placeholder if given)."""
+    with placeholder.container() if placeholder is not None else st.container():
+        with st.expander(REASONING_LABEL):
+            st.markdown(reasoning)
+
+
+def reasoning_notice(placeholder):
+    """on_reasoning callback for api_client.TextStream: show the reasoning received so far in placeholder."""
+    parts = []
+    shown_at = [0.0]
+
+    def on_reasoning(piece):
+        parts.append(piece)
+        if time.monotonic() - shown_at[0] >= REASONING_REFRESH_S:
+            shown_at[0] = time.monotonic()
+            show_reasoning("".join(parts), placeholder)
+    return on_reasoning
+
+
+def asktoai(user_input, system_prompt_content, conversation_history, model_option, max_tokens_val, top_p_val,
+            stream=False, use_cache=True, api_calls=None):
+    """Ask the chat model and return (reply_text, reasoning); reply_text may be an "error: ..." string.
+
+    Reasoning models' thinking is split from the answer (api_client.split_reasoning) and
+    returned separately so it never ends up in the history sent on later turns; it is
+    None for other models. With stream=True both are rendered into the current container
+    as they arrive, and the full text is still returned. When the response cache is
+    enabled, identical payloads are answered from it (without reasoning) unless use_cache is False.
+    Each request actually sent is appended to api_calls as a usage_metrics.ApiCall.
+    """
+    payload = api_client.build_chat_payload(user_input, system_prompt_content, conversation_history, model_option,
+                                            max_tokens_val, top_p_val)
 
+    cache_key = response_cache.make_key(payload) if response_cache.ENABLED and use_cache else None
+    if cache_key:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            if stream:
+                st.markdown(cached_response)  # 非流式时由调用方渲染
+            return cached_response, None
+
+    # 当前模型在重试后仍不可用（超时、连接失败、429/5xx）时，按 MODEL_FALLBACKS 依次换用备选模型
+    fallback_chain = [model_option] + MODEL_FALLBACKS.get(model_option, [])
+    queue_placeholder = st.empty()
+    for i, current_model in enumerate(fallback_chain):
+        payload["model"] = current_model
+        call = usage_metrics.ApiCall("llm", payload)
+        if api_calls is not None:
+            api_calls.append(call)
+        # 备选模型的回复不写入以原模型为键的缓存
+        store_in_cache = cache_key is not None and current_model == model_option
+        try:
+            if stream:
+                reasoning_placeholder = st.empty()
+                text_stream = api_client.TextStream(
+                    async_client.stream_chat_completion(DEEPSEEK_API_URL, payload, timeout=120,
+                                                        on_wait=queue_notice(queue_placeholder)),
+                    on_reasoning=reasoning_notice(reasoning_placeholder), model=current_model)
+                pieces = iter(text_stream)
+                with st.spinner("AI正在思考中..."):
+                    first_piece = next(pieces, None)  # 首个 token 到达前显示 spinner（思考过程在折叠框里实时更新）
+                queue_placeholder.empty()
+                if text_stream.reasoning:
+                    show_reasoning(text_stream.reasoning, reasoning_placeholder)
+                if first_piece is None:
+                    return "error: empty response from AI", None
+                call.first_token()
+                # 按 text_stream.text 重绘而不是拼接片段：省略 <think> 的 R1 回复在出现 </think> 时，
+                # 已显示的部分会被移到推理里
+                answer_placeholder = st.empty()
+                for _ in itertools.chain([first_piece], pieces):
+                    answer_placeholder.markdown(text_stream.text)
+                if text_stream.reasoning:
+                    show_reasoning(text_stream.reasoning, reasoning_placeholder)
+                call.finish(text_stream.usage, (text_stream.reasoning or "") + text_stream.text)
+                if text_stream.error is not None:
+                    # 中途断线：保留已收到的部分回复
+                    st.warning(f"连接中断，回复可能不完整: {text_stream.error}")
+                elif store_in_cache:
+                    response_cache.put(cache_key, model_option, text_stream.text.strip())
+                return text_stream.text.strip(), text_stream.reasoning
+            with st.spinner("AI正在思考中..."):
+                response = async_client.post_hedged(DEEPSEEK_API_URL, current_model, json=payload, timeout=120,
+                                                    on_wait=queue_notice(queue_placeholder))
+            queue_placeholder.empty()
+            response.raise_for_status()
+            response_data = response.json()
+            if response_data.get("choices") and len(response_data["choices"]) > 0 and response_data["choices"][0].get(
+                    "message"):
+                reasoning, ai_response = api_client.split_reasoning(response_data["choices"][0]["message"],
+                                                                current_model)
+                call.finish(response_data.get("usage"), (reasoning or "") + ai_response)
+                if ai_response and store_in_cache:
+                    response_cache.put(cache_key, model_option, ai_response)
+                return (ai_response, reasoning) if ai_response else ("error: empty response from AI", None)
+            else:
+                st.error("API响应格式不正确或choices为空。")
+                st.json(response_data)
+                return "error: API response format issue", None
+        except requests.exceptions.RequestException as e:
+            queue_placeholder.empty()
+            if i + 1 < len(fallback_chain) and api_client.is_transient_error(e):
+                st.info(f"{current_model} 暂时不可用，改用 {fallback_chain[i + 1]} 回答。")
+                continue
+            if isinstance(e, requests.exceptions.Timeout):
+                st.error("API请求超时。请稍后再试或增加超时时间。")
+                return "error: request timeout", None
+            st.error(f"API请求失败: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                st.error(f"服务器响应码: {e.response.status_code}")
+                st.text(f"错误详情: {e.response.text}")
+                try:
+                    st.json(e.response.json())
+                except json.JSONDecodeError:
+                    pass
+            return "error: request failed", None
+        except Exception as e:
+            st.error(f"处理API请求时发生未知错误: {e}")
+            return "error: unknown processing error", None
+
+
+def summarize_history(previous_summary, messages):
+    """Fold messages into previous_summary with SUMMARY_MODEL; returns the new summary or None on failure."""
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    if previous_summary:
+        transcript = f"已有摘要：\n{previous_summary}\n\n新增对话：\n{transcript}"
     payload = {
-        "model": model_option,  # This will now use the prefixed model name
-        "messages": api_messages,
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": "请把以下对话压缩成简洁的摘要，保留事实、结论和用户的要求，不超过300字。"},
+            {"role": "user", "content": transcript},
+        ],
         "stream": False,
-        "max_tokens": max_tokens_val,
-        "stop": ["null"],
-        "temperature": 0.7,
-        "top_p": top_p_val,
-        "top_k": 50,
-        "frequency_penalty": 0.5,
-        "n": 1,
-        "response_format": {"type": "text"},
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "temperature": 0.3,
     }
-
+    call = usage_metrics.ApiCall("llm", payload)
     try:
-        with st.spinner("AI正在思考中..."):
-            response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=120)
+        response = async_client.post_with_retry(DEEPSEEK_API_URL, json=payload, timeout=60)
         response.raise_for_status()
         response_data = response.json()
-        if response_data.get("choices") and len(response_data["choices"]) > 0 and response_data["choices"][0].get(
-                "message"):
-            ai_response = response_data["choices"][0]["message"]["content"]
-            return ai_response.strip() if ai_response else "error: empty response from AI"
-        else:
-            st.error("API响应格式不正确或choices为空。")
-            st.json(response_data)
-            return "error: API response format issue"
-    except requests.exceptions.Timeout:
-        st.error("API请求超时。请稍后再试或增加超时时间。")
-        return "error: request timeout"
-    except requests.exceptions.RequestException as e:
-        st.error(f"API请求失败: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            st.error(f"服务器响应码: {e.response.status_code}")
-            st.text(f"错误详情: {e.response.text}")
+        choices = response_data.get("choices") or []
+        summary = choices[0]["message"]["content"].strip() if choices else ""
+        call.finish(response_data.get("usage"), summary)
+        return summary or None
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return None
+    finally:
+        call.record(st.session_state.get("user_id"), st.session_state.get("chat_session_id"))
+
+
+def build_context(model_option, max_tokens_val, system_prompt_content, user_input, summarize_dropped):
+    """Return (system_prompt, history, dropped_count) fitted to the model's context budget.
+
+    Messages that no longer fit are dropped from the front; with summarize_dropped they
+    are folded into a rolling summary kept in st.session_state.context_summary and
+    appended to the system prompt.
+    """
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model_option, context_window.DEFAULT_CONTEXT_TOKENS)
+    budget = context_window.history_budget(
+        context_tokens, max_tokens_val, system_prompt_content, user_input,
+        reserved_tokens=SUMMARY_MAX_TOKENS if summarize_dropped else 0)
+    dropped, history = context_window.fit_history(st.session_state.messages, budget)
+    if not dropped or not summarize_dropped:
+        return system_prompt_content, history, dropped
+
+    # 滚动摘要：只把上次摘要之后新丢弃的消息并入摘要
+    summary = st.session_state.context_summary
+    if summary["covered"] < dropped:
+        with st.spinner("正在整理较早的对话..."):
+            new_text = summarize_history(summary["text"], st.session_state.messages[summary["covered"]:dropped])
+        if new_text:
+            summary = st.session_state.context_summary = {"covered": dropped, "text": new_text}
+    if summary["text"]:
+        system_prompt_content = f"{system_prompt_content or ''}\n\n此前对话的摘要：\n{summary['text']}".strip()
+    return system_prompt_content, history, dropped
+
+
+def compare_models(user_input, system_prompt_content, display_names, max_tokens_val, top_p_val):
+    """Send one prompt to several models at once and render each answer in its column as soon as it arrives."""
+    columns = st.columns(len(display_names))
+    placeholders = {}
+    for column, display_name in zip(columns, display_names):
+        with column:
+            st.markdown(f"**{display_name}**")
+            placeholders[display_name] = st.empty()
+            placeholders[display_name].info("等待回复...")
+
+    # 请求在共享事件循环里并发进行，所有 st 调用都留在脚本线程里
+    futures = {}
+    calls = {}
+    start = time.monotonic()
+    for display_name in display_names:
+        model_option = MODEL_OPTIONS_MAP[display_name]
+        system_prompt_for_api, history, _ = build_context(
+            model_option, max_tokens_val, system_prompt_content, user_input, summarize_dropped=False)
+        payload = api_client.build_chat_payload(user_input, system_prompt_for_api, history, model_option,
+                                                max_tokens_val, top_p_val)
+        calls[display_name] = usage_metrics.ApiCall("llm", payload)
+        futures[async_client.submit_chat_completion(payload)] = display_name
+    for future in as_completed(futures):
+        with placeholders[futures[future]].container():
             try:
-                st.json(e.response.json())
-            except json.JSONDecodeError:
-                pass
-        return "error: request failed"
-    except Exception as e:
-        st.error(f"处理API请求时发生未知错误: {e}")
-        return "error: unknown processing error"
+                text, usage, latency = future.result()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                st.error(f"请求失败: {e}")
+                continue
+            calls[futures[future]].finish(usage, text)
+            st.markdown(text)
+            if usage:
+                token_info = f"输入 {usage.get('prompt_tokens', '?')} / 输出 {usage.get('completion_tokens', '?')} tokens"
+            else:
+                token_info = f"输出约 {context_window.estimate_tokens(text)} tokens"
+            st.caption(f"耗时 {latency:.1f}s · {token_info}")
+    st.caption(f"总耗时 {time.monotonic() - start:.1f}s（各模型并行请求）")
+    # 对比的问答不属于任何会话
+    for call in calls.values():
+        call.record(st.session_state.get("user_id"))
+
+
+def open_chat_session(session):
+    """Button callback: load a saved session's messages so that new turns are appended to it."""
+    pending_chat_write = st.session_state.get("pending_chat_write")
+    if pending_chat_write is not None:
+        pending_chat_write.exception()  # 等上一轮的后台写入完成，否则可能读不到刚写入的消息
+    messages = []
+    for msg in database.get_chat_messages([session["session_id"]]).get(session["session_id"], []):
+        message = {"role": msg["role"], "content": msg["content"]}
+        if msg["role"] == "assistant":
+            # 较早保存的回复可能还把 <think> 块留在正文里，载入时拆出来，不再随历史发送
+            message["reasoning"], message["content"] = api_client.split_reasoning(
+                {"content": msg["content"], "reasoning_content": msg.get("reasoning")}, session["model_name"])
+        messages.append(message)
+    st.session_state.messages = messages
+    st.session_state.chat_session_id = session["session_id"]
+    st.session_state.context_summary = {"covered": 0, "text": ""}
+    st.session_state.current_session_model = session["model_name"]
+    # 回调在组件创建前执行，可以直接切换模型选择框
+    if session["model_name"] in MODEL_DISPLAY_NAMES:
+        st.session_state.model_select = MODEL_DISPLAY_NAMES[session["model_name"]]
 
 
 # --- Streamlit App UI ---
@@ -110,7 +329,7 @@ if not st.session_state.get("authenticated"):
 # Retrieve current user's ID
 # Assuming 'username' is stored in session_state after successful login
 current_username = st.session_state.get('username')
-current_user = database.get_user_by_username(current_username)
+current_user = database.get_user_by_id(st.session_state.get('user_id'))  # 走用户缓存，通常不访问数据库
 current_user_id = current_user['id'] if current_user else None
 
 if not current_user_id:
@@ -155,6 +374,32 @@ with st.sidebar:
         min_value=0.0, max_value=1.0, value=0.7, step=0.01, key="top_p_slider",
         help="控制输出文本的随机性。较低的值使输出更集中和确定性，较高的值更多样化。\n(原代码中此滑块名为Temperature，但实际控制API的top_p参数，temperature参数固定为0.7)"
     )
+    st.subheader("🔀 多模型对比")
+    compare_mode = st.checkbox("对比模式", value=False, key="compare_mode_checkbox",
+                               help="把同一个问题同时发给多个模型，并排显示各自的回复、耗时和 token 用量。对比的问答不计入当前对话。")
+    compare_display_names = []
+    if compare_mode:
+        compare_display_names = st.multiselect("参与对比的模型:", options=display_model_names,
+                                               default=display_model_names, key="compare_models_select")
+
+    stream_output = st.checkbox("流式输出", value=True, key="stream_output_checkbox",
+                                help="边生成边显示回复，无需等待整段回复完成。")
+    summarize_dropped_turns = st.checkbox(
+        "用摘要代替较早的对话", value=False, key="summarize_dropped_checkbox",
+        help="对话超出模型上下文预算时，较早的消息默认直接丢弃；勾选后改为发送它们的滚动摘要（需额外调用一次模型）。")
+    use_response_cache = True
+    if response_cache.ENABLED:
+        use_response_cache = st.checkbox("使用回复缓存", value=True, key="use_response_cache_checkbox",
+                                         help="相同的模型、提示、历史和参数直接返回缓存的回复；需要重新采样时取消勾选。")
+        cache_stats = response_cache.stats()
+        st.caption(f"缓存命中 {cache_stats['memory_hits'] + cache_stats['disk_hits']} 次，"
+                   f"未命中 {cache_stats['misses']} 次")
+    token_quota, request_quota = usage_metrics.effective_quota(current_user_id)
+    if token_quota or request_quota:
+        usage_today = database.get_daily_usage(current_user_id, usage_metrics.today())
+        st.caption(f"今日用量：{usage_today['calls']}"
+                   f"{f' / {request_quota}' if request_quota else ''} 次请求，{usage_today['tokens']}"
+                   f"{f' / {token_quota}' if token_quota else ''} tokens")
 
 
 if 'messages' not in st.session_state:
@@ -163,16 +408,52 @@ if 'messages' not in st.session_state:
 # Initialize session state for the current model in use for saving
 if 'current_session_model' not in st.session_state:
     st.session_state.current_session_model = model_selected
+# 当前对话在数据库中的会话 ID，首轮对话成功后才创建
+if 'chat_session_id' not in st.session_state:
+    st.session_state.chat_session_id = None
+# 已被裁剪出上下文的较早消息的滚动摘要：covered 为摘要覆盖的消息条数
+if 'context_summary' not in st.session_state:
+    st.session_state.context_summary = {"covered": 0, "text": ""}
+# 历史会话列表的游标栈（栈顶为当前页的起始游标）
+if 'session_list_cursors' not in st.session_state:
+    st.session_state.session_list_cursors = [None]
 
 
-for i, msg_content in enumerate(st.session_state.messages):
-    role_name = "human" if i % 2 == 0 else "ai"
+for msg in st.session_state.messages:
+    role_name = "human" if msg["role"] == "user" else "ai"
     with st.chat_message(name=role_name):
-        st.markdown(msg_content)
+        if msg.get("reasoning"):
+            show_reasoning(msg["reasoning"])
+        st.markdown(msg["content"])
+
+# 上一轮后台写入如果失败，在这里提示用户
+pending_chat_write = st.session_state.get("pending_chat_write")
+if pending_chat_write is not None and pending_chat_write.done():
+    if pending_chat_write.exception() is not None:
+        st.warning(f"上一轮对话未能保存到数据库: {pending_chat_write.exception()}")
+    st.session_state.pending_chat_write = None
 
 user_chat_input = st.chat_input("您好，请问有什么可以帮助您的？")
 
+quota_error = None
 if user_chat_input:
+    try:
+        usage_metrics.check_quota(current_user_id, context_window.estimate_tokens(user_chat_input))
+    except usage_metrics.QuotaExceeded as e:
+        quota_error = str(e)
+
+if user_chat_input and quota_error:
+    with st.chat_message("human"):
+        st.markdown(user_chat_input)
+    st.error(quota_error)
+elif user_chat_input and compare_mode:
+    with st.chat_message("human"):
+        st.markdown(user_chat_input)
+    if compare_display_names:
+        compare_models(user_chat_input, system_prompt_input, compare_display_names, max_token_val, top_p_slider_val)
+    else:
+        st.warning("请在侧边栏选择至少一个参与对比的模型。")
+elif user_chat_input:
     # Update the model used for the current session if it changed
     # Only if there are no messages yet, or if we decide to allow changing mid-session
     # For now, let's assume if a new chat input comes, we use the currently selected model
@@ -181,37 +462,88 @@ if user_chat_input:
 
     with st.chat_message("human"):
         st.markdown(user_chat_input)
-    history_for_api = list(st.session_state.messages)
-    st.session_state.messages.append(user_chat_input)
-
-    ai_response = asktoai(
-        user_input=user_chat_input,
-        system_prompt_content=system_prompt_input,
-        conversation_history=history_for_api,
-        model_option=model_selected,  # Use the derived model_selected here
-        max_tokens_val=max_token_val,
-        top_p_val=top_p_slider_val
-    )
+    system_prompt_for_api, history_for_api, dropped_count = build_context(
+        model_selected, max_token_val, system_prompt_input, user_chat_input, summarize_dropped_turns)
+    if dropped_count:
+        st.caption(f"对话较长，最早的 {dropped_count} 条消息"
+                   f"{'以摘要形式' if summarize_dropped_turns and st.session_state.context_summary['text'] else '未'}"
+                   "随本轮发送。")
+    user_message = {"role": "user", "content": user_chat_input}
+    st.session_state.messages.append(user_message)
 
-    if ai_response and not ai_response.startswith("error:"):
-        with st.chat_message("ai"):
+    api_calls = []
+    with st.chat_message("ai"):
+        ai_response, ai_reasoning = asktoai(
+            user_input=user_chat_input,
+            system_prompt_content=system_prompt_for_api,
+            conversation_history=history_for_api,
+            model_option=model_selected,  # Use the derived model_selected here
+            max_tokens_val=max_token_val,
+            top_p_val=top_p_slider_val,
+            stream=stream_output,
+            use_cache=use_response_cache,
+            api_calls=api_calls
+        )
+        if ai_response and not ai_response.startswith("error:") and not stream_output:
+            if ai_reasoning:
+                show_reasoning(ai_reasoning)
             st.markdown(ai_response)
-        st.session_state.messages.append(ai_response)
+
+    if ai_response and not ai_response.startswith("error:"):
+        # 思考过程单独保存在 reasoning 中，build_chat_payload 只发送 content
+        assistant_message = {"role": "assistant", "content": ai_response, "reasoning": ai_reasoning}
+        st.session_state.messages.append(assistant_message)
+
+        # 每轮对话结束即写入数据库：首轮先创建会话，之后每轮一次事务追加问答两条消息
+        if st.session_state.chat_session_id is None:
+            st.session_state.chat_session_id = database.start_chat_session(
+                current_user_id, st.session_state.current_session_model)
+        if st.session_state.chat_session_id is None:
+            st.warning("本轮对话未能保存到数据库。")
+        else:
+            # 追加消息交给后台写线程，不阻塞页面渲染；失败会在下一轮提示
+            st.session_state.pending_chat_write = database.append_chat_messages_async(
+                st.session_state.chat_session_id, [user_message, assistant_message],
+                model_name=st.session_state.current_session_model)
     else:
-        if st.session_state.messages and st.session_state.messages[-1] == user_chat_input:
+        if st.session_state.messages and st.session_state.messages[-1] is user_message:
             st.session_state.messages.pop()
 
+    # 会话创建之后再记录用量，首轮的调用也能关联到会话
+    for call in api_calls:
+        call.record(current_user_id, st.session_state.chat_session_id)
+
 st.markdown("---", unsafe_allow_html=True)
-if st.button("💾 保存聊天记录并开始新对话", help="保存当前对话到本地文件，并清空当前聊天界面。"):
-    if st.session_state.messages:
-        # Pass the current_user_id, the model used for this session, and messages to the database function
-        success = database.save_chat_session(current_user_id, st.session_state.current_session_model, st.session_state.messages)
-        if success:
-            st.success("聊天记录已保存到数据库！将开始新的对话。")
-            st.session_state.messages = []
-            st.session_state.current_session_model = model_selected # Reset model for new session
-            st.rerun()
-        else:
-            st.error("保存聊天记录到数据库失败。")
+if st.button("💾 开始新对话", help="聊天记录已在每轮对话后自动保存，点击后清空当前聊天界面并开始新的会话。"):
+    if st.session_state.messages or st.session_state.chat_session_id is not None:
+        st.session_state.messages = []
+        st.session_state.chat_session_id = None
+        st.session_state.context_summary = {"covered": 0, "text": ""}
+        st.session_state.current_session_model = model_selected # Reset model for new session
+        st.rerun()
     else:
-        st.info("当前没有聊天记录可保存。")
\ No newline at end of file
+        st.info("当前没有聊天记录。")
+# 放在脚本末尾，本轮刚创建的会话也会出现在列表里
+with st.sidebar:
+    st.subheader("🗂️ 历史会话")
+    session_cursors = st.session_state.session_list_cursors
+    saved_sessions, next_session_cursor = database.get_chat_sessions_page(
+        current_user_id, session_cursors[-1], SESSION_PAGE_SIZE, with_messages=False)
+    if not saved_sessions:
+        st.caption("还没有已保存的会话。")
+    for saved_session in saved_sessions:
+        is_current_session = saved_session["session_id"] == st.session_state.chat_session_id
+        st.button(f"{'▶ ' if is_current_session else ''}{saved_session['started_at'][:16]} · "
+                  f"{MODEL_DISPLAY_NAMES.get(saved_session['model_name'], saved_session['model_name'])}",
+                  key=f"open_session_{saved_session['session_id']}", disabled=is_current_session,
+                  on_click=open_chat_session, args=(saved_session,), use_container_width=True)
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if st.button("上一页", disabled=len(session_cursors) <= 1, use_container_width=True, key="sessions_prev_page"):
+            session_cursors.pop()
+            st.rerun()
+    with next_col:
+        if st.button("下一页", disabled=next_session_cursor is None, use_container_width=True,
+                     key="sessions_next_page"):
+            session_cursors.append(next_session_cursor)
+            st.rerun()
@@ -0,0 +1,158 @@
+# load_test.py
+"""
+API 请求路径的压测工具：以固定并发调用页面所用的 api_client 函数，报告延迟分位数和吞吐。
+
+场景与页面一一对应（经由 async_client，设置 API_ASYNC=0 可对比基于线程的 api_client 实现）：
+  chat   -- post_hedged() 非流式聊天（llm.py / vlm.py 的默认路径）
+  stream -- stream_chat_completion() + TextStream 流式聊天，另报告首 token 延迟
+  image  -- post_coalesced() 图片生成（word_image.py / mcp.py），--identical 时所有请求相同，可观察请求合并
+默认连接本地替身服务器 http://127.0.0.1:8765（python mock_siliconflow.py 启动），
+--mock 则在本进程内启动一个，替身服务器的延迟、错误率和 429 参数可直接在这里传入。
+默认关闭 admission 全局限流（--admission 开启），否则吞吐只反映配置的令牌桶速率。
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import admission
+import api_client
+import async_client
+import mock_siliconflow
+from batch_infer import _percentile
+
+DEFAULT_BASE_URL = f"http://127.0.0.1:{mock_siliconflow.DEFAULT_PORT}"
+DEFAULT_MODEL = "deepseek-ai/DeepSeek-V3"
+DEFAULT_IMAGE_MODEL = "Kwai-Kolors/Kolors"
+
+
+def _point_client_at(base_url):
+    base_url = base_url.rstrip("/")
+    api_client.SILICONFLOW_BASE_URL = base_url
+    api_client.CHAT_COMPLETIONS_URL = f"{base_url}/v1/chat/completions"
+    api_client.IMAGE_GENERATIONS_URL = f"{base_url}/v1/images/generations"
+
+
+def _chat_payload(args, i):
+    return api_client.build_chat_payload(f"压测请求 {i}: {args.prompt}", "", [], args.model, args.max_tokens, 0.7)
+
+
+def _run_chat(args, i):
+    response = async_client.post_hedged(api_client.CHAT_COMPLETIONS_URL, args.model,
+                                        json=_chat_payload(args, i), timeout=120)
+    response.raise_for_status()
+    if not response.json().get("choices"):
+        raise ValueError("empty response from AI")
+    return None
+
+
+def _run_stream(args, i):
+    start = time.monotonic()
+    text_stream = api_client.TextStream(
+        async_client.stream_chat_completion(api_client.CHAT_COMPLETIONS_URL, _chat_payload(args, i), timeout=120))
+    first_token_at = None
+    for _ in text_stream:
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+    if text_stream.error is not None:
+        raise text_stream.error
+    return first_token_at - start if first_token_at is not None else None
+
+
+def _run_image(args, i):
+    prompt = args.prompt if args.identical else f"{args.prompt} #{i}"
+    payload = {"model": DEFAULT_IMAGE_MODEL, "prompt": prompt, "image_size": "1024x1024", "batch_size": 1}
+    response = async_client.post_coalesced(api_client.IMAGE_GENERATIONS_URL, json=payload, timeout=180,
+                                           priority=admission.PRIORITY_BULK)
+    response.raise_for_status()
+    if not response.json().get("images"):
+        raise ValueError("no images in response")
+    return None
+
+
+SCENARIOS = {"chat": _run_chat, "stream": _run_stream, "image": _run_image}
+
+
+def run(args):
+    scenario = SCENARIOS[args.scenario]
+    latencies, first_token_latencies = [], []
+    errors = Counter()
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+    start = time.monotonic()
+    deadline = start + args.duration if args.duration else None
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None or (deadline and time.monotonic() >= deadline):
+                return
+            t0 = time.monotonic()
+            try:
+                first_token_s = scenario(args, i)
+            except Exception as e:
+                with lock:
+                    errors[type(e).__name__] += 1
+                continue
+            with lock:
+                latencies.append(time.monotonic() - t0)
+                if first_token_s is not None:
+                    first_token_latencies.append(first_token_s)
+
+    threads = [threading.Thread(target=worker, name=f"load-{n}", daemon=True) for n in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    failed = sum(errors.values())
+    transport = "asyncio" if async_client.ENABLED else "threads"
+    print(f"{args.scenario}: {len(latencies)} ok, {failed} failed in {elapsed:.1f}s "
+          f"at concurrency {args.concurrency} ({transport})")
+    print(f"Throughput: {len(latencies) / elapsed:.2f} req/s")
+    for label, values in (("Latency", latencies), ("First token", first_token_latencies)):
+        if values:
+            values.sort()
+            print(f"{label}: p50 {_percentile(values, 0.50):.3f}s, p95 {_percentile(values, 0.95):.3f}s, "
+                  f"p99 {_percentile(values, 0.99):.3f}s, max {values[-1]:.3f}s")
+    if errors:
+        print("Errors: " + ", ".join(f"{name} x{count}" for name, count in errors.most_common()))
+    return latencies, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the API request path against a (mock) SiliconFlow server.")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="total requests to send")
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds (0 = no limit)")
+    parser.add_argument("--base-url", default=os.environ.get("SILICONFLOW_BASE_URL", DEFAULT_BASE_URL))
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--prompt", default="hello from the load test")
+    parser.add_argument("--identical", action="store_true", help="image scenario: send identical prompts")
+    parser.add_argument("--admission", action="store_true", help="keep admission rate limiting on")
+    parser.add_argument("--mock", action="store_true", help="start an in-process mock server on --mock-port")
+    parser.add_argument("--mock-port", type=int, default=mock_siliconflow.DEFAULT_PORT)
+    mock_group = parser.add_argument_group("mock server options (with --mock)")
+    mock_siliconflow.add_config_arguments(mock_group)
+    args = parser.parse_args(argv)
+
+    if args.mock:
+        mock_siliconflow.start_server(mock_siliconflow.config_from_args(args), args.mock_port)
+        args.base_url = f"http://127.0.0.1:{args.mock_port}"
+    if "siliconflow.cn" in args.base_url:
+        print("Refusing to load-test the real API; point --base-url at a mock server.", file=sys.stderr)
+        sys.exit(2)
+    os.environ.setdefault("API_KEY", "mock")
+    _point_client_at(args.base_url)
+    admission.ENABLED = args.admission
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
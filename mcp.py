@@ -1,14 +1,15 @@
 import streamlit as st
 import requests
+import api_client  # 共享的 keep-alive 连接池
+import async_client  # 共享的事件循环，页面通过它发起 API 请求
+import admission
+import usage_metrics
 import json # For parsing potential error responses
-import os
+import context_window
 
 # --- Configuration ---
-DEEPSEEK_CHAT_API_URL = "https://api.siliconflow.cn/v1/chat/completions" # For keyword extraction
-DEEPSEEK_IMAGE_API_URL = "https://api.siliconflow.cn/v1/images/generations"  # For image generation
-
-# Prefer environment variable for API key
-DEEPSEEK_API_KEY = os.environ["API_KEY"]
+DEEPSEEK_CHAT_API_URL = api_client.CHAT_COMPLETIONS_URL # For keyword extraction
+DEEPSEEK_IMAGE_API_URL = api_client.IMAGE_GENERATIONS_URL  # For image generation
 
 # --- Hardcoded Model Identifiers and Parameters ---
 POEM_ANALYSIS_MODEL_ID = "deepseek-ai/DeepSeek-R1"
@@ -26,14 +27,16 @@ IMAGE_SIZE = "1024x1024" # Common default, ensure model supports it
 
 # --- API Call Functions ---
 
+def queue_notice(placeholder):
+    """on_wait callback for api_client calls: show the admission queue position in placeholder."""
+    return lambda position, wait_s: placeholder.info(
+        f"请求排队中：前面还有 {position} 个请求，预计等待约 {wait_s:.0f} 秒。")
+
+
 def extract_keywords_from_poem(poem_text):
     """
     Extracts keywords from a poem using the hardcoded POEM_ANALYSIS_MODEL_ID.
     """
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
     system_prompt_content = (
         "You are an expert in analyzing the artistic conception of poetry. "
         "Carefully read the poem provided by the user. "
@@ -56,14 +59,16 @@ def extract_keywords_from_poem(poem_text):
         "temperature": KEYWORD_TEMPERATURE,
         "top_p": KEYWORD_TOP_P,
     }
-
+    call = usage_metrics.ApiCall("mcp", payload)
     with st.spinner(f"AI ({POEM_ANALYSIS_MODEL_ID.split('/')[-1]}) 正在分析诗句提取关键词..."):
         try:
-            response = requests.post(DEEPSEEK_CHAT_API_URL, headers=headers, json=payload, timeout=60)
+            response = async_client.post_coalesced(DEEPSEEK_CHAT_API_URL, json=payload, timeout=60,
+                                                   on_coalesced=call.coalesced)
             response.raise_for_status()
             response_data = response.json()
             if response_data.get("choices") and response_data["choices"][0].get("message"):
                 keywords = response_data["choices"][0]["message"]["content"].strip()
+                call.finish(response_data.get("usage"), keywords)
                 if keywords:
                     return keywords
                 else:
@@ -81,12 +86,10 @@ def extract_keywords_from_poem(poem_text):
         except Exception as e:
             st.error(f"处理关键词提取时发生未知错误: {e}")
             return None
+        finally:
+            call.record(st.session_state.get("user_id"))
 
 def generate_image_from_keywords(keywords_prompt):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
     # Ensure parameter names match SiliconFlow's API for the specific model
     # Common names are 'prompt', 'model', 'n' (for number of images), 'size', 'guidance_scale'
     payload = {
@@ -97,15 +100,23 @@ def generate_image_from_keywords(keywords_prompt):
         "size": IMAGE_SIZE,
     }
 
+    call = usage_metrics.ApiCall("mcp", payload)
+    queue_placeholder = st.empty()
     with st.spinner(f"AI ({IMAGE_GENERATION_MODEL_ID.split('/')[-1]}) 正在根据关键词生成图像..."):
         try:
-            response = requests.post(DEEPSEEK_IMAGE_API_URL, headers=headers, json=payload, timeout=180) # Increased timeout
+            # 图片生成属于批量任务，排在交互聊天之后
+            response = async_client.post_coalesced(DEEPSEEK_IMAGE_API_URL, json=payload, timeout=180, # Increased timeout
+                                                   priority=admission.PRIORITY_BULK,
+                                                   on_wait=queue_notice(queue_placeholder),
+                                                   on_coalesced=call.coalesced)
+            queue_placeholder.empty()
             response.raise_for_status()
             ai_image_data = response.json()
 
             # SiliconFlow typically returns images in a "data" list, where each item is an object with "url" or "b64_json"
             if "data" in ai_image_data and ai_image_data["data"] and isinstance(ai_image_data["data"], list):
                 images_to_display = ai_image_data["data"]
+                call.finish(image_count=len(images_to_display))
                 if images_to_display:
                     with st.chat_message("ai"):
                         st.write("AI生成图像如下:")
@@ -126,6 +137,7 @@ def generate_image_from_keywords(keywords_prompt):
                 st.json(ai_image_data)
 
         except requests.exceptions.RequestException as e:
+            queue_placeholder.empty()
             st.error(f"图像生成API调用失败: {e}")
             if hasattr(e, 'response') and e.response is not None:
                 st.text(f"错误详情: {e.response.text}")
@@ -138,6 +150,8 @@ def generate_image_from_keywords(keywords_prompt):
             if 'response' in locals(): st.text(response.text) # Show raw text if response object exists
         except Exception as e:
             st.error(f"处理图像生成时发生未知错误: {e}")
+        finally:
+            call.record(st.session_state.get("user_id"))
 
     # If any error occurred and we didn't return True
     with st.chat_message("ai"): # Keep consistent chat message for failure
@@ -164,6 +178,11 @@ if st.button("从诗句生成画作", key="generate_from_poem_button", type="pri
     else:
         with st.chat_message("user"):
             st.write(f"**待分析诗句:**\n```\n{poem_input}\n```")
+        try:
+            usage_metrics.check_quota(st.session_state.get("user_id"), context_window.estimate_tokens(poem_input))
+        except usage_metrics.QuotaExceeded as e:
+            st.error(str(e))
+            st.stop()
 
         extracted_keywords = extract_keywords_from_poem(poem_input)
 
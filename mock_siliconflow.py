@@ -0,0 +1,204 @@
+# mock_siliconflow.py
+"""
+本地 SiliconFlow 替身服务器，用于离线测试和压测。
+
+实现 POST /v1/chat/completions（流式与非流式）和 POST /v1/images/generations，
+可配置延迟分布、错误率和限流（超出 --rate-limit 时返回 429 + Retry-After）。
+让应用改连本服务器：SILICONFLOW_BASE_URL=http://127.0.0.1:8765 API_KEY=mock streamlit run main.py
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8765
+
+
+class MockConfig:
+    """Behaviour knobs shared by all handler threads."""
+
+    def __init__(self, latency_ms=800.0, latency_dist="lognormal", latency_sigma=0.5, error_rate=0.0,
+                 rate_limit=0.0, retry_after_s=1, tokens_per_s=50.0, reply_tokens=60, image_latency_ms=5000.0):
+        self.latency_ms = latency_ms              # 非流式回复（或流式首 token）的延迟中位数
+        self.latency_dist = latency_dist          # fixed | uniform | lognormal
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate              # 返回 500 的概率
+        self.rate_limit = rate_limit              # 每秒允许的请求数，0 表示不限
+        self.retry_after_s = retry_after_s
+        self.tokens_per_s = tokens_per_s          # 流式输出速度
+        self.reply_tokens = reply_tokens
+        self.image_latency_ms = image_latency_ms
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._updated_at = time.monotonic()
+
+    def sample_latency_s(self, median_ms):
+        if self.latency_dist == "fixed":
+            ms = median_ms
+        elif self.latency_dist == "uniform":
+            ms = random.uniform(0, 2 * median_ms)
+        else:
+            # 对数正态：中位数为 median_ms，长尾由 sigma 控制
+            ms = median_ms * random.lognormvariate(0, self.latency_sigma)
+        return ms / 1000
+
+    def take_rate_token(self):
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._updated_at) * self.rate_limit)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        # api_client.prewarm() 用 HEAD 建立连接
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config = self.config
+        if not config.take_rate_token():
+            self._send_json(429, {"message": "rate limited"}, {"Retry-After": str(config.retry_after_s)})
+            return
+        if random.random() < config.error_rate:
+            self._send_json(500, {"message": "mock internal error"})
+            return
+        if self.path == "/v1/chat/completions":
+            self._chat(payload)
+        elif self.path == "/v1/images/generations":
+            self._images(payload)
+        else:
+            self._send_json(404, {"message": f"unknown path {self.path}"})
+
+    def _reply_words(self, payload):
+        messages = payload.get("messages") or [{}]
+        prompt = messages[-1].get("content")
+        if isinstance(prompt, list):  # VLM 的多段 content
+            prompt = " ".join(part.get("text", "") for part in prompt if isinstance(part, dict))
+        words = (str(prompt or "") + " mock").split()
+        count = min(self.config.reply_tokens, payload.get("max_tokens") or self.config.reply_tokens)
+        return [words[i % len(words)] for i in range(count)]
+
+    def _chat(self, payload):
+        config = self.config
+        words = self._reply_words(payload)
+        model = payload.get("model", "mock")
+        # R1 系列像真实接口一样先在 reasoning_content 里给出思考过程
+        reasoning_words = ["mock", "reasoning"] * (len(words) // 4) if "R1" in model else []
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in payload.get("messages", [])),
+                 "completion_tokens": len(reasoning_words) + len(words)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        time.sleep(config.sample_latency_s(config.latency_ms))
+        if not payload.get("stream"):
+            message = {"role": "assistant", "content": " ".join(words)}
+            if reasoning_words:
+                message["reasoning_content"] = " ".join(reasoning_words)
+            self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "model": model, "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            pieces = [("reasoning_content", word) for word in reasoning_words] + [("content", word) for word in words]
+            for i, (field, word) in enumerate(pieces):
+                chunk = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {field: word if i == 0 else " " + word}}]}
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                time.sleep(1 / config.tokens_per_s)
+            final = {"id": "mock", "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(final)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端中途断开
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _images(self, payload):
+        config = self.config
+        time.sleep(config.sample_latency_s(config.image_latency_ms))
+        count = payload.get("n") or payload.get("batch_size") or 1
+        images = [{"url": f"https://example.com/mock-image-{random.randrange(10 ** 6)}.png"} for _ in range(count)]
+        # word_image 读取 "images"，mcp 读取 "data"
+        self._send_json(200, {"images": images, "data": images, "seed": random.randrange(10 ** 6)})
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端读到 [DONE] 后直接关闭连接属于正常情况，不打印堆栈
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(config=None, port=DEFAULT_PORT, host="127.0.0.1"):
+    """Start the mock server on a daemon thread and return it (call shutdown() to stop)."""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-siliconflow", daemon=True).start()
+    return server
+
+
+def add_config_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="median chat latency / time to first token")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal tail width")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests/s before answering 429 (0 = off)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--tokens-per-s", type=float, default=50.0, help="streaming speed")
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--image-latency-ms", type=float, default=5000.0)
+
+
+def config_from_args(args):
+    return MockConfig(args.latency_ms, args.latency_dist, args.latency_sigma, args.error_rate, args.rate_limit,
+                      args.retry_after, args.tokens_per_s, args.reply_tokens, args.image_latency_ms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the SiliconFlow API.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(config_from_args(args), args.port)
+    print(f"Mock SiliconFlow listening on http://127.0.0.1:{args.port} (Ctrl-C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,279 @@
+# query_trace.py
+"""
+数据库查询追踪与慢查询日志。
+
+开启后（环境变量 DB_TRACE=1，或调用 database.enable_query_tracing()），新建的连接会换成
+带追踪的游标：记录每条语句的耗时、返回行数和发起调用的页面，按语句汇总统计；
+超过 SLOW_QUERY_MS 的语句以 JSON 行写入慢查询日志，并可附带 EXPLAIN QUERY PLAN。
+未开启时连接仍是普通的 PooledConnection，不经过这里的任何代码。
+
+连接上的 execute/executemany 快捷方法同样经由追踪游标执行，commit() 也单独计时
+（WAL 模式下写入最慢的往往是提交时的追加与 fsync），记为 COMMIT。sqlite3 的 trace callback
+用来补充记录其余不经过游标的语句，例如 ROLLBACK 以及触发器的执行（这些只计次数，耗时已
+算在所属语句里）；回调拿到的是代入了参数值的 SQL，记录前把其中的字面量替换为 ?，
+与游标记录的语句一致且不泄露参数。
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+TRACE_ENABLED = os.environ.get("DB_TRACE", "") == "1"
+SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "50"))
+SLOW_QUERY_LOG = os.environ.get("DB_SLOW_QUERY_LOG", "slow_queries.log")
+EXPLAIN_SLOW_QUERIES = os.environ.get("DB_EXPLAIN_SLOW_QUERIES", "1") == "1"
+
+# 调用栈中属于数据库层自身的文件，定位“调用页面”时跳过
+_INTERNAL_FILES = {"database.py", "query_trace.py", "write_behind.py", "threading.py", "thread.py"}
+
+_stats = {}
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+slow_query_logger = logging.getLogger("ai_app.slow_queries")
+_log_handler_lock = threading.Lock()
+
+
+def _get_slow_query_logger():
+    if not slow_query_logger.handlers:
+        with _log_handler_lock:
+            if not slow_query_logger.handlers:
+                handler = logging.FileHandler(SLOW_QUERY_LOG, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                slow_query_logger.addHandler(handler)
+                slow_query_logger.setLevel(logging.INFO)
+                slow_query_logger.propagate = False
+    return slow_query_logger
+
+
+def _calling_page():
+    """Name of the first non-database-layer file on the stack (the Streamlit page or script)."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.basename(frame.f_code.co_filename)
+        if filename not in _INTERNAL_FILES:
+            return filename
+        frame = frame.f_back
+    return threading.current_thread().name
+
+
+def _normalize(sql):
+    return " ".join(sql.split())
+
+
+# 字符串/BLOB 字面量和数值字面量（标识符中的数字前面是单词字符，不会匹配）
+_LITERAL_RE = re.compile(r"[xX]?'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+
+
+def _strip_literals(sql):
+    return _LITERAL_RE.sub("?", sql)
+
+
+class _Record:
+    __slots__ = ("sql", "parameters", "page", "elapsed", "rows", "error", "connection")
+
+    def __init__(self, sql, parameters, page, connection):
+        self.sql = sql
+        self.parameters = parameters
+        self.page = page
+        self.elapsed = 0.0
+        self.rows = 0
+        self.error = None
+        self.connection = connection
+
+
+def _explain(connection, sql, parameters):
+    if not EXPLAIN_SLOW_QUERIES or not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+        return None
+    try:
+        # 用基类 Cursor 执行，避免 EXPLAIN 本身再被追踪
+        cursor = sqlite3.Cursor(connection)
+        try:
+            return [row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+        finally:
+            cursor.close()
+    except sqlite3.Error:
+        return None
+
+
+def _finish(record):
+    elapsed_ms = record.elapsed * 1000
+    key = _normalize(record.sql)
+    with _stats_lock:
+        stat = _stats.get(key)
+        if stat is None:
+            stat = _stats[key] = {"sql": key, "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                                  "errors": 0, "pages": set()}
+        stat["calls"] += 1
+        stat["total_ms"] += elapsed_ms
+        stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+        stat["rows"] += record.rows
+        stat["errors"] += record.error is not None
+        stat["pages"].add(record.page)
+    if elapsed_ms >= SLOW_QUERY_MS or record.error is not None:
+        # 参数可能包含密码等敏感信息，日志中只记录参数个数
+        entry = {
+            "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ms": round(elapsed_ms, 3),
+            "rows": record.rows,
+            "page": record.page,
+            "sql": key,
+            "param_count": len(record.parameters) if hasattr(record.parameters, "__len__") else None,
+        }
+        if record.error is not None:
+            entry["error"] = str(record.error)
+        elif record.connection is not None:
+            entry["plan"] = _explain(record.connection, record.sql, record.parameters)
+        _get_slow_query_logger().info(json.dumps(entry, ensure_ascii=False))
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that times each statement until its rows have been fetched."""
+
+    _record = None
+
+    def _close_record(self):
+        record = self._record
+        if record is not None:
+            self._record = None
+            _finish(record)
+
+    def _run(self, method, sql, parameters):
+        self._close_record()
+        record = _Record(sql, parameters, _calling_page(), self.connection)
+        _local.in_wrapped = True
+        start = time.perf_counter()
+        try:
+            method(sql, parameters)
+        except sqlite3.Error as e:
+            record.elapsed = time.perf_counter() - start
+            record.error = e
+            _finish(record)
+            raise
+        finally:
+            _local.in_wrapped = False
+        record.elapsed = time.perf_counter() - start
+        if self.description is None:
+            # 非查询语句：没有结果集，直接结束计时
+            record.rows = max(self.rowcount, 0)
+            _finish(record)
+        else:
+            self._record = record
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        return self._run(super().executemany, sql, seq_of_parameters)
+
+    def _timed_fetch(self, fetch, *args):
+        record = self._record
+        if record is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            record.elapsed += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._timed_fetch(super().fetchone)
+        if self._record is not None:
+            if row is None:
+                self._close_record()
+            else:
+                self._record.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed_fetch(super().fetchmany, size)
+        if self._record is not None:
+            self._record.rows += len(rows)
+            if len(rows) < size:
+                self._close_record()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed_fetch(super().fetchall)
+        if self._record is not None:
+            self._record.rows += len(rows)
+            self._close_record()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed_fetch(super().__next__)
+        except StopIteration:
+            self._close_record()
+            raise
+        if self._record is not None:
+            self._record.rows += 1
+        return row
+
+    def close(self):
+        self._close_record()
+        super().close()
+
+    def __del__(self):
+        self._close_record()
+
+
+class TracingConnectionMixin:
+    """Mixin for sqlite3.Connection subclasses: hands out TracedCursor and installs the trace callback."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute 不经过 cursor()，在这里改为走追踪游标
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if not self.in_transaction:
+            return super().commit()
+        record = _Record("COMMIT", (), _calling_page(), None)
+        _local.in_wrapped = True  # trace callback 不再重复记录这条 COMMIT
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        except sqlite3.Error as e:
+            record.error = e
+            raise
+        finally:
+            _local.in_wrapped = False
+            record.elapsed = time.perf_counter() - start
+            _finish(record)
+
+    def install_trace_callback(self):
+        page_for = _calling_page
+
+        def on_statement(statement):
+            # 游标 execute 和 commit() 已单独计时；这里只记录触发器、ROLLBACK 等其它语句
+            if getattr(_local, "in_wrapped", False) and not statement.startswith("-- TRIGGER"):
+                return
+            record = _Record(_strip_literals(statement), (), page_for(), None)
+            _finish(record)
+
+        self.set_trace_callback(on_statement)
+
+
+def get_stats():
+    """Aggregated per-statement stats, slowest total first."""
+    with _stats_lock:
+        stats = [dict(stat, pages=sorted(stat["pages"])) for stat in _stats.values()]
+    return sorted(stats, key=lambda stat: stat["total_ms"], reverse=True)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
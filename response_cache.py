@@ -0,0 +1,103 @@
+# response_cache.py
+"""
+LLM 回复缓存（可选，设置 LLM_RESPONSE_CACHE=1 开启）。
+
+缓存键是完整请求 payload（模型、system prompt、历史、max_tokens、top_p 等）规范化
+JSON 的 SHA-256，流式与非流式请求共用同一个键。进程内 LRU 在前，未命中时再查
+database.LLM_CACHE_DATABASE 中的持久层；两层都按 CACHE_TTL_S 过期，持久层超过
+CACHE_MAX_BYTES 时按最近使用时间淘汰。需要新的随机采样结果时调用方传 bypass 跳过缓存。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+ENABLED = os.environ.get("LLM_RESPONSE_CACHE", "") == "1"
+CACHE_TTL_S = int(os.environ.get("LLM_CACHE_TTL_S", str(24 * 3600)))
+MEMORY_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 请求中不影响回复内容的字段，不参与缓存键
+_KEY_EXCLUDED_FIELDS = ("stream",)
+
+_memory = OrderedDict()             # {key: (写入时间, 回复)}，末尾为最近使用
+_lock = threading.Lock()
+_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0,
+             "memory_evictions": 0, "disk_evictions": 0}
+
+
+def _count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def make_key(payload):
+    """Canonical SHA-256 of a request payload."""
+    canonical = {k: v for k, v in payload.items() if k not in _KEY_EXCLUDED_FIELDS}
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _remember(key, created_at, response):
+    with _lock:
+        _memory[key] = (created_at, response)
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_MAX_ENTRIES:
+            _memory.popitem(last=False)
+            _counters["memory_evictions"] += 1
+
+
+def get(key):
+    """Return the cached response for key, or None on a miss (or when caching is disabled)."""
+    if not ENABLED:
+        return None
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if now - entry[0] < CACHE_TTL_S:
+                _memory.move_to_end(key)
+                _counters["memory_hits"] += 1
+                return entry[1]
+            del _memory[key]
+    stored = database.get_cached_llm_response(key, CACHE_TTL_S)
+    if stored is None:
+        _count("misses")
+        return None
+    response, created_at = stored
+    _count("disk_hits")
+    _remember(key, created_at, response)
+    database.touch_cached_llm_response_async(key)
+    return response
+
+
+def _on_stored(future):
+    if future.exception() is None:
+        _count("disk_evictions", future.result())
+
+
+def put(key, model_name, response):
+    """Cache a complete response in memory and (in the background) on disk."""
+    if not ENABLED or not response:
+        return
+    _remember(key, time.time(), response)
+    _count("stores")
+    database.store_cached_llm_response_async(
+        key, model_name, response, CACHE_TTL_S, CACHE_MAX_BYTES).add_done_callback(_on_stored)
+
+
+def stats():
+    """Hit/miss counters plus the current in-memory entry count."""
+    with _lock:
+        return dict(_counters, memory_entries=len(_memory))
+
+
+def clear():
+    """Drop both cache tiers."""
+    with _lock:
+        _memory.clear()
+    database.clear_llm_response_cache()
@@ -15,7 +15,7 @@ if not st.session_state.get("authenticated"):
 
 # Retrieve current user's ID and username
 current_username = st.session_state.get('username')
-current_user = database.get_user_by_username(current_username)
+current_user = database.get_user_by_id(st.session_state.get('user_id'))  # 走用户缓存，通常不访问数据库
 current_user_id = current_user['id'] if current_user else None
 
 if not current_user_id:
@@ -34,6 +34,12 @@ AVAILABLE_MODELS = {
 }
 
 
+# 查看全部及按模型/日期/用户名查找时每页显示的会话数
+HISTORY_PAGE_SIZE = 10
+# 关键词查找每页显示的匹配消息数
+KEYWORD_PAGE_SIZE = 30
+
+
 # --- Search/Display Function ---
 def display_chat_results(search_results, title_prefix=""):
     """Helper function to display chat results in a consistent format."""
@@ -52,99 +58,212 @@ def display_chat_results(search_results, title_prefix=""):
                     role_name = "human" if message['role'] == "user" else "ai"
                     with st.chat_message(name=role_name):
                         st.markdown(message['content'])
+                        if message.get('snippet'):
+                            st.caption(f"匹配片段: {message['snippet']}")  # 关键词以粗体高亮
                         st.caption(f"_{message['created_at']}_")  # Optional: show message timestamp
                 st.write("---")  # Separator for clarity within expander
     else:
         st.info(f"{title_prefix} 未找到聊天记录。")
 
 
-def search_chat_history(user_id, search_type, search_value, is_admin_user):
-    conn = database.create_connection()
+def search_chat_history(user_id, search_type, search_value, is_admin_user, page_cursor=None):
+    """Return (sessions, next_cursor) for one page of search results; next_cursor is None on the last page."""
+    # 参数与权限检查在脚本线程内完成（跨分片并行查询的工作线程里不能调用 st.*）
+    if search_type == "by_username" and not is_admin_user:
+        st.error("您没有权限按用户名搜索其他用户。")
+        return [], None # Prevent non-admin from searching by username
+    if search_type not in ("by_keyword", "by_model", "by_date", "by_username", "all") or \
+            (search_type != "all" and not search_value):
+        st.warning("请输入有效的搜索条件。")
+        return [], None
+
+    # 要查询的用户范围，None 表示全部用户（管理员）
+    if search_type == "by_username":
+        # This condition is specifically for admin to search by username
+        user_ids = list(database.find_usernames_like(search_value))
+        if not user_ids:
+            return [], None
+    elif not is_admin_user:
+        user_ids = [user_id]
+    else:
+        user_ids = None
+
+    if search_type != "by_keyword":
+        # 按会话过滤的查找方式与“查看全部”共用按 (started_at, session_id) 翻页的接口
+        filters = {}
+        if search_type == "by_model":
+            filters["model_name"] = search_value
+        elif search_type == "by_date":
+            filters["started_on"] = datetime.date.fromisoformat(search_value) # Assuming search_value is already 'YYYY-MM-DD'
+        return database.get_chat_sessions_page(page_cursor=page_cursor, limit=HISTORY_PAGE_SIZE,
+                                               user_ids=user_ids, **filters)
+
+    # 关键词查找按匹配的消息翻页；游标记录每个聊天库已返回的最后一条，各库分别继续
+    page_cursor = page_cursor or {}
+    match_query = database.fts_match_query(search_value)
+    try:
+        # 启用分片时并行查询各分片后合并；未分片时只有中心库一个。每个库多取一条用于判断是否还有下一页
+        parts = database.fan_out(
+            lambda chat_db: _search_chat_database(chat_db, search_value, user_ids, match_query,
+                                                  page_cursor.get(chat_db), KEYWORD_PAGE_SIZE + 1),
+            database.chat_databases(user_ids))
+    except sqlite3.Error as e:
+        st.error(f"数据库查询失败: {e}")
+        return [], None
+    except Exception as e:
+        st.error(f"处理搜索请求时发生错误: {e}")
+        return [], None
+
+    rows = [row for part in parts for row in part]
+    # bm25() 越小越相关；全文索引不可用时按消息时间从新到旧
+    rows = sorted((row for row in rows if row["rank"] is not None),
+                  key=lambda row: (row["rank"], row["message_id"], row["chat_db"])) + \
+        sorted((row for row in rows if row["rank"] is None),
+               key=lambda row: (row["created_at"] or "", row["message_id"], row["chat_db"]), reverse=True)
+    next_cursor = None
+    if len(rows) > KEYWORD_PAGE_SIZE:
+        rows = rows[:KEYWORD_PAGE_SIZE]
+        next_cursor = dict(page_cursor)
+        for row in rows:
+            next_cursor[row["chat_db"]] = row["cursor"]
+
+    # 同一会话的匹配消息合并为一个条目，会话按其最相关消息排序，会话内部仍按时间顺序展示
+    sessions = {}
+    for row in rows:
+        session = sessions.setdefault((row["chat_db"], row["session_id"]), {
+            "session_id": row["session_id"],
+            "user_id": row["user_id"],
+            "model_name": row["model_name"],
+            "started_at": row["started_at"],
+            "messages": []
+        })
+        session["messages"].append({
+            "role": row["role"],
+            "content": row["content"],
+            "created_at": row["created_at"],
+            "snippet": row["snippet"]
+        })
+    results = list(sessions.values())
+    for session in results:
+        session["messages"].sort(key=lambda m: m["created_at"] or "")
+
+    usernames = database.get_usernames({session["user_id"] for session in results})
+    results = [session for session in results if session["user_id"] in usernames]
+    for session in results:
+        session["username"] = usernames[session["user_id"]]
+    if next_cursor is None:
+        # 已归档的旧会话单独搜索，排在热数据结果之后（最后一页）；归档后又继续聊过的会话两边都会命中，
+        # 归档中的（更早的）消息并入本页已有条目。分片间 session_id 可能重复，按 (user_id, session_id) 识别
+        hot = {(session["user_id"], session["session_id"]): session for session in results}
+        for session in database.search_archived_messages(search_value, user_ids):
+            existing = hot.get((session["user_id"], session["session_id"]))
+            if existing:
+                existing["messages"][:0] = session["messages"]
+            else:
+                results.append(session)
+    return results, next_cursor
+
+
+def _search_chat_database(chat_db, search_value, user_ids, match_query, after, limit):
+    """Return up to limit messages matching the keyword in a single chat database, continuing after the cursor."""
+    if match_query:
+        try:
+            return _query_chat_database(chat_db, search_value, user_ids, after, limit, match_query)
+        except sqlite3.OperationalError as e:
+            # 全文索引不可用（例如 SQLite 未编译 FTS5）时退回 LIKE 扫描
+            print(f"Full-text search unavailable, falling back to LIKE: {e}")
+    return _query_chat_database(chat_db, search_value, user_ids, after, limit)
+
+
+def _query_chat_database(chat_db, search_value, user_ids, after, limit, match_query=None):
+    conn = database.create_connection(chat_db)
     results = []
     if conn:
         try:
             cursor = conn.cursor()
 
-            query = """
-                SELECT
-                    cs.session_id,
-                    u.username,
-                    cs.model_name,
-                    cs.started_at,
-                    cm.role,
-                    cm.content,
-                    cm.created_at
-                FROM
-                    chat_messages cm
-                JOIN
-                    chat_sessions cs ON cm.session_id = cs.session_id
-                JOIN
-                    users u ON cs.user_id = u.id
-                WHERE
-                    1=1
-            """
-            params = []
-
-            # Add user ID restriction for non-admin users
-            if not is_admin_user and search_type != "by_username": # Admins can search by username for all users
-                query += " AND cs.user_id = ?"
-                params.append(user_id)
-            elif search_type == "by_username" and not is_admin_user:
-                 st.error("您没有权限按用户名搜索其他用户。")
-                 return [] # Prevent non-admin from searching by username
-
-            # Add conditions based on search_type
-            if search_type == "by_keyword" and search_value:
-                query += " AND cm.content LIKE ?"
-                params.append(f'%{search_value}%')
-            elif search_type == "by_model" and search_value:
-                query += " AND cs.model_name = ?"
-                params.append(search_value)
-            elif search_type == "by_date" and search_value:
-                # Ensure date format is correct for database comparison
-                query += " AND DATE(cs.started_at) = ?"
-                params.append(search_value) # Assuming search_value is already 'YYYY-MM-DD'
-            elif search_type == "by_username" and search_value:
-                # This condition is specifically for admin to search by username
-                query += " AND u.username LIKE ?"
-                params.append(f'%{search_value}%')
-            elif search_type == "all": # For "查看全部" button
-                # No specific content/model/date/username filter needed, user_id filter already handled
-                pass
-            else: # If search_type or search_value is empty/invalid for a specific search
-                # This case might cover the initial load or empty search inputs for specific types
-                if search_type != "all": # Only show warning for non-"all" empty searches
-                    st.warning("请输入有效的搜索条件。")
-                return []
-
-
-            query += " ORDER BY cs.started_at DESC, cm.created_at ASC;"
+            if match_query:
+                # 关键词搜索走 FTS5 索引：按 BM25 排序并返回高亮片段
+                query = f"""
+                    SELECT
+                        cm.message_id,
+                        cs.session_id,
+                        cs.user_id,
+                        cs.model_name,
+                        cs.started_at,
+                        cm.role,
+                        cm.content,
+                        cm.created_at,
+                        snippet({database.CHAT_FTS_TABLE}, 0, '**', '**', '…', 24) AS snippet,
+                        bm25({database.CHAT_FTS_TABLE}) AS rank
+                    FROM
+                        {database.CHAT_FTS_TABLE}
+                    JOIN
+                        chat_messages cm ON cm.message_id = {database.CHAT_FTS_TABLE}.rowid
+                    JOIN
+                        chat_sessions cs ON cm.session_id = cs.session_id
+                    WHERE
+                        {database.CHAT_FTS_TABLE} MATCH ?
+                """
+                params = [match_query]
+                if after is not None:
+                    # (rank, message_id) 行值比较，从上一页最后一条之后继续
+                    query += f" AND (bm25({database.CHAT_FTS_TABLE}), cm.message_id) > (?, ?)"
+                    params.extend(after)
+            else:
+                # 关键词过短（少于 3 个字符）时 trigram 索引无法使用
+                query = """
+                    SELECT
+                        cm.message_id,
+                        cs.session_id,
+                        cs.user_id,
+                        cs.model_name,
+                        cs.started_at,
+                        cm.role,
+                        cm.content,
+                        cm.created_at,
+                        NULL AS snippet,
+                        NULL AS rank
+                    FROM
+                        chat_messages cm
+                    JOIN
+                        chat_sessions cs ON cm.session_id = cs.session_id
+                    WHERE
+                        cm.content LIKE ?
+                """
+                params = [f'%{search_value}%']
+                if after is not None:
+                    query += " AND (IFNULL(cm.created_at, ''), cm.message_id) < (?, ?)"
+                    params.extend(after)
+
+            # Restrict to the users in scope (the current user for non-admins)
+            if user_ids is not None:
+                query += f" AND cs.user_id IN ({', '.join('?' for _ in user_ids)})"
+                params.extend(user_ids)
+
+            if match_query:
+                query += f" ORDER BY bm25({database.CHAT_FTS_TABLE}), cm.message_id LIMIT ?;"
+            else:
+                query += " ORDER BY IFNULL(cm.created_at, '') DESC, cm.message_id DESC LIMIT ?;"
+            params.append(limit)
 
             cursor.execute(query, tuple(params))
-            raw_results = cursor.fetchall()
-
-            session_dict = {}
-            for row in raw_results:
-                session_id, username, model_name, started_at, role, content, created_at = row
-                if session_id not in session_dict:
-                    session_dict[session_id] = {
-                        "session_id": session_id,
-                        "username": username,
-                        "model_name": model_name,
-                        "started_at": started_at,
-                        "messages": []
-                    }
-                session_dict[session_id]["messages"].append({
+            for row in cursor.fetchall():
+                message_id, session_id, row_user_id, model_name, started_at, role, content, created_at, snippet, rank = row
+                results.append({
+                    "chat_db": chat_db,
+                    "message_id": message_id,
+                    "session_id": session_id,
+                    "user_id": row_user_id,
+                    "model_name": model_name,
+                    "started_at": started_at,
                     "role": role,
                     "content": content,
-                    "created_at": created_at
+                    "created_at": created_at,
+                    "snippet": snippet,
+                    "rank": rank,
+                    "cursor": (rank, message_id) if match_query else (created_at or "", message_id)
                 })
-            results = list(session_dict.values())
-
-        except sqlite3.Error as e:
-            st.error(f"数据库查询失败: {e}")
-        except Exception as e:
-            st.error(f"处理搜索请求时发生错误: {e}")
         finally:
             conn.close()
     return results
@@ -186,8 +305,11 @@ with col2:
     st.write("") # Add some vertical space
     view_all_button = st.button("查看全部", use_container_width=True)
 
-# Handle button clicks
-if search_button:
+# 查找结果按页浏览：当前查找条件与游标栈（每一页的起始游标，栈顶为当前页）保存在 session_state 中，翻页时重新执行
+if view_all_button:
+    st.session_state.history_search = ("all", None, "全部聊天记录")
+    st.session_state.history_page_cursors = [None]
+elif search_button:
     if search_value: # Check if search_value is valid for the selected option
         actual_search_type = {
             "关键词查找": "by_keyword",
@@ -195,14 +317,27 @@ if search_button:
             "日期查找": "by_date",
             "用户名查找": "by_username",
         }.get(search_option)
-
-        with st.spinner(f"正在按 {search_option} 查找..."):
-            search_results = search_chat_history(current_user_id, actual_search_type, search_value, is_admin)
-        display_chat_results(search_results, title_prefix="查找结果")
+        st.session_state.history_search = (actual_search_type, search_value, "查找结果")
+        st.session_state.history_page_cursors = [None]
     else:
+        st.session_state.history_page_cursors = None
         st.warning(f"请为 '{search_option}' 输入有效的查找条件。")
-elif view_all_button:
-    with st.spinner("正在加载全部聊天记录..."):
-        # Call search_chat_history with "all" type and no specific search value
-        all_results = search_chat_history(current_user_id, "all", None, is_admin)
-    display_chat_results(all_results, title_prefix="全部聊天记录")
\ No newline at end of file
+
+if st.session_state.get("history_page_cursors"):
+    search_type, active_search_value, title = st.session_state.history_search
+    page_cursors = st.session_state.history_page_cursors
+    with st.spinner("正在加载聊天记录..." if search_type == "all" else "正在查找..."):
+        # 管理员可查看所有用户的会话，普通用户只看自己的；每次只取一页
+        page_results, next_cursor = search_chat_history(
+            current_user_id, search_type, active_search_value, is_admin, page_cursors[-1])
+    display_chat_results(page_results, title_prefix=f"{title} · 第 {len(page_cursors)} 页")
+
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if st.button("上一页", disabled=len(page_cursors) <= 1, use_container_width=True, key="history_prev_page"):
+            page_cursors.pop()
+            st.rerun()
+    with next_col:
+        if st.button("下一页", disabled=next_cursor is None, use_container_width=True, key="history_next_page"):
+            page_cursors.append(next_cursor)
+            st.rerun()
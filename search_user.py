@@ -1,6 +1,8 @@
+import datetime
 import streamlit as st
 import database  # Import your database module
 import authenticator as auth  # Assuming authentication is still needed
+import usage_metrics
 
 st.set_page_config(page_title="搜索用户", layout="centered")
 st.title("👥 搜索用户")
@@ -19,28 +21,19 @@ if current_username != "admin":
 st.info(f"当前用户: **{current_username}** (管理员)")
 
 
+# 每页显示的用户数
+USER_PAGE_SIZE = 20
+
+
 # --- Search Functionality ---
-def get_user_by_criteria(search_type, search_value):
-    conn = database.create_connection()
-    users = []
-    if conn:
-        try:
-            cursor = conn.cursor()
-            if search_type == "username":
-                cursor.execute("SELECT id, username, email FROM users WHERE username LIKE ?", (f"%{search_value}%",))
-            elif search_type == "email":
-                cursor.execute("SELECT id, username, email FROM users WHERE email LIKE ?", (f"%{search_value}%",))
-            else:  # For 'display_all' case, or if search_value is empty for a general search
-                cursor.execute("SELECT id, username, email FROM users ORDER BY username ASC")  # Order for consistency
-
-            raw_results = cursor.fetchall()
-            for row in raw_results:
-                users.append({"id": row[0], "username": row[1], "email": row[2]})
-        except sqlite3.Error as e:
-            st.error(f"数据库查询失败: {e}")
-        finally:
-            conn.close()
-    return users
+def get_user_by_criteria(search_type, search_value, after_username=None, limit=USER_PAGE_SIZE):
+    """Return (users, next_cursor) for one keyset page of users matching the criteria."""
+    if search_type == "username":
+        return database.get_users_page(after_username, limit, username_like=search_value)
+    elif search_type == "email":
+        return database.get_users_page(after_username, limit, email_like=search_value)
+    else:  # For 'display_all' case, or if search_value is empty for a general search
+        return database.get_users_page(after_username, limit)  # Ordered by username for consistent paging
 
 
 # --- Helper function to display user results ---
@@ -73,17 +66,76 @@ with col1:
 with col2:
     display_all_button = st.button("显示全部用户", use_container_width=True)
 
-# Handle button clicks
+# 当前查询条件与游标栈（栈顶为当前页的起始游标），翻页时保持不变
 if search_button:
     if search_value:
-        with st.spinner("正在搜索用户..."):
-            actual_search_type = "username" if search_type == "按用户名" else "email"
-            found_users = get_user_by_criteria(actual_search_type, search_value)
-        display_user_results(found_users, title="搜索结果")
+        actual_search_type = "username" if search_type == "按用户名" else "email"
+        st.session_state.user_search = {"type": actual_search_type, "value": search_value, "title": "搜索结果",
+                                        "cursors": [None]}
     else:
+        st.session_state.user_search = None
         st.warning("请输入搜索值。")
 elif display_all_button:
-    with st.spinner("正在加载全部用户..."):
-        # Call get_user_by_criteria with a special type or empty values to get all
-        all_users = get_user_by_criteria(None, None)  # Passing None will trigger the 'else' in get_user_by_criteria
-    display_user_results(all_users, title="全部用户")
\ No newline at end of file
+    # Passing None will trigger the 'else' in get_user_by_criteria
+    st.session_state.user_search = {"type": None, "value": None, "title": "全部用户", "cursors": [None]}
+
+user_search = st.session_state.get("user_search")
+if user_search:
+    with st.spinner("正在加载用户..."):
+        page_users, next_cursor = get_user_by_criteria(user_search["type"], user_search["value"],
+                                                       user_search["cursors"][-1])
+    display_user_results(page_users, title=f"{user_search['title']} · 第 {len(user_search['cursors'])} 页")
+
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if st.button("上一页", disabled=len(user_search["cursors"]) <= 1, use_container_width=True, key="users_prev_page"):
+            user_search["cursors"].pop()
+            st.rerun()
+    with next_col:
+        if st.button("下一页", disabled=next_cursor is None, use_container_width=True, key="users_next_page"):
+            user_search["cursors"].append(next_cursor)
+            st.rerun()
+
+
+# --- API 用量与配额 ---
+USAGE_GROUPS = {"按模型": "model", "按用户": "user", "按日期": "day"}
+
+st.markdown("---")
+st.subheader("📊 API 用量")
+today = datetime.date.today()
+usage_range = st.date_input("日期范围:", value=(today - datetime.timedelta(days=6), today), key="usage_date_range")
+usage_group_label = st.radio("分组方式:", tuple(USAGE_GROUPS), horizontal=True, key="usage_group_radio")
+if len(usage_range) == 2:  # 只选了起始日期时等待选择结束日期
+    usage_group_by = USAGE_GROUPS[usage_group_label]
+    usage_report = database.get_usage_report(usage_range[0].isoformat(), usage_range[1].isoformat(), usage_group_by)
+    if usage_group_by == "user":
+        usernames = database.get_usernames(row["key"] for row in usage_report)
+        for row in usage_report:
+            row["key"] = usernames.get(row["key"], f"(已删除用户 {row['key']})")
+    if usage_report:
+        st.dataframe(usage_report, use_container_width=True)
+    else:
+        st.info("该时间段内没有 API 调用记录。")
+
+st.subheader("🎫 每日配额")
+st.caption(f"默认配额：每日 {usage_metrics.DAILY_TOKEN_QUOTA or '不限'} tokens，"
+           f"{usage_metrics.DAILY_REQUEST_QUOTA or '不限'} 次请求（环境变量 DAILY_TOKEN_QUOTA / DAILY_REQUEST_QUOTA）。")
+with st.form("user_quota_form"):
+    quota_username = st.text_input("用户名:", key="quota_username_input")
+    quota_tokens = st.number_input("每日 token 上限（0 = 不限）:", min_value=0, value=0, step=1000)
+    quota_requests = st.number_input("每日请求次数上限（0 = 不限）:", min_value=0, value=0, step=10)
+    quota_reset = st.checkbox("恢复为默认配额", value=False)
+    quota_submitted = st.form_submit_button("保存配额")
+if quota_submitted:
+    quota_user = database.get_user_by_username(quota_username.strip()) if quota_username.strip() else None
+    if not quota_user:
+        st.warning("未找到该用户。")
+    elif quota_reset:
+        if database.set_user_quota(quota_user['id']):
+            st.success(f"已恢复 {quota_user['username']} 的默认配额。")
+        else:
+            st.error("保存配额失败。")
+    elif database.set_user_quota(quota_user['id'], int(quota_tokens), int(quota_requests)):
+        st.success(f"已设置 {quota_user['username']} 的每日配额。")
+    else:
+        st.error("保存配额失败。")
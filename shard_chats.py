@@ -0,0 +1,99 @@
+# shard_chats.py
+import sqlite3
+
+import database as db
+
+BATCH_SIZE = 200
+
+
+def _moved_session_id(shard_cursor, session_id):
+    """Return the shard session_id that central session_id was already copied to, or None."""
+    # 搬迁记录与会话数据在同一个分片事务里提交：复制后、中心库删除前中断时，重跑只补做删除
+    shard_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS moved_sessions (
+            central_session_id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL
+        );
+    ''')
+    row = shard_cursor.execute('SELECT session_id FROM moved_sessions WHERE central_session_id = ?',
+                               (session_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _copy_session(shard_cursor, central_cursor, session_id, user_id, model_name, started_at):
+    """Copy one session (hot messages and archive) into its shard, keeping the original timestamps.
+
+    Records the move in the shard's moved_sessions table (same transaction); returns the new session_id.
+    """
+    new_session_id = db._insert_chat_session(shard_cursor, user_id, model_name)
+    shard_cursor.execute('UPDATE chat_sessions SET started_at = ? WHERE session_id = ?', (started_at, new_session_id))
+    central_cursor.execute('''
+        SELECT role, content, reasoning, created_at FROM chat_messages
+        WHERE session_id = ? ORDER BY created_at ASC, message_id ASC
+    ''', (session_id,))
+    shard_cursor.executemany(
+        'INSERT INTO chat_messages (session_id, role, content, reasoning, created_at) VALUES (?, ?, ?, ?, ?)',
+        [(new_session_id, role, content, reasoning, created_at)
+         for role, content, reasoning, created_at in central_cursor.fetchall()])
+    central_cursor.execute('SELECT codec, message_count, payload, archived_at FROM chat_archive WHERE session_id = ?',
+                           (session_id,))
+    archived = central_cursor.fetchone()
+    if archived:
+        shard_cursor.execute('''
+            INSERT INTO chat_archive (session_id, codec, message_count, payload, archived_at) VALUES (?, ?, ?, ?, ?)
+        ''', (new_session_id,) + tuple(archived))
+        codec, _, payload, _ = archived
+        db._index_archived_session(shard_cursor, new_session_id, db.decompress_messages(codec, payload))
+    shard_cursor.execute('INSERT INTO moved_sessions (central_session_id, session_id) VALUES (?, ?)',
+                         (session_id, new_session_id))
+    return new_session_id
+
+
+def shard_chats():
+    """One-time move of chat history from the central database into the shards selected by CHAT_SHARD_MODE."""
+    if not db.CHAT_SHARD_MODE:
+        print("CHAT_SHARD_MODE is not set; nothing to do.")
+        return
+    print(f"Moving chat history from {db.DATABASE_NAME} into {db.CHAT_SHARD_DIR} ({db.CHAT_SHARD_MODE} mode) ...")
+    moved = 0
+    central = db.create_connection()
+    try:
+        central_cursor = central.cursor()
+        while True:
+            central_cursor.execute('''
+                SELECT session_id, user_id, model_name, started_at FROM chat_sessions
+                ORDER BY session_id LIMIT ?
+            ''', (BATCH_SIZE,))
+            sessions = central_cursor.fetchall()
+            if not sessions:
+                break
+            for session_id, user_id, model_name, started_at in sessions:
+                shard = db.create_connection(db.chat_database_for_user(user_id))
+                try:
+                    shard_cursor = shard.cursor()
+                    new_session_id = _moved_session_id(shard_cursor, session_id)
+                    if new_session_id is None:
+                        new_session_id = _copy_session(shard_cursor, central_cursor, session_id, user_id, model_name,
+                                                       started_at)
+                    shard.commit()
+                finally:
+                    shard.close()
+                # 分片写入成功后再从中心库删除；中途中断时重跑只会处理剩余会话，已复制的不会再复制
+                central_cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+                db._unindex_archived_session(central_cursor, session_id)
+                # 用量明细留在中心库，改指向新的 session_id（分片 id 不小于 1 << SHARD_KEY_BITS，不会与尚未搬迁的旧 id 冲突）
+                central_cursor.execute('UPDATE api_call_metrics SET session_id = ? WHERE session_id = ?',
+                                       (new_session_id, session_id))
+                central_cursor.execute('DELETE FROM chat_archive WHERE session_id = ?', (session_id,))
+                central_cursor.execute('DELETE FROM chat_sessions WHERE session_id = ?', (session_id,))
+                central.commit()
+                moved += 1
+    except sqlite3.Error as e:
+        print(f"Database error during shard_chats: {e}")
+    finally:
+        central.close()
+    print(f"Moved {moved} chat sessions.")
+
+
+if __name__ == "__main__":
+    shard_chats()
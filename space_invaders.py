@@ -31,6 +31,31 @@ if 'lives' not in st.session_state:
 # High score is now handled by the database for the current user (if logged in) or globally for the game type
 # Removed 'high_score' from session_state as it's fetched from DB or calculated
 
+if 'pending_score_write' not in st.session_state:
+    st.session_state.pending_score_write = None  # (分数, Future)：后台写线程尚未确认的分数
+
+
+def save_score():
+    """Queue the current score on the write-behind queue; the result is reported on a later rerun."""
+    try:
+        future = database.save_game_score_async(st.session_state.user_id, "Space Invaders", st.session_state.score) # 后台线程批量写入
+    except RuntimeError as e:  # 写队列已关闭
+        st.toast(f"分数 {st.session_state.score} 保存失败: {e}", icon="❌")
+        return
+    st.session_state.pending_score_write = (st.session_state.score, future)
+
+
+# 上一次保存的分数在这里确认：写入完成前不阻塞页面渲染，等之后的某次 rerun 再提示
+if st.session_state.pending_score_write is not None:
+    pending_score, pending_future = st.session_state.pending_score_write
+    if pending_future.done():
+        if pending_future.exception() is not None:
+            st.toast(f"分数 {pending_score} 保存失败: {pending_future.exception()}", icon="❌")
+        else:
+            st.toast(f"分数 {pending_score} 已保存!", icon="💾")
+        st.session_state.pending_score_write = None
+
+
 # --- Sidebar ---
 with st.sidebar:
     st.title("🚀 Space Invaders 🚀")
@@ -85,19 +110,23 @@ with st.sidebar:
             st.session_state.game_active = False
             # Save score when game ends
             if st.session_state.user_id:
-                database.save_game_score(st.session_state.user_id, "Space Invaders", st.session_state.score)
-                st.toast(f"分数 {st.session_state.score} 已保存!", icon="💾")
+                save_score()
             st.rerun()
 
     st.markdown("---")
     st.subheader("🏆 排行榜 (Leaderboard)")
     if st.session_state.user_id:
+        if st.session_state.pending_score_write is not None:
+            st.caption("最新分数正在保存，排行榜稍后更新。")
         leaderboard_data = database.get_leaderboard("Space Invaders", limit=5)
         if leaderboard_data:
             for i, entry in enumerate(leaderboard_data):
                 st.write(f"**{i+1}. {entry['username']}** - {entry['score']}")
         else:
             st.info("还没有分数。成为第一个！")
+        my_rank = database.get_user_rank(st.session_state.user_id, "Space Invaders")
+        if my_rank:
+            st.caption(f"你的最好成绩: {my_rank['score']}（第 {my_rank['rank']} 名）")
     else:
         st.info("登录后查看排行榜。")
 
@@ -420,8 +449,7 @@ with game_column:
                     st.toast(f"游戏结束! 最终得分: {st.session_state.score}", icon="🏁")
                     st.session_state.game_active = False
                     if st.session_state.user_id: # Save score only if user is logged in
-                        database.save_game_score(st.session_state.user_id, "Space Invaders", st.session_state.score)
-                        st.toast(f"分数 {st.session_state.score} 已保存!", icon="💾")
+                        save_score()
                     should_rerun_for_game_over = True
 
                 if should_rerun_for_game_over:
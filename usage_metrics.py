@@ -0,0 +1,128 @@
+# usage_metrics.py
+"""
+模型调用的用量、延迟记录和每用户每日配额。
+
+页面为每次实际发出的模型调用创建一个 ApiCall：记录模型、请求参数、总耗时、流式调用的
+首 token 时间和接口返回的 usage（没有 usage 时用 context_window 估算并标记），
+record() 交给后台写线程写入 api_call_metrics，按 (用户, 日期, 模型) 的汇总由触发器维护。
+合并请求（post_coalesced）中搭便车的调用记为 'coalesced'、用量为 0，不计入汇总和配额。
+发请求前调用 check_quota()：当天请求数或 token 数达到上限时抛出 QuotaExceeded。
+上限优先取 user_quotas 中的个人设置，否则取 DAILY_TOKEN_QUOTA / DAILY_REQUEST_QUOTA（0 表示不限）。
+用量是异步写入的，配额检查可能漏算刚完成的一两个请求。
+"""
+import json
+import os
+import time
+
+import context_window
+import database
+
+DAILY_TOKEN_QUOTA = int(os.environ.get("DAILY_TOKEN_QUOTA", "0"))
+DAILY_REQUEST_QUOTA = int(os.environ.get("DAILY_REQUEST_QUOTA", "0"))
+
+# 记录到 params 中的请求字段（不含消息正文）
+PARAM_FIELDS = ("max_tokens", "temperature", "top_p", "top_k", "frequency_penalty", "stream",
+                "n", "image_size", "size", "height", "width", "batch_size", "guidance_scale")
+
+
+class QuotaExceeded(Exception):
+    """The user has used up today's request or token quota."""
+
+
+def today():
+    return time.strftime("%Y-%m-%d")
+
+
+def effective_quota(user_id):
+    """(daily_tokens, daily_requests) that apply to user_id; 0 means unlimited."""
+    daily_tokens, daily_requests = database.get_user_quota(user_id) or (None, None)
+    return (DAILY_TOKEN_QUOTA if daily_tokens is None else daily_tokens,
+            DAILY_REQUEST_QUOTA if daily_requests is None else daily_requests)
+
+
+def check_quota(user_id, estimated_tokens=0):
+    """Raise QuotaExceeded if a request of about estimated_tokens prompt tokens would exceed today's quota."""
+    if user_id is None:
+        return
+    token_limit, request_limit = effective_quota(user_id)
+    if not token_limit and not request_limit:
+        return
+    used = database.get_daily_usage(user_id, today())
+    if request_limit and used["calls"] >= request_limit:
+        raise QuotaExceeded(f"今日请求次数已达上限（{request_limit} 次），请明天再试。")
+    if token_limit and used["tokens"] + estimated_tokens > token_limit:
+        raise QuotaExceeded(f"今日 token 用量已达上限（已用 {used['tokens']} / {token_limit}），请明天再试。")
+
+
+def _prompt_tokens(payload):
+    tokens = context_window.estimate_tokens(payload.get("prompt", ""))
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):  # VLM 的多段 content，只估算文字部分
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        tokens += context_window.estimate_tokens(content) + context_window.MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+class ApiCall:
+    """Timing and usage of one model call; finish() marks it successful, record() stores it."""
+
+    def __init__(self, page, payload):
+        self.page = page
+        self.payload = payload
+        self.model_name = payload.get("model", "")
+        self.params = {field: payload[field] for field in PARAM_FIELDS if field in payload}
+        self.started_at = time.monotonic()
+        self.latency_s = None
+        self.first_token_s = None
+        self.status = "error"
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tokens_estimated = False
+        self.image_count = 0
+        self.shared = False
+
+    def coalesced(self):
+        """Mark the call as having joined another caller's in-flight request (pass as on_coalesced)."""
+        self.shared = True
+
+    def first_token(self):
+        """Note the arrival of the first streamed piece."""
+        if self.first_token_s is None:
+            self.first_token_s = time.monotonic() - self.started_at
+
+    def finish(self, usage=None, text=None, image_count=0):
+        """Mark the call successful; without a usage dict, tokens are estimated from the request and the reply text."""
+        self.latency_s = time.monotonic() - self.started_at
+        self.status = "ok"
+        self.image_count = image_count
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens") or 0
+            self.completion_tokens = usage.get("completion_tokens") or 0
+        elif text is not None:
+            self.prompt_tokens = _prompt_tokens(self.payload)
+            self.completion_tokens = context_window.estimate_tokens(text)
+            self.tokens_estimated = True
+
+    def record(self, user_id, session_id=None):
+        """Queue the metrics row; calls that never reached finish() are stored as errors."""
+        if user_id is None:
+            return None
+        latency_s = self.latency_s if self.latency_s is not None else time.monotonic() - self.started_at
+        # 用量已记在发出请求的那次调用上，这里只留一条耗时记录
+        shared = self.shared
+        return database.record_api_call_async({
+            "user_id": user_id,
+            "session_id": session_id,
+            "page": self.page,
+            "model_name": self.model_name,
+            "status": "coalesced" if shared else self.status,
+            "prompt_tokens": 0 if shared else self.prompt_tokens,
+            "completion_tokens": 0 if shared else self.completion_tokens,
+            "tokens_estimated": int(self.tokens_estimated and not shared),
+            "image_count": 0 if shared else self.image_count,
+            "latency_ms": round(latency_s * 1000),
+            "first_token_ms": round(self.first_token_s * 1000) if self.first_token_s is not None else None,
+            "params": json.dumps(self.params, ensure_ascii=False),
+            "day": today(),
+        })
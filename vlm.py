@@ -1,11 +1,14 @@
 import streamlit as st
 import requests
+import api_client  # 共享的 keep-alive 连接池
+import async_client  # 共享的事件循环，页面通过它发起 API 请求
+import usage_metrics
+import context_window
+import itertools
 import json
-import os
 
 # --- Configuration ---
-DEEPSEEK_API_URL = "https://api.siliconflow.cn/v1/chat/completions"
-DEEPSEEK_API_KEY = os.environ["API_KEY"]
+DEEPSEEK_API_URL = api_client.CHAT_COMPLETIONS_URL
 
 # Mapping from user-friendly display names to actual VLM model identifiers for the API
 # Ensure these actual model identifiers are exactly what the SiliconFlow API expects.
@@ -21,11 +24,8 @@ VLM_MODEL_OPTIONS_MAP = {
 # ("Qwen/QVQ-72B-Preview", "deepseek-ai/deepseek-vl2"),
 
 # --- API Communication Function ---
-def asktovlmai(input_text, image_url_val, model_option, max_tokens_val, top_p_val_api):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
+def asktovlmai(input_text, image_url_val, model_option, max_tokens_val, top_p_val_api, stream=False):
+    """Ask the VLM about an image; with stream=True the reply is rendered via st.write_stream as it arrives."""
     content_parts = []
     if input_text and input_text.strip():
         content_parts.append({"type": "text", "text": input_text})
@@ -55,14 +55,38 @@ def asktovlmai(input_text, image_url_val, model_option, max_tokens_val, top_p_va
     st.sidebar.write("Request Payload (for debugging):")
     st.sidebar.json(payload)
 
+    user_id = st.session_state.get("user_id")
+    try:
+        usage_metrics.check_quota(user_id, context_window.estimate_tokens(input_text))
+    except usage_metrics.QuotaExceeded as e:
+        st.error(str(e))
+        return "error: quota exceeded"
+
+    call = usage_metrics.ApiCall("vlm", payload)
     try:
+        if stream:
+            text_stream = api_client.TextStream(
+                async_client.stream_chat_completion(DEEPSEEK_API_URL, payload, timeout=120))
+            pieces = iter(text_stream)
+            with st.spinner("AI 正在思考中 (VLM)..."):
+                first_piece = next(pieces, None)  # 首个 token 到达前显示 spinner
+            if first_piece is None:
+                return "error: empty response from AI"
+            call.first_token()
+            st.write_stream(itertools.chain([first_piece], pieces))
+            if text_stream.error is not None:
+                # 中途断线：保留已收到的部分回复
+                st.warning(f"连接中断，回复可能不完整: {text_stream.error}")
+            call.finish(text_stream.usage, text_stream.text)
+            return text_stream.text.strip()
         with st.spinner("AI 正在思考中 (VLM)..."):
-            response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=120)
+            response = async_client.post_hedged(DEEPSEEK_API_URL, model_option, json=payload, timeout=120)
         response.raise_for_status()
         response_data = response.json()
         if response_data.get("choices") and len(response_data["choices"]) > 0 and response_data["choices"][0].get(
                 "message"):
             ai_response = response_data["choices"][0]["message"]["content"]
+            call.finish(response_data.get("usage"), ai_response)
             return ai_response.strip() if ai_response else "error: empty response from AI"
         else:
             st.error("API响应格式不正确或choices为空。")
@@ -84,6 +108,8 @@ def asktovlmai(input_text, image_url_val, model_option, max_tokens_val, top_p_va
     except Exception as e:
         st.error(f"处理API请求时发生未知错误: {e}")
         return "error: unknown processing error"
+    finally:
+        call.record(user_id)
 
 
 # --- Streamlit App UI ---
@@ -119,6 +145,8 @@ with st.sidebar:
         key="vlm_top_p_slider",
         help="控制输出文本的随机性。\n(API的temperature参数固定为0.7)"
     )
+    stream_output = st.checkbox("流式输出", value=True, key="vlm_stream_output_checkbox",
+                                help="边生成边显示回复，无需等待整段回复完成。")
 
 
 st.markdown("---")
@@ -154,16 +182,16 @@ if text_input_data or (image_url_input and not text_input_data):  # Allow if tex
         with st.chat_message("user"):
             st.markdown(user_message_display.strip())
 
-        ai_response = asktovlmai(
-            input_text=text_input_data if text_input_data else "",
-            image_url_val=image_url_input,
-            model_option=model_selected_vlm,  # Use the mapped VLM model ID
-            max_tokens_val=max_token_val,
-            top_p_val_api=top_p_val
-        )
-
-        if ai_response and not ai_response.startswith("error:"):
-            with st.chat_message("ai"):
+        with st.chat_message("ai"):
+            ai_response = asktovlmai(
+                input_text=text_input_data if text_input_data else "",
+                image_url_val=image_url_input,
+                model_option=model_selected_vlm,  # Use the mapped VLM model ID
+                max_tokens_val=max_token_val,
+                top_p_val_api=top_p_val,
+                stream=stream_output
+            )
+            if ai_response and not ai_response.startswith("error:") and not stream_output:
                 st.markdown(ai_response)
 
 # This separate button logic might become redundant if chat_input handles the "enter" key well
@@ -173,15 +201,16 @@ elif st.button("发送", key="send_button_vlm", help="如果您只输入了URL
         st.info("将尝试分析图片。建议也输入一个问题或指令。")
         with st.chat_message("user"):
             st.markdown(f"图片URL: {image_url_input}\n问题: (无文本输入，尝试分析图片)")
-        ai_response = asktovlmai(
-            input_text="",
-            image_url_val=image_url_input,
-            model_option=model_selected_vlm,
-            max_tokens_val=max_token_val,
-            top_p_val_api=top_p_val
-        )
-        if ai_response and not ai_response.startswith("error:"):
-            with st.chat_message("ai"):
+        with st.chat_message("ai"):
+            ai_response = asktovlmai(
+                input_text="",
+                image_url_val=image_url_input,
+                model_option=model_selected_vlm,
+                max_tokens_val=max_token_val,
+                top_p_val_api=top_p_val,
+                stream=stream_output
+            )
+            if ai_response and not ai_response.startswith("error:") and not stream_output:
                 st.markdown(ai_response)
     elif not image_url_input:
         st.warning("请输入图片URL。")
@@ -1,18 +1,56 @@
 import streamlit as st
 import requests
-import os # Added for environment variable access
+import api_client  # 共享的 keep-alive 连接池
+import async_client  # 共享的事件循环，页面通过它发起 API 请求
+import admission
+import usage_metrics
 
 # --- Configuration ---
-DEEPSEEK_API_URL = "https://api.siliconflow.cn/v1/images/generations"
-# Prefer environment variable for API key, fallback to hardcoded for development
-DEEPSEEK_API_KEY = os.environ["API_KEY"]
+DEEPSEEK_API_URL = api_client.IMAGE_GENERATIONS_URL
 
 # --- API Call Functions ---
+def queue_notice(placeholder):
+    """on_wait callback for api_client calls: show the admission queue position in placeholder."""
+    return lambda position, wait_s: placeholder.info(
+        f"请求排队中：前面还有 {position} 个请求，预计等待约 {wait_s:.0f} 秒。")
+
+
+def post_image_request(payload):
+    """Send an image generation request with a queue notice, recording its usage metrics.
+
+    Returns the response, or None (after showing the error) if no response was received:
+    the admission queue was full or timed out, or the request timed out or failed to connect.
+    """
+    call = usage_metrics.ApiCall("image", payload)
+    queue_placeholder = st.empty()
+    try:
+        with st.spinner("AI is generating image(s)..."):
+            # 图片生成属于批量任务，排在交互聊天之后
+            response = async_client.post_coalesced(DEEPSEEK_API_URL, json=payload, timeout=180,
+                                                   priority=admission.PRIORITY_BULK,
+                                                   on_wait=queue_notice(queue_placeholder),
+                                                   on_coalesced=call.coalesced)
+        if response.status_code == 200:
+            try:
+                call.finish(image_count=len(response.json().get("images") or []))
+            except requests.exceptions.JSONDecodeError:
+                pass  # 调用方会显示原始响应
+    except admission.AdmissionRejected as e:
+        st.error(f"The image queue is busy, please try again later: {e}")
+        return None
+    except requests.exceptions.Timeout:
+        st.error("The image request timed out. Please try again later.")
+        return None
+    except requests.exceptions.RequestException as e:
+        st.error(f"API request failed: {e}")
+        return None
+    finally:
+        queue_placeholder.empty()
+        call.record(st.session_state.get("user_id"))
+    return response
+
+
 def asktostabilityai(model_selected, current_prompt, batch_size_val, guidance_scale_val, image_size_val):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "model": model_selected,
         "prompt": current_prompt,
@@ -22,8 +60,11 @@ def asktostabilityai(model_selected, current_prompt, batch_size_val, guidance_sc
     }
     # Debug lines removed
 
-    with st.spinner("AI is generating image(s)..."):
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=180) # Added timeout
+    response = post_image_request(payload)
+    if response is None:
+        with st.chat_message("ai"):
+            st.write("No images were generated due to an error.")
+        return
 
     # Image output
     if response.status_code == 200:
@@ -52,10 +93,6 @@ def asktostabilityai(model_selected, current_prompt, batch_size_val, guidance_sc
 
 
 def asktoFLUX1schnell(model_selected, current_prompt, image_size_val):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "model": model_selected,
         "prompt": current_prompt,
@@ -63,8 +100,11 @@ def asktoFLUX1schnell(model_selected, current_prompt, image_size_val):
     }
     # Debug lines removed
 
-    with st.spinner("AI is generating image(s)..."):
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=180)
+    response = post_image_request(payload)
+    if response is None:
+        with st.chat_message("ai"):
+            st.write("No images were generated due to an error.")
+        return
 
     if response.status_code == 200:
         try:
@@ -91,10 +131,6 @@ def asktoFLUX1schnell(model_selected, current_prompt, image_size_val):
             st.write("No images were generated due to an error.")
 
 def asktoFLUX1pro(model_selected, current_prompt, height_val, width_val):
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "model": model_selected,
         "prompt": current_prompt,
@@ -103,8 +139,11 @@ def asktoFLUX1pro(model_selected, current_prompt, height_val, width_val):
     }
     # Debug lines removed
 
-    with st.spinner("AI is generating image(s)..."):
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=180)
+    response = post_image_request(payload)
+    if response is None:
+        with st.chat_message("ai"):
+            st.write("No images were generated due to an error.")
+        return
 
     if response.status_code == 200:
         try:
@@ -199,6 +238,11 @@ prompt_input = st.chat_input("输入描述词来生成图片...")
 if prompt_input:
     with st.chat_message("user"):
         st.write(f"提示词: {prompt_input}")
+    try:
+        usage_metrics.check_quota(st.session_state.get("user_id"))
+    except usage_metrics.QuotaExceeded as e:
+        st.error(str(e))
+        st.stop()
 
     # Call the appropriate function based on the selected model
     if selected_model in ("stabilityai/stable-diffusion-3-5-large", "stabilityai/stable-diffusion-3-5-large-turbo"):
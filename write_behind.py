@@ -0,0 +1,190 @@
+# write_behind.py
+"""
+单写线程的后台写队列（write-behind）。
+
+页面线程把写操作提交到队列后立即返回一个 Future；后台线程把一段时间内
+（或攒够一定数量）的写请求合并进同一个事务提交，遇到 "database is locked"
+时带抖动地指数退避重试。每个请求在事务里有自己的 SAVEPOINT，单个请求出错
+不会影响同批次的其它请求。
+"""
+import atexit
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class _WriteRequest:
+    __slots__ = ("fn", "args", "future")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+
+
+def _is_busy_error(e):
+    message = str(e).lower()
+    return "database is locked" in message or "database is busy" in message
+
+
+class WriteBehindQueue:
+    """Run write callbacks on one background thread, batched into shared transactions.
+
+    connect is a zero-argument callable returning a sqlite3 connection; each
+    submitted fn is called as fn(cursor, *args) and its return value resolves the
+    Future handed back by submit().
+    """
+
+    def __init__(self, connect, max_batch_size=100, max_batch_delay=0.05,
+                 max_retries=5, retry_base_delay=0.05):
+        self._connect = connect
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, fn, *args):
+        """Queue fn(cursor, *args) for the writer thread and return its Future."""
+        request = _WriteRequest(fn, args)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("write-behind queue has been shut down")
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sqlite-write-behind", daemon=True)
+                self._thread.start()
+            self._queue.put(request)
+        return request.future
+
+    def flush(self, timeout=None):
+        """Block until everything submitted before this call has been committed."""
+        self.submit(lambda cursor: None).result(timeout)
+
+    def shutdown(self, wait=True):
+        """Commit what is still queued, then stop the writer thread."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+            self._queue.put(_STOP)
+        if wait and thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            stop = False
+            # 批次触发条件：攒够 max_batch_size 个请求，或距第一个请求超过 max_batch_delay 秒
+            deadline = time.monotonic() + self.max_batch_delay
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                outcomes = self._apply_batch(batch)
+            except sqlite3.OperationalError as e:
+                if _is_busy_error(e) and attempt < self.max_retries:
+                    # 全抖动指数退避：在 [0, base * 2^attempt] 内随机等待
+                    time.sleep(random.uniform(0, self.retry_base_delay * (2 ** attempt)))
+                    continue
+                self._fail_all(batch, e)
+                return
+            except Exception as e:
+                self._fail_all(batch, e)
+                return
+            for request, result, error in outcomes:
+                if error is None:
+                    request.future.set_result(result)
+                else:
+                    request.future.set_exception(error)
+            return
+
+    def _apply_batch(self, batch):
+        conn = self._connect()
+        if conn is None:
+            raise sqlite3.OperationalError("unable to open database connection")
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE;")
+            outcomes = []
+            try:
+                for request in batch:
+                    cursor.execute("SAVEPOINT write_request;")
+                    try:
+                        result = request.fn(cursor, *request.args)
+                    except sqlite3.OperationalError as e:
+                        if _is_busy_error(e):
+                            raise  # 整批回滚后重试
+                        cursor.execute("ROLLBACK TO write_request;")
+                        cursor.execute("RELEASE write_request;")
+                        outcomes.append((request, None, e))
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write_request;")
+                        cursor.execute("RELEASE write_request;")
+                        outcomes.append((request, None, e))
+                    else:
+                        cursor.execute("RELEASE write_request;")
+                        outcomes.append((request, result, None))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            return outcomes
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _fail_all(batch, error):
+        for request in batch:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_write_queue(key, connect, **options):
+    """Return the process-wide WriteBehindQueue for key (e.g. a database path), creating it on first use."""
+    write_queue = _queues.get(key)
+    if write_queue is None:
+        with _queues_lock:
+            write_queue = _queues.get(key)
+            if write_queue is None:
+                write_queue = WriteBehindQueue(connect, **options)
+                # 进程退出前把队列里剩余的写请求提交完
+                atexit.register(write_queue.shutdown)
+                _queues[key] = write_queue
+    return write_queue
+
+
+def flush_all(timeout=None):
+    """Flush every queue created by get_write_queue()."""
+    for write_queue in list(_queues.values()):
+        write_queue.flush(timeout)